@@ -0,0 +1,357 @@
+#! /usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import datetime
+import itertools
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+import gillespie_multi_particle
+import heilmann
+import streams
+
+'''
+Benchmarks both models over grid sizes, EPS fills and burst sizes.
+
+Every case runs with a fixed seed in a fresh worker process, so its peak
+resident memory is its own, and reports:
+
+    steps_per_sec          time steps of the Heilmann model, or diffusion
+                           events (Plate.iterate() calls) of the GMP model
+    events_per_sec         lyses, replications and phage adsorptions to
+                           cells, debris and EPS of the Heilmann model, or
+                           reactions fired in the GMP patches
+    patch_updates_per_sec  patches times steps
+    peak_rss_mb            peak resident memory of the worker process
+
+Heilmann runs have no burn-in, so that every step counts its events as a
+recorded step would. Results are written as JSON, and a run can be compared
+with an earlier one to catch slowdowns:
+
+    python3 benchmark.py -o before.json
+    # ... change the code ...
+    python3 benchmark.py --baseline before.json -o after.json
+'''
+
+# Engines of the GMP Plate: exact steps in lock step or patch by patch, and
+# tau-leaping
+PLATE_ENGINES = ('lockstep', 'patch', 'tau')
+
+# Parameters of the GMP plate, as in gillespie_multi_particle.main() but
+# with infection and loss to goo fast enough that phage are taken up during
+# a run
+PLATE_PARAMS = dict(length=1, phage_diffusion=1, cell_diffusion=6, goo=5,
+                    max_cell_density=3, k_infect=0.01, k_lysis=0.1,
+                    k_goo=0.001, k_replicate=0.03)
+
+# Cells and phage in every patch of the dense GMP cases, where the patches
+# take some hundred thousand reactions per unit of plate time and
+# tau-leaping pays off. Infection is slowed down so that the cells last the
+# run, and the plates are small and run for a short time to keep the exact
+# engines quick.
+DENSE_LOAD = (50000, 200000)
+DENSE_PARAMS = dict(PLATE_PARAMS, k_infect=1e-5)
+DENSE_SIZE = 4
+DENSE_TIME = 0.25
+
+
+def make_cases(models=('heilmann', 'gmp'), engines=None, sizes=(20, 50, 100),
+               eps_list=(0.3,), burst_sizes=(20,), steps=100, plate_time=5,
+               seed=1234, dense_load=DENSE_LOAD):
+    """
+    Expand parameter lists into one benchmark case per combination.
+
+    Args:
+        models: Models to benchmark: 'heilmann' and/or 'gmp'.
+        engines: Engines to run, from heilmann.ENGINES and PLATE_ENGINES
+            (defaults to all of them).
+        sizes: Numbers of rows (and columns) of the square grids.
+        eps_list: EPS fill fractions, for the Heilmann model.
+        burst_sizes: Burst sizes.
+        steps: Time steps of every Heilmann run.
+        plate_time: Plate time every GMP run is advanced to.
+        seed: Seed of every run.
+        dense_load: (cells, phages) in every patch of the dense GMP cases,
+            run on DENSE_SIZE plates up to DENSE_TIME, or None to skip them.
+
+    Return:
+        List of case dicts, as taken by run_case().
+    """
+    cases = []
+    if 'heilmann' in models:
+        for engine, size, eps, burst in itertools.product(
+                sorted(heilmann.ENGINES), sizes, eps_list, burst_sizes):
+            if engines is None or engine in engines:
+                cases.append(dict(model='heilmann', engine=engine, rows=size,
+                                  cols=size, eps=eps, burst=burst,
+                                  steps=steps, seed=seed))
+    if 'gmp' in models:
+        for engine, size, burst in itertools.product(
+                PLATE_ENGINES, sizes, burst_sizes):
+            if engines is None or engine in engines:
+                cases.append(dict(model='gmp', engine=engine, rows=size,
+                                  cols=size, burst=burst,
+                                  plate_time=plate_time, seed=seed))
+        if dense_load is not None:
+            for engine, burst in itertools.product(PLATE_ENGINES,
+                                                   burst_sizes):
+                if engines is None or engine in engines:
+                    cases.append(dict(model='gmp', engine=engine,
+                                      rows=DENSE_SIZE, cols=DENSE_SIZE,
+                                      burst=burst, plate_time=DENSE_TIME,
+                                      seed=seed, load=list(dense_load)))
+    return cases
+
+
+def case_key(case):
+    """
+    Key identifying a case, to match it with the same case of a baseline.
+    """
+    return json.dumps({key: value for key, value in case.items()
+                       if key in ('model', 'engine', 'rows', 'cols', 'eps',
+                                  'burst', 'steps', 'plate_time', 'seed',
+                                  'load')},
+                      sort_keys=True)
+
+
+def run_case(case):
+    """
+    Run one benchmark case in this process.
+
+    Return:
+        The case, with its timings, counts and rates added.
+    """
+    if case['model'] == 'heilmann':
+        seconds, steps, events = _run_heilmann(case)
+    else:
+        seconds, steps, events = _run_plate(case)
+    patch_updates = steps * case['rows'] * case['cols']
+    return dict(case, seconds=seconds, step_count=steps, events=events,
+                patch_updates=patch_updates,
+                steps_per_sec=steps / seconds,
+                events_per_sec=events / seconds,
+                patch_updates_per_sec=patch_updates / seconds,
+                peak_rss_mb=peak_rss_mb())
+
+
+def _run_heilmann(case):
+    rng = np.random.default_rng(case['seed'])
+    start = time.perf_counter()
+    output = heilmann.run_simulation(
+        case['eps'], case['burst'], sim_time=case['steps'], burn_in=0,
+        rows=case['rows'], cols=case['cols'], engine=case['engine'], rng=rng,
+        verbose=False)
+    seconds = time.perf_counter() - start
+    events = output['burst_total'] + output['replication_total'] + \
+        output['lost_to_primary_infection'] + \
+        output['lost_to_secondary_infection'] + output['lost_to_eps'] + \
+        output['lost_to_debris']
+    return seconds, case['steps'], int(events)
+
+
+def _run_plate(case):
+    engine = case['engine']
+    load = case.get('load')
+    plate = gillespie_multi_particle.Plate(
+        case['rows'], case['cols'], burst_size=case['burst'],
+        tau_epsilon=0.03 if engine == 'tau' else None,
+        rng=streams.Streams(case['seed']), lockstep=engine == 'lockstep',
+        **(PLATE_PARAMS if load is None else DENSE_PARAMS))
+    if load is not None:
+        plate.cells[:], plate.phages[:] = load
+    events = 0
+    execute_until = plate.execute_until
+
+    def counting_execute_until(until):
+        # Count the reactions fired from the change in counts they cause
+        nonlocal events
+        before = plate.state.astype(np.int64)
+        execute_until(until)
+        events += reactions_fired(before, plate.state, plate.burst_size)
+    plate.execute_until = counting_execute_until
+
+    start = time.perf_counter()
+    steps = 0
+    while plate.time < case['plate_time']:
+        plate.iterate()
+        steps += 1
+    return time.perf_counter() - start, steps, events
+
+
+def reactions_fired(before, after, burst_size):
+    """
+    Count the reactions of gillespie_multi_particle.PHAGE_REACTIONS fired
+    between two states of a plate with no diffusion in between. Every
+    reaction changes the counts in its own way, so the number of each is
+    fixed by the changes: infections by the loss of cells, lyses by the
+    infected cells that were not added by infection, replications by the
+    gain of replicated cells, and phage lost to goo by the phage left
+    unaccounted for.
+    """
+    species = gillespie_multi_particle.Plate.species
+    change = dict(zip(species, after.astype(np.int64) - before))
+    infections = -change['cells']
+    lyses = infections - change['infected_cells']
+    replications = change['replicated_cells']
+    goo = burst_size * lyses - infections - change['phages']
+    return int(np.sum(infections + lyses + replications + goo))
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kB elsewhere
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def run_benchmarks(cases, repeat=1, out=sys.stdout):
+    """
+    Run every case `repeat` times, each in a fresh worker process, and keep
+    its fastest run.
+
+    Return:
+        List of the results of run_case(), in the order of cases.
+    """
+    results = []
+    for case in cases:
+        best = None
+        for _ in range(repeat):
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+                result = pool.submit(run_case, case).result()
+            if best is None or result['seconds'] < best['seconds']:
+                best = result
+        results.append(best)
+        print(format_result(best), file=out)
+        out.flush()
+    return results
+
+
+def environment():
+    """
+    Describe the machine and software the benchmarks ran on.
+    """
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+HEADER = "model\tengine\tsize\teps\tburst\tload\tsteps/s\tevents/s\t" \
+    "patch-updates/s\tpeak MB"
+
+
+def format_result(result):
+    load = result.get('load')
+    return "{}\t{}\t{}x{}\t{}\t{}\t{}\t{:.4g}\t{:.4g}\t{:.4g}\t{:.1f}".format(
+        result['model'], result['engine'], result['rows'], result['cols'],
+        result.get('eps', '-'), result['burst'],
+        '-' if load is None else '{}/{}'.format(*load),
+        result['steps_per_sec'],
+        result['events_per_sec'], result['patch_updates_per_sec'],
+        result['peak_rss_mb'])
+
+
+def compare(results, baseline, tolerance=0.1, out=sys.stdout):
+    """
+    Compare results with those of the same cases in a baseline, by their
+    steps per second.
+
+    Args:
+        results: Results of run_benchmarks().
+        baseline: Results of an earlier run, as saved by main().
+        tolerance: Fraction by which a case may be slower than its baseline
+            before it counts as a slowdown.
+
+    Return:
+        List of the results that are slower than their baseline by more than
+        tolerance.
+    """
+    before = {case_key(result): result for result in baseline}
+    slower = []
+    print("model\tengine\tsize\tsteps/s\tbaseline\tratio", file=out)
+    for result in results:
+        old = before.get(case_key(result))
+        if old is None:
+            continue
+        ratio = result['steps_per_sec'] / old['steps_per_sec']
+        flag = ''
+        if ratio < 1 - tolerance:
+            slower.append(result)
+            flag = '\tSLOWER'
+        print("{}\t{}\t{}x{}\t{:.4g}\t{:.4g}\t{:.2f}{}".format(
+            result['model'], result['engine'], result['rows'],
+            result['cols'], result['steps_per_sec'], old['steps_per_sec'],
+            ratio, flag), file=out)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Heilmann and GMP models.")
+    parser.add_argument('--models', nargs='+', choices=('heilmann', 'gmp'),
+                        default=['heilmann', 'gmp'])
+    parser.add_argument('--engines', nargs='+', default=None,
+                        choices=sorted(heilmann.ENGINES) +
+                        list(PLATE_ENGINES),
+                        help="engines to run (default: all)")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 50, 100],
+                        help="rows and columns of the square grids")
+    parser.add_argument('--eps', type=float, nargs='+', default=[0.3],
+                        help="EPS fill fractions (Heilmann model)")
+    parser.add_argument('--burst', type=int, nargs='+', default=[20],
+                        help="burst sizes")
+    parser.add_argument('--steps', type=int, default=100,
+                        help="time steps of every Heilmann run")
+    parser.add_argument('--plate-time', type=float, default=5,
+                        help="plate time of every GMP run")
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--dense-load', type=int, nargs=2,
+                        default=list(DENSE_LOAD),
+                        metavar=('CELLS', 'PHAGES'),
+                        help="cells and phage in every patch of the dense "
+                             "GMP cases, run on {0}x{0} plates to time "
+                             "{1}".format(DENSE_SIZE, DENSE_TIME))
+    parser.add_argument('--no-dense', action='store_true',
+                        help="skip the dense GMP cases")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="runs of every case, of which the fastest is "
+                             "kept")
+    parser.add_argument('-o', '--output', default=None,
+                        help="JSON file to write the results to")
+    parser.add_argument('--baseline', default=None,
+                        help="JSON file of earlier results to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="fraction by which a case may be slower than "
+                             "its baseline")
+    args = parser.parse_args()
+
+    cases = make_cases(args.models, args.engines, args.sizes, args.eps,
+                       args.burst, args.steps, args.plate_time, args.seed,
+                       None if args.no_dense else args.dense_load)
+    print(HEADER)
+    results = run_benchmarks(cases, repeat=args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f,
+                      indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        slower = compare(results, baseline, args.tolerance)
+        if slower:
+            print("{} case(s) slower than the baseline".format(len(slower)),
+                  file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
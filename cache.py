@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+'''
+Persistent, content-addressed cache of simulation results.
+
+A result is stored under the SHA-256 of a canonical JSON encoding of
+everything that determines it (model name and version, parameters and the
+starting state of the random number generator), so a run is only ever
+computed once for a cache directory. Results are dicts of numbers, strings
+and arrays, stored like heilmann checkpoints: arrays in an .npz file and
+everything else as JSON inside it.
+
+Writes go to a temporary file that is renamed into place, so any number of
+processes can share a cache directory and readers never see a partial
+entry. Reading an entry marks it as recently used, and when the cache grows
+beyond its size limit the least recently used entries are removed.
+'''
+
+
+class ResultCache:
+    """
+    Directory of cached results.
+
+    Attributes:
+        directory: Directory holding the entries, created if needed.
+        max_bytes: Size limit of the entries in bytes, or None for no limit.
+    """
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, **parts):
+        """
+        Get the key of the result determined by `parts`, as a hex digest.
+        Dict order does not matter, and tuples and NumPy values are keyed
+        like the equivalent lists and Python numbers.
+        """
+        text = json.dumps(parts, sort_keys=True, separators=(',', ':'),
+                          default=_json)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """
+        Get the result stored under `key`, or None if there is none.
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                result = json.loads(str(data['meta']))
+                for name in data.files:
+                    if name != 'meta':
+                        result[name] = data[name]
+            # Mark the entry as recently used
+            os.utime(path)
+        except (FileNotFoundError, zipfile.BadZipFile):
+            # Missing, or removed while being read
+            return None
+        return result
+
+    def put(self, key, result):
+        """
+        Store a result dict under `key`, replacing any entry there, then
+        evict entries beyond the size limit.
+        """
+        arrays = {name: value for name, value in result.items()
+                  if isinstance(value, np.ndarray)}
+        meta = {name: value for name, value in result.items()
+                if name not in arrays}
+        handle, temp = tempfile.mkstemp(dir=self.directory, prefix='.',
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez_compressed(
+                    f, meta=np.array(json.dumps(meta, default=_json)),
+                    **arrays)
+            os.replace(temp, self.path(key))
+        except BaseException:
+            os.unlink(temp)
+            raise
+        self.evict()
+
+    def get_or_compute(self, compute, **parts):
+        """
+        Get the result determined by `parts`, calling compute() and storing
+        its result if it is not cached yet.
+        """
+        key = self.key(**parts)
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in
+        max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if not entry.name.endswith('.npz'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # Already evicted by another process
+                pass
+            total -= size
+
+    def __len__(self):
+        return sum(1 for name in os.listdir(self.directory)
+                   if name.endswith('.npz'))
+
+
+def _json(value):
+    # Convert NumPy values and SeedSequences for json.dumps()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    elif isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, np.random.SeedSequence):
+        return {'entropy': value.entropy, 'spawn_key': value.spawn_key}
+    raise TypeError("Cannot encode {!r}".format(value))
@@ -1,8 +1,15 @@
 #! /usr/bin/env python3
 
+import concurrent.futures
+import math
+import operator
+import types
+from multiprocessing import shared_memory
+
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
+
+import recorder
+import streams
 
 '''
 Author: Benjamin R. Jack
@@ -15,6 +22,218 @@ doi: 10.1093/bioinformatics/btl271
 
 '''
 
+class Reaction:
+    """
+    A mass-action reaction in a patch.
+
+    Attributes:
+        name: Name of the reaction.
+        rate: Name of the Patch attribute holding the rate constant.
+        reactants: Dict of species name to number of particles consumed.
+        products: Dict of species name to number of particles produced. A
+            number may also be given as the name of a Patch attribute, as
+            for the burst size of lysis.
+    """
+    def __init__(self, name, rate, reactants, products):
+        self.name = name
+        self.rate = rate
+        self.reactants = reactants
+        self.products = products
+
+
+class ReactionNetwork:
+    """
+    A set of reactions compiled for the gillespie algorithm.
+
+    Stoichiometries are kept as sparse lists of the species each reaction
+    changes, and the dependency graph lists, for each reaction, the reactions
+    whose propensities change when it fires. After an event only those
+    propensities are recomputed, so the cost of an event does not grow with
+    reactions that it does not affect.
+
+    Attributes:
+        species: Tuple of species names, in the order used for counts.
+        reactions: Tuple of Reaction.
+        reactants: For each reaction, a tuple of (species index, number of
+            particles) pairs consumed.
+        dependents: For each reaction, a tuple of the indices of the
+            reactions whose propensities change when it fires, itself
+            included if it changes its own propensity.
+        mass_action: For each reaction, a function of the rate constant and
+            the counts giving its propensity.
+    """
+    def __init__(self, species, reactions):
+        self.species = tuple(species)
+        self.reactions = tuple(reactions)
+        index = {name: i for i, name in enumerate(self.species)}
+        # Parameters named as stoichiometries, and changes resolved for each
+        # combination of their values
+        self._parameters = tuple(sorted(
+            {number for reaction in self.reactions
+             for number in reaction.products.values()
+             if isinstance(number, str)}))
+        self._resolved = {}
+        self._get_parameters = operator.attrgetter(*self._parameters) \
+            if self._parameters else lambda params: ()
+        self._get_rates = operator.attrgetter(
+            *(reaction.rate for reaction in self.reactions))
+        self.reactants = tuple(
+            tuple((index[name], number)
+                  for name, number in reaction.reactants.items())
+            for reaction in self.reactions)
+        self.mass_action = tuple(_mass_action(reactants)
+                                 for reactants in self.reactants)
+        # Net change of each species touched by a reaction. A change is
+        # kept as a (produced, consumed) pair because produced may name a
+        # parameter.
+        self._changes = []
+        for reaction in self.reactions:
+            changes = []
+            for name in self.species:
+                produced = reaction.products.get(name, 0)
+                consumed = reaction.reactants.get(name, 0)
+                if isinstance(produced, str) or produced != consumed:
+                    changes.append((index[name], produced, consumed))
+            self._changes.append(tuple(changes))
+        # A reaction depends on every species it consumes
+        self.dependents = tuple(
+            tuple(other for other, reactants in enumerate(self.reactants)
+                  if any(s == species for species, _ in reactants
+                         for s, _, _ in changes))
+            for changes in self._changes)
+        # Order of each reaction, for the tau-leap size bound
+        self.orders = tuple(sum(number for _, number in reactants)
+                            for reactants in self.reactants)
+
+    def changes(self, params):
+        """
+        Resolve the net changes of every reaction.
+
+        Args:
+            params: Object whose attributes hold any named stoichiometries.
+
+        Return:
+            For each reaction, a tuple of (species index, change) pairs.
+        """
+        key = self._get_parameters(params)
+        if key not in self._resolved:
+            values = dict(zip(self._parameters, key
+                              if len(self._parameters) > 1 else (key,)))
+            self._resolved[key] = [
+                tuple((species, values.get(produced, produced) - consumed)
+                      for species, produced, consumed in changes)
+                for changes in self._changes]
+        return self._resolved[key]
+
+    def patch_changes(self, params):
+        """
+        Resolve the net changes of every reaction for many patches at once.
+
+        Args:
+            params: Object whose attributes hold any named stoichiometries,
+                as arrays of per-patch values.
+
+        Return:
+            For each reaction, a tuple of (species index, change) pairs,
+            where a change is a number or an array of per-patch changes.
+        """
+        return [tuple((species, getattr(params, produced) - consumed
+                       if isinstance(produced, str)
+                       else produced - consumed)
+                      for species, produced, consumed in changes)
+                for changes in self._changes]
+
+    def stoichiometry(self, params):
+        """
+        Build the stoichiometry matrix.
+
+        Args:
+            params: Object whose attributes hold any named stoichiometries.
+
+        Return:
+            Array of shape (reactions, species) of the net change in each
+            species when each reaction fires.
+        """
+        key = ('stoichiometry', self._get_parameters(params))
+        if key not in self._resolved:
+            matrix = np.zeros((len(self.reactions), len(self.species)),
+                              dtype=int)
+            for reaction, changes in enumerate(self.changes(params)):
+                for species, change in changes:
+                    matrix[reaction, species] = change
+            matrix.flags.writeable = False
+            self._resolved[key] = matrix
+        return self._resolved[key]
+
+    def rates(self, params):
+        """
+        Get the rate constants of every reaction.
+
+        Args:
+            params: Object whose attributes hold the rate constants.
+
+        Return:
+            List of rate constants, in the order of reactions.
+        """
+        rates = self._get_rates(params)
+        return list(rates) if len(self.reactions) > 1 else [rates]
+
+
+def _mass_action(reactants):
+    """
+    Build the propensity function of a reaction consuming `reactants`, a
+    tuple of (species index, number of particles) pairs. Reactions of up to
+    two single particles, the common case, get a function without loops.
+    """
+    if all(number == 1 for _, number in reactants):
+        if len(reactants) == 0:
+            return lambda rate, counts: rate
+        if len(reactants) == 1:
+            (a, _), = reactants
+            return lambda rate, counts: rate * counts[a]
+        if len(reactants) == 2:
+            (a, _), (b, _) = reactants
+            return lambda rate, counts: rate * counts[a] * counts[b]
+
+    def propensity(rate, counts):
+        for species, number in reactants:
+            rate *= math.comb(counts[species], number)
+        return rate
+    return propensity
+
+
+def _patch_mass_action(reactants):
+    """
+    Build the propensity function of a reaction consuming `reactants` for
+    arrays of counts of shape (species, patches). Reactions of single
+    particles share the functions of _mass_action(), which work on arrays
+    as they are, so propensities round exactly as in a single patch.
+    """
+    if all(number == 1 for _, number in reactants) and len(reactants) <= 2:
+        return _mass_action(reactants)
+
+    def propensity(rate, counts):
+        rate = rate * np.ones(counts.shape[1:])
+        for species, number in reactants:
+            for k in range(number):
+                rate = rate * (counts[species] - k) / (k + 1)
+        return rate
+    return propensity
+
+
+# Reactions within a patch. Phages lost to goo leave the goo in place, and
+# replicating cells stay put while their daughters wait to diffuse.
+PHAGE_REACTIONS = ReactionNetwork(
+    ('cells', 'phages', 'infected_cells', 'replicated_cells', 'goo'),
+    [Reaction('infect', 'k_infect', {'cells': 1, 'phages': 1},
+              {'infected_cells': 1}),
+     Reaction('lyse', 'k_lysis', {'infected_cells': 1},
+              {'phages': 'burst_size'}),
+     Reaction('replicate', 'k_replicate', {'cells': 1},
+              {'cells': 1, 'replicated_cells': 1}),
+     Reaction('goo', 'k_goo', {'phages': 1, 'goo': 1}, {'goo': 1})])
+
+
 class Patch:
     """
     A single patch in the simulation.
@@ -43,52 +262,111 @@ class Patch:
         time: Current time within the patch. This time may not always match the
             Plate time because each patch is an independent set of reactions
             being executed by the gillespie algorithm.
+        network: ReactionNetwork of the reactions in every patch. Its rate
+            constants are attributes of the patch.
+        counts: List of the particle counts of the species of network, in
+            order. The named counts above are views into it.
+        rng: Random number generator the reactions are drawn from: an
+            np.random.Generator, such as one of a streams.Streams, or the
+            np.random module to draw from NumPy's global random state.
 
     """
+    network = PHAGE_REACTIONS
+    # Smallest mean number of reactions a tau-leap must cover to be taken
+    leap_threshold = 10
+    # The running sum of the propensities is recomputed from scratch every
+    # so many events, and whenever it falls below resum_below, so that
+    # rounding errors in its updates cannot build up
+    resum_interval = 1000
+    resum_below = 1e-9
+
     def __init__(self, row, col, length, cells, phages, goo, burst_size,
-                 k_replicate, k_infect, k_lysis, k_goo):
+                 k_replicate, k_infect, k_lysis, k_goo, rng=None):
         """
         Inits Patch with row and column positions, dimensions, number of cells,
         number of phage, number of goo particles, and associated rate constants.
+        If rng is None, a new np.random.Generator is used.
         """
-        self.cells = cells
-        self.phages = phages
-        self.infected_cells = 0
-        self.replicated_cells = 0
+        self.rng = np.random.default_rng() if rng is None else rng
+        initial = {'cells': cells, 'phages': phages, 'goo': goo}
+        self.counts = [initial.get(name, 0) for name in self.network.species]
         self.k_replicate = k_replicate
         self.k_lysis = k_lysis
         self.k_infect = k_infect
         self.k_goo = k_goo
-        self.goo = goo
         self.burst_size = burst_size
         self.row = row
         self.col = col
         self.length = length
         self.time = 0
 
-    def execute_until(self, time):
+    def execute_until(self, time, tau_epsilon=None, fired=None):
         """
         Execute reactions following gillespie algorithm until a given time.
 
+        Only the propensities of the reactions that depend on the one that
+        fired are recomputed after each event (see ReactionNetwork), and the
+        next reaction is selected with a cumulative sum search. Their sum is
+        updated the same way and recomputed every resum_interval events. If
+        it has drifted above the actual propensities and the search runs
+        past them, the event is rejected and nothing fires, which as with
+        thinning leaves the distribution of reactions exact.
+
+        With tau_epsilon set, the patch switches to tau-leaping whenever a
+        leap that keeps the relative change in propensities below
+        tau_epsilon would cover many reactions (see leap_size()), and falls
+        back to exact steps otherwise.
+
         Args:
             time: Time at which reactions should stop executing.
+            tau_epsilon: Error tolerance for adaptive tau-leaping, or None to
+                only execute exact gillespie steps.
+            fired: List of the number of firings of every reaction, added
+                to, or None.
         """
+        network = self.network
+        mass_action = network.mass_action
+        rates = network.rates(self)
+        changes = network.changes(self)
+        dependents = network.dependents
+        counts = self.counts
+        random = self.rng.random
+        prop = [propensity(rate, counts)
+                for propensity, rate in zip(mass_action, rates)]
+        prop_sum = sum(prop)
+        # Exact steps left before trying to leap again
+        exact_steps = 0
+        # Events since prop_sum was last recomputed
+        events = 0
         while (self.time < time):
-            # Calculate propensities for all reactions
-            prop = np.array([self.k_infect * self.cells * self.phages,
-                             self.k_lysis * self.infected_cells,
-                             self.k_replicate * self.cells,
-                             self.k_goo * self.goo * self.phages])
+            # Only leap if there are enough reactions left before time for a
+            # leap to be worth it
+            if tau_epsilon is not None and exact_steps == 0 and \
+                    prop_sum * (time - self.time) >= self.leap_threshold:
+                tau = self.leap_size(tau_epsilon)
+                if tau is not None:
+                    firings = self.leap(min(tau, time - self.time))
+                    if fired is not None:
+                        for reaction, number in enumerate(firings.tolist()):
+                            fired[reaction] += number
+                    prop = [propensity(rate, counts)
+                            for propensity, rate in zip(mass_action, rates)]
+                    prop_sum = sum(prop)
+                    continue
+                # A leap would cover fewer reactions than this anyway
+                exact_steps = self.leap_threshold
+            exact_steps = max(exact_steps - 1, 0)
 
-            # Find total propensity of the system
-            prop_sum = prop.sum()
+            if events >= self.resum_interval or prop_sum < self.resum_below:
+                prop_sum = sum(prop)
+                events = 0
 
             # End the simulation if propensities are 0 and no cells are infected
-            if prop_sum == 0:
+            if prop_sum <= 0:
                 break
 
             # Calculate time until next reaction will occur
-            dt = -(1/prop_sum)*np.log(np.random.rand())
+            dt = -(1/prop_sum)*math.log(random())
             # Update current time in this patch
             self.time += dt
             # If we've gone past the time for the next diffusion event, break
@@ -96,47 +374,128 @@ class Patch:
             if self.time > time:
                 break
 
-            # Randomly select next reaction to occur
-            next_reaction = np.random.multinomial(1,
-                                                  prop/prop_sum).nonzero()[0][0]
+            # Select the next reaction with a cumulative sum search
+            target = random() * prop_sum
+            next_reaction = 0
+            cumulative = prop[0]
+            while cumulative <= target and next_reaction < len(prop) - 1:
+                next_reaction += 1
+                cumulative += prop[next_reaction]
+            events += 1
+            if cumulative <= target:
+                # prop_sum drifted above the propensities, so reject the event
+                events = self.resum_interval
+                continue
 
-            # Execute next reaction
-            if next_reaction == 0:
-                self.infect_cell()
-            elif next_reaction == 1:
-                self.burst_cell()
-            elif next_reaction == 2:
-                self.replicate_cell()
-            elif next_reaction == 3:
-                self.kill_phage()
+            # Execute next reaction and update the propensities that depend
+            # on it
+            if fired is not None:
+                fired[next_reaction] += 1
+            for species, change in changes[next_reaction]:
+                counts[species] += change
+            for reaction in dependents[next_reaction]:
+                new = mass_action[reaction](rates[reaction], counts)
+                prop_sum += new - prop[reaction]
+                prop[reaction] = new
 
-    def replicate_cell(self):
+    def propensities(self):
         """
-        Increase newly-replicated cell count by 1.
+        Calculate the propensities of the reactions in this patch.
+
+        Return:
+            Array of the propensities of the reactions of network, in order.
         """
-        self.replicated_cells += 1
+        return np.array([propensity(rate, self.counts)
+                         for propensity, rate
+                         in zip(self.network.mass_action,
+                                self.network.rates(self))])
 
-    def infect_cell(self):
+    def fire(self, reaction):
         """
-        Infect a cell. Increase infected cells by 1, decrease cells and phages
-        by 1 each.
+        Execute a single reaction.
+
+        Args:
+            reaction: Index of the reaction in network.reactions.
         """
-        self.cells -= 1
-        self.phages -= 1
-        self.infected_cells += 1
+        for species, change in self.network.changes(self)[reaction]:
+            self.counts[species] += change
 
-    def burst_cell(self):
+    def leap_size(self, epsilon):
         """
-        Lyse an infected cell and add new phage particles.
+        Select a tau-leap size following Cao, Gillespie and Petzold.
+
+        doi: 10.1063/1.2159468
+
+        The leap is bounded so that the expected change, and its standard
+        deviation, of every reactant count stays within epsilon times that
+        count (divided by the order of its highest-order reaction), or within
+        one particle for small counts. Only the reactants of reactions that
+        can fire count: an empty species, such as infected cells before the
+        first infection, changes no propensity until it has been produced.
+
+        Args:
+            epsilon: Error tolerance.
+
+        Return:
+            Leap size, or None if a leap would cover fewer than
+            leap_threshold reactions on average, in which case exact steps
+            are cheaper and more accurate.
         """
-        self.phages += self.burst_size
-        self.infected_cells -= 1
+        prop = self.propensities()
+        a_total = prop.sum()
+        if a_total == 0:
+            return None
+        # Mean and variance of the change in each species per unit time
+        stoichiometry = self.network.stoichiometry(self)
+        mean = prop @ stoichiometry
+        variance = prop @ stoichiometry**2
+        # Highest order of the reactions that can fire consuming each species
+        orders = [0] * len(self.counts)
+        for a, order, reactants in zip(prop, self.network.orders,
+                                       self.network.reactants):
+            if a > 0:
+                for species, _ in reactants:
+                    orders[species] = max(orders[species], order)
+        tau = np.inf
+        for count, order, mu, sigma2 in zip(self.counts, orders, mean,
+                                            variance):
+            if order == 0:
+                # Not a reactant of any reaction that can fire yet
+                continue
+            bound = max(epsilon * count / order, 1)
+            if mu != 0:
+                tau = min(tau, bound / abs(mu))
+            if sigma2 != 0:
+                tau = min(tau, bound**2 / sigma2)
+        if tau * a_total < self.leap_threshold:
+            return None
+        return tau
 
-    def kill_phage(self):
+    def leap(self, tau):
         """
-        Kill a phage particle if it falls into a goo particle.
+        Advance the patch by tau with a Poisson-distributed number of firings
+        of every reaction. If any count would become negative the leap is
+        halved and redrawn.
+
+        Args:
+            tau: Leap size.
+
+        Return:
+            Array of the number of firings of every reaction.
         """
-        self.phages -= 1
+        prop = self.propensities()
+        stoichiometry = self.network.stoichiometry(self)
+        counts = np.array(self.counts)
+        while True:
+            firings = self.rng.poisson(prop * tau)
+            new_counts = counts + firings @ stoichiometry
+            if (new_counts >= 0).all():
+                break
+            tau /= 2
+        # Update in place, as execute_until holds on to the list
+        self.counts[:] = new_counts.tolist()
+        self.time += tau
+        return firings
 
     def __str__(self):
         """
@@ -146,11 +505,226 @@ class Patch:
         return "Phage: " + str(self.phages) + "\nCells: " + \
             str(self.cells) + "\nTime:" + str(self.time)
 
+
+def execute_patches(state, patch_time, rates, length, time, tau_epsilon=None,
+                    origin=(0, 0), rng=np.random, step=0, width=None,
+                    fired=None):
+    """
+    Execute reactions in a block of patches until a given time, and bring
+    every patch to that time.
+
+    Args:
+        state: Particle counts of the patches, of shape (species, rows,
+            cols), updated in place.
+        patch_time: Gillespie time of the patches, of shape (rows, cols),
+            updated in place.
+        rates: Arrays of shape (rows, cols) of the Patch rate constants, as
+            returned by Plate.rates().
+        length: Length and width of each patch.
+        time: Time at which reactions should stop executing.
+        tau_epsilon: Error tolerance of adaptive tau-leaping, or None.
+        origin: Plate row and column of the first patch of the block.
+        rng: Random number generator shared by the patches, or a
+            streams.Streams, from which every patch draws its own stream,
+            keyed by the diffusion event, `step`, and its position in the
+            plate.
+        step: Diffusion event, for keyed streams.
+        width: Columns of the whole plate, for keyed streams (defaults to
+            those of the block).
+        fired: List of the number of firings of every reaction, added to,
+            or None.
+    """
+    # Work on plain Python lists, which are much faster to index one
+    # element at a time than NumPy arrays
+    counts = state.tolist()
+    times = patch_time.tolist()
+    rates = [rate.tolist() for rate in rates]
+    rows, cols = patch_time.shape
+    keyed = isinstance(rng, streams.Streams)
+    if width is None:
+        width = cols
+    for i in range(rows):
+        for j in range(cols):
+            row, col = origin[0] + i, origin[1] + j
+            if keyed:
+                patch_rng = rng.generator(step, row * width + col,
+                                          'reactions')
+            else:
+                patch_rng = rng
+            patch = Patch(row, col, length, 0, 0, 0,
+                          *(rate[i][j] for rate in rates), rng=patch_rng)
+            patch.counts = [count[i][j] for count in counts]
+            patch.time = times[i][j]
+            patch.execute_until(time, tau_epsilon, fired)
+            for count, value in zip(counts, patch.counts):
+                count[i][j] = value
+    state[:] = counts
+    patch_time[:] = time
+
+
+def execute_lockstep(state, patch_time, rates, time, origin=(0, 0),
+                     rng=np.random, step=0, width=None, fired=None):
+    """
+    Execute exact gillespie steps in a block of patches in lock step until a
+    given time, and bring every patch to that time.
+
+    The counts and propensities of all patches are held as arrays, and each
+    round takes one step in every patch that has not yet passed `time`:
+    draw the time to its next reaction, and, if it comes before `time`,
+    select the reaction, apply its changes and update the propensities that
+    depend on it, as Patch.execute_until does. As there, the sums of the
+    propensities are recomputed every Patch.resum_interval events, and
+    events past the actual propensities are rejected. Patches drop out as
+    they pass `time`, so the number of rounds is set by the busiest patch,
+    not by the number of patches.
+
+    With a streams.Streams as rng, every patch draws the same numbers from
+    the same stream as in execute_patches, and the results are identical.
+    With any other generator the draws are shared differently between the
+    patches, but every patch follows the same distribution.
+
+    Args:
+        state, patch_time, rates, time, origin, rng, step, width, fired: As
+            for execute_patches.
+
+    Return:
+        Number of rounds taken.
+    """
+    network = Patch.network
+    rows, cols = patch_time.shape
+    if width is None:
+        width = cols
+    counts = state.reshape(len(network.species), -1).astype(np.int64)
+    clock = patch_time.ravel().astype(float)
+    # Rate constants as flat per-patch arrays, by Patch attribute name
+    params = types.SimpleNamespace(**{
+        name: np.broadcast_to(rate, (rows, cols)).ravel()
+        for name, rate in zip(('burst_size', 'k_replicate', 'k_infect',
+                               'k_lysis', 'k_goo'), rates)})
+    propensities = [_patch_mass_action(reactants)
+                    for reactants in network.reactants]
+    rates = network.rates(params)
+    changes = network.patch_changes(params)
+    reactions = len(network.reactions)
+    # depends[fired, other] is whether other is updated when fired fires
+    depends = np.zeros((reactions, reactions), dtype=bool)
+    for reaction, dependents in enumerate(network.dependents):
+        depends[reaction, list(dependents)] = True
+    keyed = isinstance(rng, streams.Streams)
+    if keyed:
+        # Plate number of every patch of the block, and draws taken so far
+        patches = ((origin[0] + np.arange(rows))[:, None] * width
+                   + origin[1] + np.arange(cols)).ravel()
+        draws = np.zeros(rows * cols, dtype=np.int64)
+
+    def random(index):
+        if not keyed:
+            return rng.random(index.size)
+        u = rng.random(step, patches[index], 'reactions', draw=draws[index])
+        draws[index] += 1
+        return u
+
+    prop = np.array([propensity(rate, counts)
+                     for propensity, rate in zip(propensities, rates)],
+                    dtype=float)
+    prop_sum = np.zeros(rows * cols)
+    # Events of every patch since its prop_sum was last recomputed
+    events = np.zeros(rows * cols, dtype=np.int64)
+
+    def resum(index):
+        # Summed in order, as sum() does in a single patch
+        total = prop[0, index]
+        for row in prop[1:, index]:
+            total += row
+        prop_sum[index] = total
+        events[index] = 0
+
+    resum(np.arange(rows * cols))
+    index = np.flatnonzero(clock < time)
+    rounds = 0
+    while index.size > 0:
+        resum(index[(events[index] >= Patch.resum_interval) |
+                    (prop_sum[index] < Patch.resum_below)])
+        index = index[prop_sum[index] > 0]
+        if index.size == 0:
+            break
+        rounds += 1
+        # Time until the next reaction. math.log, as in execute_until,
+        # rounds the same way in every patch.
+        u = random(index)
+        clock[index] += -(1/prop_sum[index]) * np.fromiter(
+            map(math.log, u.tolist()), float, u.size)
+        index = index[clock[index] <= time]
+        if index.size == 0:
+            break
+
+        # Select the next reaction with a cumulative sum search. Patches
+        # whose prop_sum drifted above their propensities, so that the
+        # search runs past all of them, fire nothing this round and have
+        # their prop_sum recomputed from the propensities.
+        target = random(index) * prop_sum[index]
+        cumulative = np.cumsum(prop[:, index], axis=0)
+        selected = (cumulative <= target).sum(axis=0)
+        events[index] += 1
+        rejected = selected == reactions
+        events[index[rejected]] = Patch.resum_interval
+        accepted = index[~rejected]
+        selected = selected[~rejected]
+        if fired is not None:
+            for reaction, number in enumerate(
+                    np.bincount(selected, minlength=reactions).tolist()):
+                fired[reaction] += number
+
+        # Execute it and update the propensities that depend on it
+        for reaction in range(reactions):
+            firing = accepted[selected == reaction]
+            for species, change in changes[reaction]:
+                if isinstance(change, np.ndarray):
+                    change = change[firing]
+                counts[species, firing] += change
+        for reaction, propensity in enumerate(propensities):
+            updated = accepted[depends[selected, reaction]]
+            new = propensity(rates[reaction][updated], counts[:, updated])
+            prop_sum[updated] += new - prop[reaction, updated]
+            prop[reaction, updated] = new
+        index = index[clock[index] < time]
+    state[:] = counts.reshape(state.shape)
+    patch_time[:] = time
+    return rounds
+
+
+def _count_property(index):
+    """
+    Property for the count of a species, stored in Patch.counts.
+    """
+    return property(lambda patch: patch.counts[index],
+                    lambda patch, count: patch.counts.__setitem__(index, count))
+
+
+for _index, _name in enumerate(Patch.network.species):
+    setattr(Patch, _name, _count_property(_index))
+del _index, _name
+
+
+def _integers(rng):
+    """
+    Method drawing random integers in [low, high) from the np.random module,
+    an np.random.RandomState or an np.random.Generator.
+    """
+    return getattr(rng, 'integers', None) or rng.randint
+
+
 class Plate:
     """
     A plate that contains patches in a grid. The plate controls the diffusion
     of particles between patches.
 
+    The state of the patches is stored as a struct of arrays: one contiguous
+    int32 array of shape (5, rows, cols) holds the particle counts of every
+    patch, with the named attributes below as views into it, and a float64
+    array holds the gillespie time of every patch. Patch objects are only
+    built, by patch(), while a patch executes its reactions.
+
     Attributes:
         rows: Rows in the grid.
         cols: Columns in the grid.
@@ -158,12 +732,48 @@ class Plate:
         phage_diffusion: Diffusion constant for phage particles.
         cell_diffusion: Diffusion constant for newly-replicated cells.
         max_cell_density: Maximum number of cells per patch.
+        tau_epsilon: Error tolerance of adaptive tau-leaping in the patches
+            (see Patch.execute_until), or None for exact gillespie steps only.
+        lockstep: Whether exact steps are taken in all patches at once by
+            execute_lockstep(), rather than patch by patch.
+        state: Particle counts of all patches, of shape (5, rows, cols).
+        cells: Uninfected cells in each patch (view into state).
+        phages: Phages in each patch (view into state).
+        infected_cells: Infected cells in each patch (view into state).
+        replicated_cells: Newly-replicated cells in each patch (view into
+            state).
+        goo: Goo particles in each patch (view into state).
+        patch_time: Gillespie simulation time of each patch.
+        burst_size, k_replicate, k_infect, k_lysis, k_goo: Rate constants, as
+            read-only (rows, cols) arrays. A constant given as a single number
+            is stored once and broadcast to every patch.
+        rng: Random number generator of the plate: an np.random.Generator
+            or RandomState, a streams.Streams, or the np.random module. With
+            streams, every draw is keyed by the diffusion event, the patch
+            (numbered row by row) and its purpose, so results do not depend
+            on the order in which patches are executed.
+        profiler: profiling.Profiler recording the time spent by iterate()
+            in reactions and in diffusion, the reactions fired by type and
+            the particles moved, or None.
     """
+    # Order of the species in state
+    species = Patch.network.species
+
     def __init__(self, rows, cols, length, phage_diffusion, cell_diffusion,
                  goo, max_cell_density, burst_size, k_infect, k_lysis, k_goo,
-                 k_replicate):
+                 k_replicate, tau_epsilon=None, rng=None, lockstep=None,
+                 profiler=None):
         """
-        Inits Plate class by constructing a grid of patches.
+        Inits Plate class by constructing a grid of patches. goo, burst_size
+        and the rate constants may be single numbers or (rows, cols) arrays
+        of per-patch values. If rng is None, a new np.random.Generator is
+        used. Pass the np.random module to draw from NumPy's global random
+        state instead.
+
+        lockstep may be True or False to choose whether patches are executed
+        by execute_lockstep(), which does not tau-leap. By default they are
+        whenever that gives the same results: with exact steps only and a
+        streams.Streams as rng.
         """
         self.rows = rows
         self.cols = cols
@@ -174,21 +784,72 @@ class Plate:
         self.cell_iter = 1 # Cell diffusion events
         self.time = 0
         self.max_cell_density = max_cell_density
-        # Grid of patches
-        self.matrix = np.empty([rows, cols], dtype = object)
-        for i in range(rows):
-            for j in range(cols):
-                # Randomly distribute phage and cell particles
-                cells = np.random.randint(0,2)
-                phages = np.random.randint(0,10)
-                self.matrix[i][j] = Patch(i, j, length, cells, phages, goo,
-                                          burst_size, k_replicate, k_infect,
-                                          k_lysis, k_goo)
+        self.tau_epsilon = tau_epsilon
+        self.rng = np.random.default_rng() if rng is None else rng
+        if lockstep is None:
+            lockstep = tau_epsilon is None and \
+                isinstance(self.rng, streams.Streams)
+        elif lockstep and tau_epsilon is not None:
+            raise ValueError("Lock-step execution does not tau-leap")
+        self.lockstep = lockstep
+        self.profiler = profiler
+        # Particle counts of all patches
+        self.state = np.zeros((len(self.species), rows, cols), dtype=np.int32)
+        for index, name in enumerate(self.species):
+            setattr(self, name, self.state[index])
+        self.patch_time = np.zeros((rows, cols))
+        # Rate constants, stored once unless given per patch
+        self.burst_size = self._per_patch(burst_size)
+        self.k_replicate = self._per_patch(k_replicate)
+        self.k_infect = self._per_patch(k_infect)
+        self.k_lysis = self._per_patch(k_lysis)
+        self.k_goo = self._per_patch(k_goo)
+        # Randomly distribute phage and cell particles
+        if isinstance(self.rng, streams.Streams):
+            integers = self.rng.generator(0, 0, 'initial plate').integers
+        else:
+            integers = _integers(self.rng)
+        self.cells[:] = integers(0, 2, size=(rows, cols))
+        self.phages[:] = integers(0, 10, size=(rows, cols))
+        self.goo[:] = goo
+
+    def _per_patch(self, value):
+        """
+        View a single value or a (rows, cols) array as a read-only (rows,
+        cols) array without copying.
+        """
+        return np.broadcast_to(np.asarray(value), (self.rows, self.cols))
+
+    def patch(self, i, j):
+        """
+        Build a Patch holding the current state of patch (i, j).
+
+        Changes to the Patch are written back with store().
+        """
+        patch = Patch(i, j, self.length, 0, 0, 0,
+                      int(self.burst_size[i, j]),
+                      float(self.k_replicate[i, j]),
+                      float(self.k_infect[i, j]), float(self.k_lysis[i, j]),
+                      float(self.k_goo[i, j]))
+        patch.counts = self.state[:, i, j].tolist()
+        patch.time = float(self.patch_time[i, j])
+        return patch
+
+    def store(self, patch):
+        """
+        Write the state of a Patch built by patch() back into the plate.
+        """
+        i, j = patch.row, patch.col
+        self.state[:, i, j] = patch.counts
+        self.patch_time[i, j] = patch.time
 
     def iterate(self):
         """
         Execute a diffusion event.
         """
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start()
         # Determine which should diffuse first: phages or cells
         t_phage = (1/4)*((self.length**2)/self.phage_diffusion)*self.phage_iter
         t_cell = (1/4)*((self.length**2)/self.cell_diffusion)*self.cell_iter
@@ -198,109 +859,181 @@ class Plate:
             self.time = t_phage
             # Iterate over all patches and execute reactions until the time to
             # the next diffusion event.
-            for i in range(self.rows):
-                for j in range(self.cols):
-                    self.matrix[i][j].execute_until(self.time)
-                    self.matrix[i][j].time = self.time
+            self.execute_until(self.time)
+            if profiler is not None:
+                profiler.lap('reactions')
             # Diffuse phages
             self.diffuse_phages()
             self.phage_iter += 1
+            if profiler is not None:
+                profiler.lap('phage diffusion')
         else:
             # Cells diffuse first
             self.time = t_cell
-            for i in range(self.rows):
-                for j in range(self.cols):
-                    self.matrix[i][j].execute_until(self.time)
-                    self.matrix[i][j].time = self.time
+            self.execute_until(self.time)
+            if profiler is not None:
+                profiler.lap('reactions')
             self.diffuse_cells()
             self.cell_iter += 1
+            if profiler is not None:
+                profiler.lap('cell diffusion')
+        if profiler is not None:
+            profiler.step(self.time)
 
-    def diffuse_phages(self):
+    def execute_until(self, time):
+        """
+        Execute reactions in every patch until a given time, and bring every
+        patch to that time.
+
+        Args:
+            time: Time at which reactions should stop executing.
+        """
+        fired = None if self.profiler is None else \
+            [0] * len(Patch.network.reactions)
+        if self.lockstep:
+            rounds = execute_lockstep(self.state, self.patch_time,
+                                      self.rates(), time, rng=self.rng,
+                                      step=self._step(), fired=fired)
+            if fired is not None:
+                self.profiler.count('lock-step rounds', rounds)
+        else:
+            execute_patches(self.state, self.patch_time, self.rates(),
+                            self.length, time, self.tau_epsilon, rng=self.rng,
+                            step=self._step(), fired=fired)
+        if fired is not None:
+            self._count_fired(fired)
+
+    def _count_fired(self, fired):
         """
-        For each phage particle, move the particle up, down, left, right, or
-        keep it in the same position, according to a uniform distribution.
+        Pass the number of firings of every reaction to the profiler.
         """
-        for i in range(self.rows):
-            for j in range(self.cols):
-                for p in range(self.matrix[i][j].phages):
-                    direction = np.random.randint(5)
-                    if direction == 0:
-                        self.move_phage(i, j, i + 1, j)
-                    elif direction == 1:
-                        self.move_phage(i, j, i - 1, j)
-                    elif direction == 2:
-                        self.move_phage(i, j, i, j + 1)
-                    elif direction == 3:
-                        self.move_phage(i, j, i, j - 1)
+        for reaction, number in zip(Patch.network.reactions, fired):
+            self.profiler.count(reaction.name, number)
 
+    def _step(self):
+        """
+        Number of diffusion events executed so far, which keys the draws of
+        the next one.
+        """
+        return self.phage_iter + self.cell_iter - 2
 
-    def move_phage(self, i, j, i2, j2):
+    def rates(self):
+        """
+        Get the rate constants in the order of the Patch arguments: burst
+        size, k_replicate, k_infect, k_lysis and k_goo.
         """
-        Move a phage particle, while checking for boundaries of plate.
+        return (self.burst_size, self.k_replicate, self.k_infect, self.k_lysis,
+                self.k_goo)
 
-        Args:
-            i: initial row
-            j: initial col
-            i2: new row
-            j2: new col
-        """
-        if i2 < self.rows and j2 < self.cols and i2 >= 0 and j2 >= 0:
-            # Only move phage particle if it is within bounds of plate.
-            self.matrix[i2][j2].phages += 1
-            self.matrix[i][j].phages -= 1
-
-    def move_cell(self, i, j, i2, j2):
-        """
-        Move a cell, while checking that the patch is not at the maximum cell
-        density and that the new patch is within plate boundaries. Newly-
-        replicated cells are only moved once and then converted to normal cells.
-        """
-        if i2 < self.rows and j2 < self.cols and i2 >= 0 and j2 >= 0:
-            if self.matrix[i2][j2].cells < self.max_cell_density:
-                self.matrix[i2][j2].cells += 1
-            # If a patch is at max cell density, and the replicated cell is at
-            # the edge of the plate, or can't move anywhere, it is effectively
-            # destroyed.
-            self.matrix[i][j].replicated_cells -= 1
+    def diffuse_phages(self):
+        """
+        Move each phage particle up, down, left, right, or keep it in the same
+        position, according to a uniform distribution.
+
+        The five-way split of every patch's phage is drawn for the whole grid
+        at once, as a chain of binomials, from the counts at the start of the
+        diffusion event, so each phage moves at most once. Moves that would
+        leave the plate are rejected and the phage stays where it is.
+        """
+        down, up, right, left, _ = self._split(self.phages)
+        # Reflecting boundaries
+        down[-1, :] = 0
+        up[0, :] = 0
+        right[:, -1] = 0
+        left[:, 0] = 0
+        self.phages -= down + up + right + left
+        self.phages[1:, :] += down[:-1, :]
+        self.phages[:-1, :] += up[1:, :]
+        self.phages[:, 1:] += right[:, :-1]
+        self.phages[:, :-1] += left[:, 1:]
+        if self.profiler is not None:
+            self.profiler.count('phage moved',
+                                int(np.sum(down + up + right + left)))
 
     def diffuse_cells(self):
         """
-        Diffuse each newly-replicated cell up, down, left, or right, according
-        to a uniform distribution.
+        Diffuse each newly-replicated cell up, down, left, or right, or keep
+        it in its own patch, according to a uniform distribution.
+
+        Newly-replicated cells are only moved once and then converted to
+        normal cells. A patch only takes in cells up to max_cell_density, and
+        the cells that do not fit are destroyed. A cell that would move off
+        the plate stays where it is as a newly-replicated cell. As for
+        phages, the split is drawn for the whole grid at once.
         """
-        for i in range(self.rows):
-            for j in range(self.cols):
-                for p in range(self.matrix[i][j].replicated_cells):
-                    direction = np.random.randint(5)
-                    if direction == 0:
-                        self.move_cell(i, j, i + 1, j)
-                    elif direction == 1:
-                        self.move_cell(i, j, i - 1, j)
-                    elif direction == 2:
-                        self.move_cell(i, j, i, j + 1)
-                    elif direction == 3:
-                        self.move_cell(i, j, i, j - 1)
-                    elif direction == 4:
-                        self.move_cell(i, j, i, j)
+        down, up, right, left, stay = self._split(self.replicated_cells)
+        # Reflecting boundaries
+        down[-1, :] = 0
+        up[0, :] = 0
+        right[:, -1] = 0
+        left[:, 0] = 0
+        # The remaining cells are converted in their own patch
+        arrivals = stay.copy()
+        arrivals[1:, :] += down[:-1, :]
+        arrivals[:-1, :] += up[1:, :]
+        arrivals[:, 1:] += right[:, :-1]
+        arrivals[:, :-1] += left[:, 1:]
+        self.replicated_cells -= down + up + right + left + stay
+        room = np.clip(self.max_cell_density - self.cells, 0, None)
+        settled = np.minimum(arrivals, room)
+        self.cells += settled
+        if self.profiler is not None:
+            self.profiler.count('cells moved',
+                                int(np.sum(down + up + right + left)))
+            self.profiler.count('cells crowded out',
+                                int(np.sum(arrivals - settled)))
+
+    def _split(self, counts):
+        """
+        Split the particles of every patch uniformly between the five
+        directions down, up, right, left and stay.
+
+        Return:
+            Counts moving down, up, right and left, and counts staying put.
+        """
+        if isinstance(self.rng, streams.Streams):
+            step = self._step()
+            patches = np.arange(counts.size).reshape(counts.shape)
+
+            def binomial(n, p, purpose):
+                return self.rng.binomial(step, patches, purpose, n,
+                                         p).astype(counts.dtype)
+        else:
+            def binomial(n, p, purpose):
+                return self.rng.binomial(n, p)
+        down = binomial(counts, 1/5, 'down')
+        left_over = counts - down
+        up = binomial(left_over, 1/4, 'up')
+        left_over -= up
+        right = binomial(left_over, 1/3, 'right')
+        left_over -= right
+        left = binomial(left_over, 1/2, 'left')
+        return down, up, right, left, left_over - left
+
+    def grids(self):
+        """
+        Get the count grids of every species, by name, as views into state.
+        """
+        return dict(zip(self.species, self.state))
 
     def make_matrix(self, type = 'phages'):
         """
-        Generate a matrix of counts for a given type. Used for matplotlib
+        Get the matrix of counts for a given type. Used for matplotlib
         visualization.
 
         Args:
-            type: Type of data that matrix should contain (phages or cells)
+            type: Type of data that matrix should contain (phages, cells,
+                infected_cells, replicated_cells or goo)
 
         Return:
-            2D numpy array of counts corresponding to the input type
+            Read-only 2D numpy view of the counts corresponding to the input
+            type. The view is not a copy, so it changes as the simulation
+            proceeds.
         """
-        out = np.zeros((self.rows, self.cols))
-        for i in range(self.rows):
-            for j in range(self.cols):
-                if type == 'phages':
-                    out[i][j] = self.matrix[i][j].phages
-                elif type == 'cells':
-                    out[i][j] = self.matrix[i][j].cells
+        if type not in self.species:
+            raise ValueError("Unknown particle type: " + str(type))
+        out = getattr(self, type).view()
+        out.flags.writeable = False
         return out
 
     def __str__(self):
@@ -312,18 +1045,509 @@ class Plate:
         cells = ""
         for i in range(self.rows):
             for j in range(self.cols):
-                cells += str(self.matrix[i][j].cells) + "\t"
-                phages += str(self.matrix[i][j].phages) + "\t"
+                cells += str(self.cells[i, j]) + "\t"
+                phages += str(self.phages[i, j]) + "\t"
             cells += "\n"
             phages += "\n"
         out = "Phages: \n" + phages
         out += "\nCells: \n" + cells + "\n"
         return out
 
+class TiledPlate(Plate):
+    """
+    A Plate whose patches execute their reactions in parallel.
+
+    Patches do not interact between diffusion events, so the plate is cut
+    into tiles that a pool of worker processes advance independently. The
+    particle counts and patch times live in shared memory, so workers update
+    them in place and diffusion runs on the merged state in the main
+    process.
+
+    Every draw comes from the keyed streams.Streams of the plate seed, so
+    results depend neither on the number of workers nor on the tiling, and
+    are the same as those of a Plate with streams.Streams(seed) as rng.
+
+    A TiledPlate holds a process pool and shared memory until close() is
+    called, and can be used as a context manager. After closing, the plate
+    can still be read and iterated, serially.
+
+    Attributes:
+        tiles: List of ((first row, end row), (first col, end col)) bounds of
+            every tile.
+        seed: Entropy of the np.random.SeedSequence of the plate streams.
+        pool: concurrent.futures.ProcessPoolExecutor running the tiles, or
+            None once closed.
+    """
+    def __init__(self, *args, tiles=(4, 4), workers=None, seed=None,
+                 rng=None, **kwargs):
+        """
+        Inits TiledPlate with the same arguments as Plate, and
+
+        Args:
+            tiles: Number of tiles along rows and along columns.
+            workers: Number of worker processes (defaults to the number of
+                CPUs).
+            seed: Seed of the plate streams. If None, fresh entropy is
+                drawn, and kept as the seed attribute.
+            rng: streams.Streams of the plate, instead of seed. Other
+                generators are not accepted, since their draws would depend
+                on the tiling.
+        """
+        if rng is not None:
+            if not isinstance(rng, streams.Streams):
+                raise ValueError("TiledPlate needs keyed random streams as "
+                                 "rng")
+            if seed is not None:
+                raise ValueError("Give TiledPlate a seed or rng, not both")
+        else:
+            rng = streams.Streams(seed)
+        super().__init__(*args, rng=rng, **kwargs)
+        self.seed = self.rng.sequence.entropy
+        row_bounds = np.linspace(0, self.rows, min(tiles[0], self.rows) + 1)
+        col_bounds = np.linspace(0, self.cols, min(tiles[1], self.cols) + 1)
+        row_bounds = row_bounds.astype(int).tolist()
+        col_bounds = col_bounds.astype(int).tolist()
+        self.tiles = [((r0, r1), (c0, c1))
+                      for r0, r1 in zip(row_bounds, row_bounds[1:])
+                      for c0, c1 in zip(col_bounds, col_bounds[1:])]
+        # Move the state into shared memory
+        self._memory = []
+        self.state = self._share(self.state)
+        self.patch_time = self._share(self.patch_time)
+        for index, name in enumerate(self.species):
+            setattr(self, name, self.state[index])
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_attach_plate,
+            initargs=([memory.name for memory in self._memory],
+                      self.state.shape, [np.asarray(rate)
+                                         for rate in self.rates()],
+                      self.length, self.tau_epsilon, self.rng, self.lockstep))
+
+    def _share(self, array):
+        """
+        Copy an array into a new block of shared memory.
+        """
+        memory = shared_memory.SharedMemory(create=True,
+                                            size=max(array.nbytes, 1))
+        self._memory.append(memory)
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+        shared[:] = array
+        return shared
+
+    def execute_until(self, time):
+        """
+        Execute reactions in every tile in parallel until a given time, and
+        bring every patch to that time.
+
+        Args:
+            time: Time at which reactions should stop executing.
+        """
+        if self.pool is None:
+            return super().execute_until(time)
+        counting = self.profiler is not None
+        futures = [self.pool.submit(_execute_tile, tile, time, self._step(),
+                                    counting)
+                   for tile in self.tiles]
+        fired = [0] * len(Patch.network.reactions)
+        for future in futures:
+            for reaction, number in enumerate(future.result()):
+                fired[reaction] += number
+        if counting:
+            self._count_fired(fired)
+
+    def close(self):
+        """
+        Shut down the worker processes and move the state out of shared
+        memory.
+        """
+        if self.pool is None:
+            return
+        self.pool.shutdown()
+        self.pool = None
+        self.state = self.state.copy()
+        self.patch_time = self.patch_time.copy()
+        for index, name in enumerate(self.species):
+            setattr(self, name, self.state[index])
+        for memory in self._memory:
+            memory.close()
+            memory.unlink()
+        self._memory = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# State of the TiledPlate shared with this worker process
+_tiled_plate = {}
+
+
+def _attach_plate(names, shape, rates, length, tau_epsilon, rng, lockstep):
+    """
+    Attach a worker process to the shared memory of a TiledPlate.
+    """
+    memory = [shared_memory.SharedMemory(name=name) for name in names]
+    _tiled_plate.update(
+        memory=memory,
+        state=np.ndarray(shape, dtype=np.int32, buffer=memory[0].buf),
+        patch_time=np.ndarray(shape[1:], buffer=memory[1].buf),
+        rates=[np.broadcast_to(rate, shape[1:]) for rate in rates],
+        length=length, tau_epsilon=tau_epsilon, rng=rng, lockstep=lockstep)
+
+
+def _execute_tile(tile, time, step, counting=False):
+    """
+    Execute reactions in a tile of the attached TiledPlate until a given
+    time, the diffusion event `step`.
+
+    Return:
+        With counting, the number of firings of every reaction, or else an
+        empty list.
+    """
+    (r0, r1), (c0, c1) = tile
+    patch_time = _tiled_plate['patch_time']
+    rates = [rate[r0:r1, c0:c1] for rate in _tiled_plate['rates']]
+    fired = [0] * len(Patch.network.reactions) if counting else None
+    if _tiled_plate['lockstep']:
+        execute_lockstep(_tiled_plate['state'][:, r0:r1, c0:c1],
+                         patch_time[r0:r1, c0:c1], rates, time,
+                         origin=(r0, c0), rng=_tiled_plate['rng'], step=step,
+                         width=patch_time.shape[1], fired=fired)
+    else:
+        execute_patches(_tiled_plate['state'][:, r0:r1, c0:c1],
+                        patch_time[r0:r1, c0:c1], rates,
+                        _tiled_plate['length'], time,
+                        _tiled_plate['tau_epsilon'], origin=(r0, c0),
+                        rng=_tiled_plate['rng'], step=step,
+                        width=patch_time.shape[1], fired=fired)
+    return fired or []
+
+
+class IndexedPriorityQueue:
+    """
+    Binary min-heap of the items 0, 1, ..., n - 1 keyed by time.
+
+    An index from each item to its position in the heap lets the key of any
+    item be changed in O(log n).
+
+    Attributes:
+        keys: Current key of each item.
+        heap: Items in heap order.
+        position: Position of each item in heap.
+    """
+    def __init__(self, keys):
+        """
+        Inits IndexedPriorityQueue with the initial key of every item.
+        """
+        self.keys = list(keys)
+        # A sorted list satisfies the heap property
+        self.heap = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        self.position = [0] * len(self.keys)
+        for position, item in enumerate(self.heap):
+            self.position[item] = position
+
+    def top(self):
+        """
+        Return the smallest key and its item.
+        """
+        item = self.heap[0]
+        return self.keys[item], item
+
+    def update(self, item, key):
+        """
+        Change the key of an item and restore the heap property.
+        """
+        old = self.keys[item]
+        self.keys[item] = key
+        if key < old:
+            self._sift_up(self.position[item])
+        else:
+            self._sift_down(self.position[item])
+
+    def _swap(self, a, b):
+        heap = self.heap
+        heap[a], heap[b] = heap[b], heap[a]
+        self.position[heap[a]] = a
+        self.position[heap[b]] = b
+
+    def _sift_up(self, position):
+        keys, heap = self.keys, self.heap
+        while position > 0:
+            parent = (position - 1) // 2
+            if keys[heap[parent]] <= keys[heap[position]]:
+                break
+            self._swap(parent, position)
+            position = parent
+
+    def _sift_down(self, position):
+        keys, heap = self.keys, self.heap
+        n = len(heap)
+        while True:
+            smallest = position
+            for child in (2*position + 1, 2*position + 2):
+                if child < n and keys[heap[child]] < keys[heap[smallest]]:
+                    smallest = child
+            if smallest == position:
+                break
+            self._swap(smallest, position)
+            position = smallest
+
+
+class NextSubvolumePlate(Plate):
+    """
+    A plate simulated with the next-subvolume method (NSM) instead of
+    alternating reactions with diffusion events at fixed intervals.
+
+    doi: 10.1101/gr.1196503
+
+    Diffusion is treated as two more reactions in every patch, next to the
+    Patch reactions (infection, lysis, replication and phage loss to goo). A
+    phage hops to one of the four neighbouring patches at rate
+    (16/5) * phage_diffusion / length**2, and a newly-replicated cell settles
+    at rate 4 * cell_diffusion / length**2 in its own patch or one of the
+    four neighbours, chosen uniformly. These rates give the same per-particle
+    transition probabilities, per interval of length**2 / (4 * diffusion),
+    as the diffusion events of Plate. As in Plate, moves that would leave
+    the plate are rejected, and a settling cell is destroyed if its new
+    patch is at max_cell_density.
+
+    Every patch keeps the time of its next event in an indexed priority
+    queue. Each call to iterate() executes the earliest event of the whole
+    plate and only reschedules the patches it changed, so an event costs
+    O(log N) for a plate of N patches, however few patches are active.
+
+    With a streams.Streams as rng, draws are keyed by the number of events
+    executed before them and by the patch.
+
+    Attributes:
+        queue: IndexedPriorityQueue of the next event time of every patch,
+            indexed by i * cols + j.
+        events: Number of events executed.
+    """
+    def __init__(self, *args, **kwargs):
+        """
+        Inits NextSubvolumePlate with the same arguments as Plate.
+        """
+        super().__init__(*args, **kwargs)
+        self.phage_hop_rate = (16/5) * self.phage_diffusion / self.length**2
+        self.cell_settle_rate = 4 * self.cell_diffusion / self.length**2
+        self.events = 0
+        self.queue = IndexedPriorityQueue(
+            self._next_event_time(self.patch(i, j), self.time)
+            for i in range(self.rows) for j in range(self.cols))
+
+    def _random(self, patch, purpose):
+        """
+        Draw a uniform number in [0, 1) for a patch.
+        """
+        if isinstance(self.rng, streams.Streams):
+            return float(self.rng.random(self.events,
+                                         patch.row * self.cols + patch.col,
+                                         purpose))
+        return self.rng.random()
+
+    def _rates(self, patch):
+        """
+        Rates of the Patch reactions followed by phage hopping and cell
+        settling in a patch.
+        """
+        return list(patch.propensities()) + \
+            [self.phage_hop_rate * patch.phages,
+             self.cell_settle_rate * patch.replicated_cells]
+
+    def _next_event_time(self, patch, time):
+        """
+        Draw the time of the next event in a patch, from `time` onwards.
+        """
+        total = sum(self._rates(patch))
+        if total == 0:
+            return np.inf
+        return time - np.log(self._random(patch, 'next event')) / total
+
+    def _reschedule(self, i, j):
+        self.queue.update(i * self.cols + j,
+                          self._next_event_time(self.patch(i, j), self.time))
+
+    def iterate(self, until=None):
+        """
+        Execute the next event on the plate. If no event can happen any more,
+        the plate time becomes infinite.
+
+        Args:
+            until: Time not to go past, or None. If the next event comes
+                after it, no event is executed and the plate time becomes
+                `until`. The event times in the queue stay valid, as the
+                times between events are exponentially distributed.
+        """
+        time, index = self.queue.top()
+        if until is not None and time > until:
+            self.time = until
+            return
+        self.time = time
+        if time == np.inf:
+            return
+        i, j = divmod(index, self.cols)
+        patch = self.patch(i, j)
+        patch.time = time
+        # Select the event with a cumulative sum search
+        rates = self._rates(patch)
+        target = self._random(patch, 'select') * sum(rates)
+        event = 0
+        cumulative = rates[0]
+        while cumulative <= target and event < len(rates) - 1:
+            event += 1
+            cumulative += rates[event]
+
+        changed = []
+        # Phage hopping and cell settling follow the patch reactions
+        hop = len(patch.network.reactions)
+        if event < hop:
+            patch.fire(event)
+            self.store(patch)
+        else:
+            moves = 4 if event == hop else 5
+            if isinstance(self.rng, streams.Streams):
+                direction = int(self._random(patch, 'direction') * moves)
+            else:
+                direction = _integers(self.rng)(moves)
+            i2, j2 = [(i + 1, j), (i - 1, j), (i, j + 1), (i, j - 1),
+                      (i, j)][direction]
+            self.patch_time[i, j] = time
+            if 0 <= i2 < self.rows and 0 <= j2 < self.cols:
+                if event == hop:
+                    self.phages[i, j] -= 1
+                    self.phages[i2, j2] += 1
+                else:
+                    self.replicated_cells[i, j] -= 1
+                    if self.cells[i2, j2] < self.max_cell_density:
+                        self.cells[i2, j2] += 1
+                if (i2, j2) != (i, j):
+                    changed.append((i2, j2))
+        self.events += 1
+
+        # Only the patches whose state changed need a new event time
+        self._reschedule(i, j)
+        for i2, j2 in changed:
+            self._reschedule(i2, j2)
+
+
+# Version of the model's results, part of the key of cached runs. Bump it
+# whenever a change alters the outcome of a run for a given seed.
+MODEL_VERSION = 4
+
+# Engines of run_plate(): exact steps in lock step or patch by patch,
+# tau-leaping patch by patch, tiles of patches in parallel (TiledPlate) and
+# the next-subvolume method (NextSubvolumePlate)
+ENGINES = ('lockstep', 'patch', 'tau', 'tiled', 'nsm')
+
+# tau_epsilon of the 'tau' engine when none is given
+TAU_EPSILON = 0.03
+
+
+def run_plate(rows, cols, length, phage_diffusion, cell_diffusion, goo,
+              max_cell_density, burst_size, k_infect, k_lysis, k_goo,
+              k_replicate, until, tau_epsilon=None, seed=None, cache=None,
+              recorder=None, profiler=None, engine=None):
+    """
+    Run a Plate drawing from streams.Streams(seed) until its time reaches
+    `until`.
+
+    Args:
+        rows, cols, length, phage_diffusion, cell_diffusion, goo,
+            max_cell_density, burst_size, k_infect, k_lysis, k_goo,
+            k_replicate, tau_epsilon: As for Plate.
+        until: Time at which to stop.
+        seed: Seed of the plate streams. If None, fresh entropy is drawn,
+            and returned in the result.
+        cache: cache.ResultCache in which the run is looked up by its
+            arguments and MODEL_VERSION, and stored if it is not there yet,
+            or None.
+        recorder: recorder.TrajectoryRecorder for the fields Plate.species,
+            to record the plate before every diffusion event and at the
+            end, or None. Runs with a recorder are never cached.
+        profiler: profiling.Profiler for Plate.profiler, or None. Its report
+            is returned as 'profile'. Profiled runs are never cached.
+        engine: One of ENGINES. 'lockstep', 'patch' and 'tiled' (with as
+            many workers as CPUs) take exact steps and give the same
+            results. 'tau' tau-leaps patch by patch, with tau_epsilon or
+            TAU_EPSILON, and 'tiled' also tau-leaps if tau_epsilon is given.
+            'nsm' runs a NextSubvolumePlate. Defaults to 'tau' if tau_epsilon
+            is given and 'lockstep' otherwise.
+
+    Return:
+        Dict of the final particle counts ('state', as Plate.state), patch
+        times ('patch_time'), plate time ('time'), numbers of phage and
+        cell diffusion events ('phage_iter' and 'cell_iter') and the seed
+        ('seed'), as the 'entropy' and 'spawn_key' of its
+        np.random.SeedSequence, whether the run was computed or cached.
+    """
+    if engine is None:
+        engine = 'lockstep' if tau_epsilon is None else 'tau'
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine {!r}, expected one of {}".format(
+            engine, ENGINES))
+    if engine == 'tau' and tau_epsilon is None:
+        tau_epsilon = TAU_EPSILON
+    elif engine in ('lockstep', 'patch', 'nsm') and tau_epsilon is not None:
+        raise ValueError("The {!r} engine does not tau-leap".format(engine))
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    if cache is not None and recorder is None and profiler is None:
+        args = dict(locals(), cache=None)
+        parts = {key: value for key, value in args.items() if key != 'cache'}
+        # Engines that give the same results share their entries
+        if engine in ('patch', 'tiled'):
+            parts['engine'] = 'lockstep' if tau_epsilon is None else 'tau'
+        return cache.get_or_compute(lambda: run_plate(**args),
+                                    model='gillespie_multi_particle',
+                                    version=MODEL_VERSION, **parts)
+
+    args = (rows, cols, length, phage_diffusion, cell_diffusion, goo,
+            max_cell_density, burst_size, k_infect, k_lysis, k_goo,
+            k_replicate)
+    if engine == 'tiled':
+        plate = TiledPlate(*args, tau_epsilon=tau_epsilon, seed=seed,
+                           profiler=profiler)
+    elif engine == 'nsm':
+        plate = NextSubvolumePlate(*args, rng=streams.Streams(seed),
+                                   profiler=profiler)
+    else:
+        plate = Plate(*args, tau_epsilon=tau_epsilon,
+                      rng=streams.Streams(seed), lockstep=engine == 'lockstep',
+                      profiler=profiler)
+    try:
+        while plate.time < until:
+            if recorder is not None and recorder.due(plate.time):
+                recorder.record(plate.time, plate.grids())
+            if engine == 'nsm':
+                # Stop at until rather than after the first event past it
+                plate.iterate(until)
+            else:
+                plate.iterate()
+        if recorder is not None and recorder.due(plate.time):
+            recorder.record(plate.time, plate.grids())
+    finally:
+        if engine == 'tiled':
+            plate.close()
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    result = {'state': plate.state, 'patch_time': plate.patch_time,
+              'time': plate.time, 'phage_iter': plate.phage_iter,
+              'cell_iter': plate.cell_iter,
+              'seed': {'entropy': seed.entropy,
+                       'spawn_key': list(seed.spawn_key)}}
+    if profiler is not None:
+        result['profile'] = profiler.report()
+    return result
+
+
 def main():
     """
     Define a plate and iterate through simulation until a certain time point.
     """
+    # To run other plates, or many of them, use a job file for jobs.py
     my_plate = Plate(10, # rows
                      10, # cols
                      1, # patch length/width
@@ -338,38 +1562,24 @@ def main():
                      0.03 # replication rate constant
                      )
 
-    out_list = [my_plate.make_matrix(type = 'phages')]
-
     print(my_plate)
 
-
+    # Record the plate every unit of plate time, in constant memory
     counter = 0
-    while (my_plate.time < 500):
-        my_plate.iterate()
-        counter += 1
-        # out_list.append(my_plate.make_matrix(type = 'phages'))
-
-
-    # The following code produces a series of PNGs that can be stitched together
-    # to make a move/animated GIF.
-
-    # fig = plt.figure()
-    # pcm = plt.pcolormesh(out_list[0])
-    # plt.axis('off')
-    # plt.axes().set_aspect('equal')
-    # plt.axes().get_xaxis().set_visible(False)
-    # plt.axes().get_yaxis().set_visible(False)
-    # plt.draw()
-    #
-    # def step(i):
-    #     if i > len(out_list): return
-    #     pcm.set_array(out_list[i].ravel())
-    #     plt.draw()
-    #     fig.savefig("./frames/" + str(i) + ".png", bbox_inches = 'tight',
-    #                 pad_inches = 0)
-    #
-    # for i in range(len(out_list)):
-    #     step(i)
+    with recorder.TrajectoryRecorder('./frames/trajectory', my_plate.species,
+                                     (my_plate.rows, my_plate.cols),
+                                     interval=1) as frames:
+        while (my_plate.time < 500):
+            if frames.due(my_plate.time):
+                frames.record(my_plate.time, my_plate.grids())
+            my_plate.iterate()
+            counter += 1
+        if frames.due(my_plate.time):
+            frames.record(my_plate.time, my_plate.grids())
+
+
+    # To make an animated GIF of the phage, run
+    #     python3 render.py ./frames/trajectory -o test.gif --fields phages
     print(counter)
     print(my_plate.time)
     print(my_plate)
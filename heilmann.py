@@ -1,6 +1,12 @@
-import numpy as np
+import heapq
+import json
+import os
 import sys
 
+import numpy as np
+
+import streams
+
 def iterate(time,
             delta_t,
             p_diffuse,
@@ -25,132 +31,398 @@ def iterate(time,
             random_rows,
             random_cols,
             eps,
-            output
+            output,
+            lysis_timers,
+            debris_timers,
+            counts,
+            rng=np.random,
+            profiler=None
             ):
     # Shuffle rows and columns so they're not traversed in the same order on
     # each iteration
-    np.random.shuffle(random_rows)
-    np.random.shuffle(random_cols)
+    rng.shuffle(random_rows)
+    rng.shuffle(random_cols)
 
-    temp_phage_with_eps = 0
-    temp_infection_with_eps = 0
-    temp_infection_total = 0
+    # Patches (as flat indices) whose cell lyses or whose debris decays now
+    due_lysis = set(lysis_timers.pop(time))
+    due_debris = set(debris_timers.pop(time))
+
+    visit, tally = patch_visitor(time, p_diffuse, burst_size, p_replicate,
+                                 lysis_time, decay_time, p_eps, p_infect,
+                                 p_debris, rows, cols, burn_in, phage, cells,
+                                 lysis, debris, eps, output, lysis_timers,
+                                 debris_timers, due_lysis, due_debris, counts,
+                                 rng, profiler=profiler)
 
     for i in random_rows:
         for j in random_cols:
-            if cells[i][j] == 0 and lysis[i][j] > 0:
+            visit(i, j)
+
+    record_statistics(time, burn_in, burst_size, p_infect, p_eps, counts,
+                      output, tally['phage_with_eps'],
+                      tally['infection_with_eps'], tally['infection_total'])
+    if profiler is not None:
+        profiler.lap('statistics')
+
+
+def patch_visitor(time, p_diffuse, burst_size, p_replicate, lysis_time,
+                  decay_time, p_eps, p_infect, p_debris, rows, cols, burn_in,
+                  phage, cells, lysis, debris, eps, output, lysis_timers,
+                  debris_timers, due_lysis, due_debris, counts, rng,
+                  wake=None, profiler=None):
+    # Build the function that updates a single patch (i, j) during time step
+    # `time`, shared by iterate() and iterate_active(). due_lysis and
+    # due_debris are the sets of patches (as flat indices) whose timers are
+    # due at this step. The running totals in counts are kept up to date with
+    # every event, and the returned tally collects the other per-step values
+    # needed by record_statistics(). If given, wake(i, j) is called whenever
+    # phage or a daughter cell move into patch (i, j). Random numbers come
+    # from blocks drawn from rng during the step (see UniformBlocks), in the
+    # order patches are visited. With a profiling.Profiler as `profiler`, an
+    # instrumented visitor records the time spent in each phase of a visit
+    # and its events, so that the plain visitor checks for none.
+    tally = {'phage_with_eps': 0, 'infection_with_eps': 0,
+             'infection_total': 0}
+    draws = UniformBlocks(rng)
+
+    def visit(i, j):
+        if due_debris and i * cols + j in due_debris and \
+                debris[i][j] == debris_timers.mark(time):
+            # Reset timers for decaying dead cells
+            debris[i][j] = 0
+            counts['debris'] -= 1
+        if due_lysis and i * cols + j in due_lysis:
+            # Check if it's time for cell to lyse
+            if cells[i][j] == 0:
                 # Sanity check
                 print(cells, lysis)
-                raise RuntimeError("Cell counts and lysis timers are out of "
-                                   " sync.")
-            if debris[i][j] == time and decay_time > 0:
-                # Reset timers for decaying dead cells
-                debris[i][j] = -1
-            if lysis[i][j] == time:
-                # Check if it's time for cell to lyse
-                lysis[i][j] = -1
-                phage[i][j] += burst_size
-                cells[i][j] = 0
-                if decay_time > 0:
-                    debris[i][j] = time + decay_time
-                # Record lysis event
+                raise RuntimeError("Cell counts and lysis timers are out "
+                                   "of sync.")
+            lysis[i][j] = 0
+            phage[i][j] += burst_size
+            cells[i][j] = 0
+            counts['infected'] -= 1
+            counts['phage'] += burst_size
+            if decay_time > 0:
+                if debris[i][j] == 0:
+                    counts['debris'] += 1
+                debris[i][j] = debris_timers.mark(time + decay_time)
+                debris_timers.schedule(i * cols + j, time + decay_time)
+            # Record lysis event
+            if time > burn_in:
+                output['burst_total'] += 1
+        # Replicate cells (only those not infected)
+        if cells[i][j] > 0 and lysis[i][j] == 0:
+            replicate = draws.binomial(cells[i][j], p_replicate)
+            if replicate == 1:
+                # Replicate cells and diffuse randomly
+                possible_moves = []
+                # Check to see if cell is at edge of grid, and have the
+                # coordinates wrap around such that phage and cells move
+                # on a torus.
+                if (i+1) < rows:
+                    down = i + 1
+                else:
+                    down = 0
+                if (j+1) < cols:
+                    right = j + 1
+                else:
+                    right = 0
+                # Daughter cell can move into one of 8 surrounding cells
+                empty = False
+                if cells[down][j] == 0:
+                    possible_moves.append((down, j))
+                    empty = True
+                if cells[i-1][j] == 0:
+                    possible_moves.append((i-1, j))
+                    empty = True
+                if cells[i][right] == 0:
+                    possible_moves.append((i, right))
+                    empty = True
+                if cells[i][j-1] == 0:
+                    possible_moves.append((i, j-1))
+                    empty = True
+                # if empty is False:
+                #     if cells[i-1][j-1] == 0:
+                #         possible_moves.append((i-1, j-1))
+                #     if cells[down][right] == 0:
+                #         possible_moves.append((down, right))
+                #     if cells[down][i-1] == 0:
+                #         possible_moves.append((down, i-1))
+                #     if cells[j-1][right] == 0:
+                #         possible_moves.append((j-1, right))
+                if len(possible_moves) > 0:
+                    # Randomly select from list of possible moves
+                    move_index = draws.choice(len(possible_moves))
+                    move = possible_moves[move_index]
+                    cells[move[0]][move[1]] += 1
+                    counts['healthy'] += 1
+                    if eps[move[0]][move[1]] > 0:
+                        counts['healthy_eps'] += 1
+                    if wake is not None:
+                        wake(move[0], move[1])
+                # Record replication event
                 if time > burn_in:
-                    output['burst_total'] += 1
-            # Replicate cells (only those not infected)
-            if cells[i][j] > 0 and lysis[i][j] == -1:
-                replicate = np.random.binomial(cells[i][j], p_replicate)
-                if replicate == 1:
-                    # Replicate cells and diffuse randomly
-                    possible_moves = []
-                    # Check to see if cell is at edge of grid, and have the
-                    # coordinates wrap around such that phage and cells move
-                    # on a torus.
-                    if (i+1) < rows:
-                        down = i + 1
-                    else:
-                        down = 0
-                    if (j+1) < cols:
-                        right = j + 1
-                    else:
-                        right = 0
-                    # Daughter cell can move into one of 8 surrounding cells
-                    empty = False
-                    if cells[down][j] == 0:
-                        possible_moves.append((down, j))
-                        empty = True
-                    if cells[i-1][j] == 0:
-                        possible_moves.append((i-1, j))
-                        empty = True
-                    if cells[i][right] == 0:
-                        possible_moves.append((i, right))
-                        empty = True
-                    if cells[i][j-1] == 0:
-                        possible_moves.append((i, j-1))
-                        empty = True
-                    # if empty is False:
-                    #     if cells[i-1][j-1] == 0:
-                    #         possible_moves.append((i-1, j-1))
-                    #     if cells[down][right] == 0:
-                    #         possible_moves.append((down, right))
-                    #     if cells[down][i-1] == 0:
-                    #         possible_moves.append((down, i-1))
-                    #     if cells[j-1][right] == 0:
-                    #         possible_moves.append((j-1, right))
-                    if len(possible_moves) > 0:
-                        # Randomly select from list of possible moves
-                        move_index = np.random.choice(len(possible_moves))
-                        move = possible_moves[move_index]
-                        cells[move[0]][move[1]] += 1
-                    # Record replication event
+                    output['replication_total'] += 1
+        # Process infections
+        if phage[i][j] > 0:
+            # Adjust probabilites based on presence or absence of cells,
+            # eps, or debris (dead cells)
+            p_infect_adj = cells[i][j] * p_infect
+            p_eps_adj = eps[i][j] * p_eps
+            p_debris_adj = (debris[i][j] > 0) * p_debris
+            # Randomly distribute phage. Only the first outcome that takes
+            # any phage matters, so the multinomial is drawn one outcome at a
+            # time and stops there.
+            infect = [draws.binomial(phage[i][j], p_infect_adj), 0, 0]
+            p_left = 1 - p_infect_adj
+            if infect[0] == 0:
+                infect[1] = draws.binomial(phage[i][j], p_eps_adj / p_left)
+                p_left -= p_eps_adj
+            if infect[0] == infect[1] == 0 and p_left > 0:
+                infect[2] = draws.binomial(phage[i][j],
+                                           p_debris_adj / p_left)
+            if infect[0] > 0:
+                # Infection will occur
+                phage[i][j] -= infect[0]  # Lose phage
+                counts['phage'] -= infect[0]
+                if lysis[i][j] == 0:
+                    # Only primary infections reset lysis timer
+                    lysis[i][j] = lysis_timers.mark(lysis_time + time)
+                    lysis_timers.schedule(i * cols + j, lysis_time + time)
+                    counts['healthy'] -= 1
+                    counts['infected'] += 1
+                    if eps[i][j] > 0:
+                        counts['healthy_eps'] -= 1
+                    # Record primary infection event
                     if time > burn_in:
-                        output['replication_total'] += 1
-            # Process infections
-            if phage[i][j] > 0:
-                # Adjust probabilites based on presence or absence of cells,
-                # eps, or debris (dead cells)
-                p_infect_adj = cells[i][j] * p_infect
-                p_eps_adj = eps[i][j] * p_eps
-                p_debris_adj = (debris[i][j] > 0) * p_debris
-                # Randomly distribute phage
-                infect = np.random.multinomial(
-                    phage[i][j],
-                    [p_infect_adj,
-                     p_eps_adj,
-                     p_debris_adj,
-                     1 - p_infect_adj - p_eps_adj - p_debris_adj]
-                )
-                if infect[0] > 0:
-                    # Infection will occur
-                    phage[i][j] -= infect[0]  # Lose phage
-                    if lysis[i][j] == -1:
-                        # Only primary infections reset lysis timer
-                        lysis[i][j] = lysis_time + time
-                        # Record primary infection event
-                        if time > burn_in:
-                            output['lost_to_primary_infection'] += infect[0]
-                            if eps[i][j] > 0:
-                                temp_infection_with_eps += infect[0]
-                            temp_infection_total += infect[0]
-                    else:
-                        # This cell is already infected
-                        if time > burn_in:
-                            output['lost_to_secondary_infection'] += infect[0]
-                elif infect[1] > 0:
-                    # Lose phage to EPS
-                    phage[i][j] -= infect[1]
+                        output['lost_to_primary_infection'] += infect[0]
+                        if eps[i][j] > 0:
+                            tally['infection_with_eps'] += infect[0]
+                        tally['infection_total'] += infect[0]
+                else:
+                    # This cell is already infected
+                    if time > burn_in:
+                        output['lost_to_secondary_infection'] += infect[0]
+            elif infect[1] > 0:
+                # Lose phage to EPS
+                phage[i][j] -= infect[1]
+                counts['phage'] -= infect[1]
+                if time > burn_in:
+                    output['lost_to_eps'] += infect[1]
+            elif infect[2] > 0:
+                # Lose phage to debris
+                phage[i][j] -= infect[2]
+                counts['phage'] -= infect[2]
+                if time > burn_in:
+                    output['lost_to_debris'] += infect[2]
+
+        # Randomly diffuse phage. Patches without phage are skipped, so that
+        # they draw no random numbers.
+        if phage[i][j] > 0:
+            # First calculate how many phage will diffuse
+            to_diffuse = draws.binomial(phage[i][j], p_diffuse)
+            # Next calculate which direction they will diffuse in, as a
+            # chain of binomials
+            directions = [draws.binomial(to_diffuse, 1/4)]
+            directions.append(draws.binomial(to_diffuse - directions[0], 1/3))
+            directions.append(draws.binomial(to_diffuse - sum(directions),
+                                             1/2))
+            directions.append(to_diffuse - sum(directions))
+            # Permute boundaries as in cell replication
+            if (i+1) < rows:
+                down = i + 1
+            else:
+                down = 0
+            if (j+1) < cols:
+                right = j + 1
+            else:
+                right = 0
+            # Phage only move orthogonallly
+            phage[down][j] += directions[0]
+            phage[i][j] -= directions[0]
+
+            phage[i-1][j] += directions[1]
+            phage[i][j] -= directions[1]
+
+            phage[i][right] += directions[2]
+            phage[i][j] -= directions[2]
+
+            phage[i][j-1] += directions[3]
+            phage[i][j] -= directions[3]
+
+            if wake is not None and to_diffuse > 0:
+                for move, count in zip([(down, j), (i-1, j), (i, right),
+                                        (i, j-1)], directions):
+                    if count > 0:
+                        wake(move[0], move[1])
+
+        # Record some values
+        if eps[i][j] > 0 and phage[i][j] > 0:
+            tally['phage_with_eps'] += int(phage[i][j])
+
+    if profiler is None:
+        return visit, tally
+
+    # The same update, timing each phase of the visit with the profiler and
+    # counting its events. Changes to one of the two visitors belong in the
+    # other.
+    def profiled_visit(i, j):
+        # Time since the last visit goes to choosing the patches
+        profiler.lap('order')
+        profiler.count('patches visited')
+        if due_debris and i * cols + j in due_debris and \
+                debris[i][j] == debris_timers.mark(time):
+            # Reset timers for decaying dead cells
+            debris[i][j] = 0
+            counts['debris'] -= 1
+            profiler.count('debris decayed')
+        if due_lysis and i * cols + j in due_lysis:
+            # Check if it's time for cell to lyse
+            if cells[i][j] == 0:
+                # Sanity check
+                print(cells, lysis)
+                raise RuntimeError("Cell counts and lysis timers are out "
+                                   "of sync.")
+            lysis[i][j] = 0
+            phage[i][j] += burst_size
+            cells[i][j] = 0
+            counts['infected'] -= 1
+            counts['phage'] += burst_size
+            if decay_time > 0:
+                if debris[i][j] == 0:
+                    counts['debris'] += 1
+                debris[i][j] = debris_timers.mark(time + decay_time)
+                debris_timers.schedule(i * cols + j, time + decay_time)
+            # Record lysis event
+            if time > burn_in:
+                output['burst_total'] += 1
+            profiler.count('lyses')
+        profiler.lap('timers')
+        # Replicate cells (only those not infected)
+        if cells[i][j] > 0 and lysis[i][j] == 0:
+            replicate = draws.binomial(cells[i][j], p_replicate)
+            if replicate == 1:
+                # Replicate cells and diffuse randomly
+                possible_moves = []
+                # Check to see if cell is at edge of grid, and have the
+                # coordinates wrap around such that phage and cells move
+                # on a torus.
+                if (i+1) < rows:
+                    down = i + 1
+                else:
+                    down = 0
+                if (j+1) < cols:
+                    right = j + 1
+                else:
+                    right = 0
+                # Daughter cell can move into one of 8 surrounding cells
+                empty = False
+                if cells[down][j] == 0:
+                    possible_moves.append((down, j))
+                    empty = True
+                if cells[i-1][j] == 0:
+                    possible_moves.append((i-1, j))
+                    empty = True
+                if cells[i][right] == 0:
+                    possible_moves.append((i, right))
+                    empty = True
+                if cells[i][j-1] == 0:
+                    possible_moves.append((i, j-1))
+                    empty = True
+                # if empty is False:
+                #     if cells[i-1][j-1] == 0:
+                #         possible_moves.append((i-1, j-1))
+                #     if cells[down][right] == 0:
+                #         possible_moves.append((down, right))
+                #     if cells[down][i-1] == 0:
+                #         possible_moves.append((down, i-1))
+                #     if cells[j-1][right] == 0:
+                #         possible_moves.append((j-1, right))
+                if len(possible_moves) > 0:
+                    # Randomly select from list of possible moves
+                    move_index = draws.choice(len(possible_moves))
+                    move = possible_moves[move_index]
+                    cells[move[0]][move[1]] += 1
+                    counts['healthy'] += 1
+                    if eps[move[0]][move[1]] > 0:
+                        counts['healthy_eps'] += 1
+                    if wake is not None:
+                        wake(move[0], move[1])
+                    profiler.count('daughters placed')
+                # Record replication event
+                if time > burn_in:
+                    output['replication_total'] += 1
+                profiler.count('replications')
+        profiler.lap('replication')
+        # Process infections
+        if phage[i][j] > 0:
+            # Adjust probabilites based on presence or absence of cells,
+            # eps, or debris (dead cells)
+            p_infect_adj = cells[i][j] * p_infect
+            p_eps_adj = eps[i][j] * p_eps
+            p_debris_adj = (debris[i][j] > 0) * p_debris
+            # Randomly distribute phage. Only the first outcome that takes
+            # any phage matters, so the multinomial is drawn one outcome at a
+            # time and stops there.
+            infect = [draws.binomial(phage[i][j], p_infect_adj), 0, 0]
+            p_left = 1 - p_infect_adj
+            if infect[0] == 0:
+                infect[1] = draws.binomial(phage[i][j], p_eps_adj / p_left)
+                p_left -= p_eps_adj
+            if infect[0] == infect[1] == 0 and p_left > 0:
+                infect[2] = draws.binomial(phage[i][j],
+                                           p_debris_adj / p_left)
+            profiler.count('phage adsorbed', sum(infect))
+            if infect[0] > 0:
+                # Infection will occur
+                phage[i][j] -= infect[0]  # Lose phage
+                counts['phage'] -= infect[0]
+                if lysis[i][j] == 0:
+                    # Only primary infections reset lysis timer
+                    lysis[i][j] = lysis_timers.mark(lysis_time + time)
+                    lysis_timers.schedule(i * cols + j, lysis_time + time)
+                    profiler.count('primary infections')
+                    counts['healthy'] -= 1
+                    counts['infected'] += 1
+                    if eps[i][j] > 0:
+                        counts['healthy_eps'] -= 1
+                    # Record primary infection event
                     if time > burn_in:
-                        output['lost_to_eps'] += infect[1]
-                elif infect[2] > 0:
-                    # Lose phage to debris
-                    phage[i][j] -= infect[2]
+                        output['lost_to_primary_infection'] += infect[0]
+                        if eps[i][j] > 0:
+                            tally['infection_with_eps'] += infect[0]
+                        tally['infection_total'] += infect[0]
+                else:
+                    # This cell is already infected
                     if time > burn_in:
-                        output['lost_to_debris'] += infect[2]
+                        output['lost_to_secondary_infection'] += infect[0]
+            elif infect[1] > 0:
+                # Lose phage to EPS
+                phage[i][j] -= infect[1]
+                counts['phage'] -= infect[1]
+                if time > burn_in:
+                    output['lost_to_eps'] += infect[1]
+            elif infect[2] > 0:
+                # Lose phage to debris
+                phage[i][j] -= infect[2]
+                counts['phage'] -= infect[2]
+                if time > burn_in:
+                    output['lost_to_debris'] += infect[2]
+        profiler.lap('infection')
 
-            # Randomly diffuse phage
+        # Randomly diffuse phage. Patches without phage are skipped, so that
+        # they draw no random numbers.
+        if phage[i][j] > 0:
             # First calculate how many phage will diffuse
-            to_diffuse = np.random.binomial(phage[i][j], p_diffuse)
-            # Next calculate which direction they will diffuse in
-            directions = np.random.multinomial(to_diffuse, [1/4]*4)
+            to_diffuse = draws.binomial(phage[i][j], p_diffuse)
+            # Next calculate which direction they will diffuse in, as a
+            # chain of binomials
+            directions = [draws.binomial(to_diffuse, 1/4)]
+            directions.append(draws.binomial(to_diffuse - directions[0], 1/3))
+            directions.append(draws.binomial(to_diffuse - sum(directions),
+                                             1/2))
+            directions.append(to_diffuse - sum(directions))
             # Permute boundaries as in cell replication
             if (i+1) < rows:
                 down = i + 1
@@ -173,42 +445,647 @@ def iterate(time,
             phage[i][j-1] += directions[3]
             phage[i][j] -= directions[3]
 
-            # Record some values
-            if eps[i][j] > 0 and phage[i][j] > 0:
-                temp_phage_with_eps += phage[i][j]
+            if wake is not None and to_diffuse > 0:
+                for move, count in zip([(down, j), (i-1, j), (i, right),
+                                        (i, j-1)], directions):
+                    if count > 0:
+                        wake(move[0], move[1])
+            profiler.count('phage moved', to_diffuse)
+
+        # Record some values
+        if eps[i][j] > 0 and phage[i][j] > 0:
+            tally['phage_with_eps'] += int(phage[i][j])
+        profiler.lap('diffusion')
+
+    return profiled_visit, tally
+
+
+def iterate_active(time,
+                   delta_t,
+                   p_diffuse,
+                   burst_size,
+                   p_replicate,
+                   lysis_time,
+                   decay_time,
+                   p_eps,
+                   p_infect,
+                   p_debris,
+                   random_eps,
+                   rows,
+                   cols,
+                   fill_phage,
+                   fill_cells,
+                   fill_eps,
+                   burn_in,
+                   phage,
+                   cells,
+                   lysis,
+                   debris,
+                   random_rows,
+                   random_cols,
+                   eps,
+                   output,
+                   lysis_timers,
+                   debris_timers,
+                   counts,
+                   active,
+                   rng=np.random,
+                   profiler=None
+                   ):
+    """
+    Version of iterate() that only visits patches where something can
+    happen.
+
+    A patch with no phage, and either no cell or an infected cell, does
+    nothing and draws no random numbers when iterate() visits it, unless its
+    lysis or debris timer is due. `active` is the set of patches (as flat
+    indices) holding phage or a healthy cell. Each step visits those patches
+    and the patches with due timers in the same random row/column order as
+    iterate(). Patches that receive phage or a daughter cell from a
+    neighbour are added on the fly if they come later in that order, so
+    runs match iterate() exactly under the same random number stream while
+    costing time in proportion to the infection front rather than to the
+    whole plate.
+    """
+    rng.shuffle(random_rows)
+    rng.shuffle(random_cols)
+
+    # Position of every row and column in this step's visiting order
+    row_rank = [0] * rows
+    for position, i in enumerate(random_rows):
+        row_rank[i] = position
+    col_rank = [0] * cols
+    for position, j in enumerate(random_cols):
+        col_rank[j] = position
+
+    queue = []
+    queued = set()
+    current = [-1]
+
+    def wake(i, j):
+        # Neighbours above and to the left arrive as negative indices
+        i %= rows
+        j %= cols
+        patch = i * cols + j
+        active.add(patch)
+        rank = row_rank[i] * cols + col_rank[j]
+        if rank > current[0] and patch not in queued:
+            heapq.heappush(queue, (rank, patch))
+            queued.add(patch)
 
+    due_lysis = set(lysis_timers.pop(time))
+    due_debris = set(debris_timers.pop(time))
 
-    # Calculate and record alpha-b values and other info
+    visit, tally = patch_visitor(time, p_diffuse, burst_size, p_replicate,
+                                 lysis_time, decay_time, p_eps, p_infect,
+                                 p_debris, rows, cols, burn_in, phage, cells,
+                                 lysis, debris, eps, output, lysis_timers,
+                                 debris_timers, due_lysis, due_debris, counts,
+                                 rng, wake=wake, profiler=profiler)
+
+    for patch in active | due_lysis | due_debris:
+        i, j = divmod(patch, cols)
+        queue.append((row_rank[i] * cols + col_rank[j], patch))
+        queued.add(patch)
+    heapq.heapify(queue)
+
+    while queue:
+        current[0], patch = heapq.heappop(queue)
+        i, j = divmod(patch, cols)
+        visit(i, j)
+        # Keep the patch active only while it holds phage or a healthy cell
+        if phage[i][j] > 0 or (cells[i][j] > 0 and lysis[i][j] == 0):
+            active.add(patch)
+        else:
+            active.discard(patch)
+
+    record_statistics(time, burn_in, burst_size, p_infect, p_eps, counts,
+                      output, tally['phage_with_eps'],
+                      tally['infection_with_eps'], tally['infection_total'])
+    if profiler is not None:
+        profiler.lap('statistics')
+
+
+def active_patches(phage, cells, lysis):
+    # Patches (as flat indices) holding phage or a healthy cell
+    return set(np.flatnonzero((phage > 0) | ((cells > 0) & (lysis == 0)))
+               .tolist())
+
+
+def record_statistics(time, burn_in, burst_size, p_infect, p_eps, counts,
+                      output, temp_phage_with_eps, temp_infection_with_eps,
+                      temp_infection_total):
+    # Calculate and record alpha-b values and other info from the running
+    # totals in counts (see count_state()). Samples whose denominator is zero
+    # are skipped and counted in output.
     if time > burn_in:
-        healthy_cells = np.sum(cells) - np.sum(np.where(lysis > 0, 1, 0))
-        total_cells = np.sum(cells) + np.sum(debris > 0)
-        output['alphab'] += (burst_size * p_infect * healthy_cells) / \
-            ((p_infect*total_cells) + p_eps * output["eps_total"])
+        healthy_cells = counts['healthy']
+        total_cells = counts['healthy'] + counts['infected'] + \
+            counts['debris']
+        output['recorded_steps'] += 1
 
-        temp = (np.where(cells > 0, 1, 0) + np.where(eps > 0, 1, 0) + np.where(lysis < 0, 1, 0))
-        # output['cells_with_eps'] += np.sum(temp == 3)/healthy_cells
+        alphab, valid = _ratio(burst_size * p_infect * healthy_cells,
+                               (p_infect*total_cells) +
+                               p_eps * output["eps_total"])
+        output['alphab'] += alphab
+        output['alphab_skipped'] += ~valid
 
-        # temp = (np.where(eps > 0, 1, 0) + np.where(lysis > 0, 1, 0))
-        # infected_cells = np.sum(np.where(lysis < 0, 1, 0))
+        phage_with_eps, valid = _ratio(temp_phage_with_eps, counts['phage'])
+        output['phage_with_eps'] += phage_with_eps
+        output['phage_with_eps_skipped'] += ~valid
 
-        try:
-            output['phage_with_eps'] += temp_phage_with_eps/np.sum(phage)
-            # output['infection_with_eps'] += temp_infection_with_eps/temp_infection_total
-            output['infection_with_eps'] += temp_infection_with_eps
-            output['infection_total'] += temp_infection_total
-            output['healthy_cell_total'] += healthy_cells
-            output['healthy_cell_eps'] += np.sum(temp == 3)
-            # output['infection_with_eps'] += np.sum(temp == 2)/infected_cells
-        except:
-            pass
+        output['infection_with_eps'] += temp_infection_with_eps
+        output['infection_total'] += temp_infection_total
+        output['healthy_cell_total'] += healthy_cells
+        output['healthy_cell_eps'] += counts['healthy_eps']
 
 
-def run_simulation(eps,
-                   burst,
-                   decay=0,
-                   random_eps=True,
-                   sim_time=10000,
-                   burn_in=7000):
+def count_state(phage, cells, lysis, debris, eps):
+    # Running totals kept up to date by the engines, counted from the grids
+    # (or per grid, for a stack of replicate grids)
+    grid = (-2, -1)
+    healthy = (cells > 0) & (lysis == 0)
+    return {
+        'healthy': np.sum(healthy, axis=grid),
+        'infected': np.sum(lysis > 0, axis=grid),
+        'debris': np.sum(debris > 0, axis=grid),
+        'phage': np.sum(phage, axis=grid),
+        'healthy_eps': np.sum(healthy & (eps > 0), axis=grid),
+    }
+
+
+def _ratio(numerator, denominator):
+    # numerator/denominator, or 0 where the denominator is 0, together with
+    # whether the denominator was non-zero
+    valid = np.asarray(denominator) != 0
+    ratio = np.divide(numerator, denominator, out=np.zeros(valid.shape),
+                      where=valid)
+    return ratio[()], valid[()]
+
+
+def iterate_vectorized(time,
+                       delta_t,
+                       p_diffuse,
+                       burst_size,
+                       p_replicate,
+                       lysis_time,
+                       decay_time,
+                       p_eps,
+                       p_infect,
+                       p_debris,
+                       random_eps,
+                       rows,
+                       cols,
+                       fill_phage,
+                       fill_cells,
+                       fill_eps,
+                       burn_in,
+                       phage,
+                       cells,
+                       lysis,
+                       debris,
+                       random_rows,
+                       random_cols,
+                       eps,
+                       output,
+                       lysis_timers,
+                       debris_timers,
+                       counts,
+                       rng=np.random,
+                       profiler=None
+                       ):
+    """
+    Whole-grid version of iterate() built from array operations.
+
+    iterate() visits patches one at a time in a random order, so a patch
+    visited late in a step already sees the lysis, daughter cells and phage
+    produced by patches visited earlier. Here each phase is applied to every
+    patch at once instead:
+
+    1. Debris timers and lysis timers that are due expire everywhere. Only
+       the patches listed in the timer wheels for this step are touched.
+    2. Phage are lost to infection, EPS or debris. The four-way multinomial
+       of iterate() is drawn as a chain of binomials and, as in iterate(),
+       only the first non-zero loss in the order infection, EPS, debris is
+       applied. The phage in EPS are counted at this point.
+    3. Cells that are still healthy decide whether to replicate. Daughter
+       cells are placed with a conflict-resolution pass: every replicating
+       cell picks one of its empty Von Neumann neighbours uniformly, and
+       when several cells pick the same patch one of them, chosen uniformly,
+       wins. The losers pick again among the neighbours that are still
+       empty, until every daughter is placed or has nowhere to go. As in
+       iterate(), a daughter with no empty neighbour dies but still counts
+       as a replication. Daughters placed during a step do not replicate
+       until the next step.
+    4. Phage diffuse. Each phage moves at most once per step, whereas in
+       iterate() a phage that moves into a patch that has not been visited
+       yet can move again in the same step.
+
+    Daughters are placed after the infections because in iterate() a
+    daughter can only move into a patch whose cell lysed this step if that
+    patch was visited first, so it is never exposed to the burst in the step
+    of the lysis. Placing daughters first let them soak up the fresh bursts,
+    which raised p2c by about 12% and p2ic by about 20% over iterate().
+    Likewise iterate() counts the phage in EPS patch by patch, before about
+    half the phage that diffuse during the step arrive, so they are counted
+    here before diffusion. With this order the outputs agree with those of
+    iterate() within sampling error (see test_heilmann.py).
+
+    The same output counters are filled as in iterate(). The grids may also
+    be stacks of shape (replicates, rows, cols), in which case every replicate
+    is advanced independently and each output counter holds one value per
+    replicate (see run_ensemble()).
+
+    rng may also be a streams.Streams, in which case every draw is keyed by
+    the time step, the flat index of its patch and its purpose, and does not
+    depend on the other patches. The trajectory is then the same as that of
+    the tiled runner in tiled.py with the same seed, however it is split.
+
+    With a profiling.Profiler as `profiler`, the time spent in each phase
+    and its events are recorded.
+    """
+    grid = (-2, -1)
+    recording = time > burn_in
+
+    # Reset timers for decaying dead cells. A patch whose debris timer was
+    # reset by a later lysis still has its old, stale entry in the wheel.
+    decayed = np.array(debris_timers.pop(time), dtype=int)
+    decayed = decayed[debris.flat[decayed] == debris_timers.mark(time)]
+    debris.flat[decayed] = 0
+    counts['debris'] -= _flat_count(decayed, debris.shape)
+
+    # Lyse infected cells whose timer is up
+    lysed = np.array(lysis_timers.pop(time), dtype=int)
+    if np.any(cells.flat[lysed] == 0):
+        # Sanity check
+        raise RuntimeError("Cell counts and lysis timers are out of sync.")
+    lysis.flat[lysed] = 0
+    phage.flat[lysed] += burst_size
+    cells.flat[lysed] = 0
+    n_lysed = _flat_count(lysed, cells.shape)
+    counts['infected'] -= n_lysed
+    counts['phage'] += burst_size * n_lysed
+    if decay_time > 0:
+        counts['debris'] += _flat_count(lysed[debris.flat[lysed] == 0],
+                                        debris.shape)
+        debris.flat[lysed] = debris_timers.mark(time + decay_time)
+        debris_timers.schedule(lysed, time + decay_time)
+    if recording:
+        output['burst_total'] += n_lysed
+    if profiler is not None:
+        profiler.count('debris decayed', decayed.size)
+        profiler.count('lyses', lysed.size)
+        profiler.lap('timers')
+
+    # Process infections. Only patches holding phage draw random numbers.
+    # Probabilities are adjusted based on presence or absence of cells, eps,
+    # or debris (dead cells), and the multinomial is drawn one outcome at a
+    # time.
+    occupied = np.nonzero(phage)
+    patches = np.ravel_multi_index(occupied, phage.shape)
+    n_phage = phage[occupied]
+    p_infect_adj = cells[occupied] * p_infect
+    p_eps_adj = eps[occupied] * p_eps
+    p_debris_adj = (debris[occupied] > 0) * p_debris
+    infect = _binomial(rng, n_phage, p_infect_adj, time, patches, 'infect')
+    p_left = 1 - p_infect_adj
+    to_eps = _binomial(rng, n_phage - infect, _conditional(p_eps_adj, p_left),
+                       time, patches, 'eps')
+    p_left = p_left - p_eps_adj
+    to_debris = _binomial(rng, n_phage - infect - to_eps,
+                          _conditional(p_debris_adj, p_left), time, patches,
+                          'debris')
+
+    infected = infect > 0
+    primary = infected & (lysis[occupied] == 0)
+    secondary = infected & ~primary
+    lost_eps = ~infected & (to_eps > 0)
+    lost_debris = ~infected & ~lost_eps & (to_debris > 0)
+    lost = (infect + np.where(lost_eps, to_eps, 0) +
+            np.where(lost_debris, to_debris, 0))
+    phage[occupied] -= lost
+    counts['phage'] -= _grid_sum(lost, occupied, phage.shape)
+    # Only primary infections reset lysis timer
+    infections = tuple(index[primary] for index in occupied)
+    lysis[infections] = lysis_timers.mark(lysis_time + time)
+    lysis_timers.schedule(np.ravel_multi_index(infections, lysis.shape),
+                          lysis_time + time)
+    n_primary = _grid_sum(primary, occupied, phage.shape)
+    n_primary_eps = _grid_sum(primary & (eps[occupied] > 0), occupied,
+                              phage.shape)
+    counts['healthy'] -= n_primary
+    counts['infected'] += n_primary
+    counts['healthy_eps'] -= n_primary_eps
+
+    temp_infection_with_eps = 0
+    temp_infection_total = 0
+    if recording:
+        primary_total = _grid_sum(infect * primary, occupied, phage.shape)
+        output['lost_to_primary_infection'] += primary_total
+        output['lost_to_secondary_infection'] += _grid_sum(
+            infect * secondary, occupied, phage.shape)
+        output['lost_to_eps'] += _grid_sum(to_eps * lost_eps, occupied,
+                                           phage.shape)
+        output['lost_to_debris'] += _grid_sum(to_debris * lost_debris,
+                                              occupied, phage.shape)
+        temp_infection_with_eps = _grid_sum(
+            infect * (primary & (eps[occupied] > 0)), occupied, phage.shape)
+        temp_infection_total = primary_total
+    temp_phage_with_eps = np.sum(np.where(eps > 0, phage, 0), axis=grid)
+    if profiler is not None:
+        profiler.count('primary infections', np.count_nonzero(primary))
+        profiler.count('phage adsorbed', np.sum(lost))
+        profiler.lap('infection')
+
+    # Replicate cells (only those not infected)
+    healthy = np.flatnonzero((cells > 0) & (lysis == 0))
+    replicate = _binomial(rng, cells.flat[healthy], p_replicate, time, healthy,
+                          'replicate') == 1
+    parents = healthy[replicate]
+    daughters = place_daughters(parents, cells, rng, time)
+    counts['healthy'] += _flat_count(daughters, cells.shape)
+    counts['healthy_eps'] += _flat_count(daughters[eps.flat[daughters] > 0],
+                                         cells.shape)
+    if recording:
+        output['replication_total'] += _flat_count(parents, cells.shape)
+    if profiler is not None:
+        profiler.count('replications', parents.size)
+        profiler.count('daughters placed', daughters.size)
+        profiler.lap('replication')
+
+    # Randomly diffuse phage, drawing the four directions as a chain of
+    # binomials. Phage move orthogonally on a torus.
+    occupied = np.nonzero(phage)
+    patches = np.ravel_multi_index(occupied, phage.shape)
+    to_diffuse = _binomial(rng, phage[occupied], p_diffuse, time, patches,
+                           'diffuse')
+    moves = np.zeros((4,) + phage.shape, dtype=phage.dtype)
+    moves[0][occupied] = _binomial(rng, to_diffuse, 1/4, time, patches,
+                                   'down')
+    moves[1][occupied] = _binomial(
+        rng, to_diffuse - moves[0][occupied], 1/3, time, patches, 'up')
+    moves[2][occupied] = _binomial(
+        rng, to_diffuse - moves[0][occupied] - moves[1][occupied], 1/2, time,
+        patches, 'right')
+    moves[3][occupied] = to_diffuse - moves[0][occupied] - \
+        moves[1][occupied] - moves[2][occupied]
+    phage[occupied] -= to_diffuse
+    phage += np.roll(moves[0], 1, axis=-2)   # down
+    phage += np.roll(moves[1], -1, axis=-2)  # up
+    phage += np.roll(moves[2], 1, axis=-1)   # right
+    phage += np.roll(moves[3], -1, axis=-1)  # left
+    if profiler is not None:
+        profiler.count('phage moved', np.sum(to_diffuse))
+        profiler.lap('diffusion')
+
+    record_statistics(time, burn_in, burst_size, p_infect, p_eps, counts,
+                      output, temp_phage_with_eps, temp_infection_with_eps,
+                      temp_infection_total)
+    if profiler is not None:
+        profiler.lap('statistics')
+
+
+def place_daughters(parents, cells, rng=np.random, time=0):
+    """
+    Place one daughter cell next to each parent in flat index array
+    `parents`, resolving conflicts between parents that pick the same empty
+    patch. Neighbours are listed down, up, right, left as in iterate().
+    `cells` may be a stack of grids, with the grid in the last two axes.
+    Returns the flat indices of the patches that received a daughter.
+
+    With a streams.Streams as rng, the picks and the order of the claims of
+    each round are keyed by `time` and the parent patch.
+    """
+    rows, cols = cells.shape[-2:]
+    placed = []
+    attempt = 0
+    while parents.size > 0:
+        base = parents - parents % (rows * cols)
+        r, c = np.divmod(parents % (rows * cols), cols)
+        neighbours = base[:, None] + np.stack(
+            [((r + 1) % rows) * cols + c,
+             ((r - 1) % rows) * cols + c,
+             r * cols + (c + 1) % cols,
+             r * cols + (c - 1) % cols], axis=1)
+        empty = np.take(cells, neighbours) == 0
+        n_empty = empty.sum(axis=1)
+        # Daughters with nowhere to move die
+        alive = n_empty > 0
+        neighbours = neighbours[alive]
+        empty = empty[alive]
+        n_empty = n_empty[alive]
+        if neighbours.shape[0] == 0:
+            break
+        # Pick uniformly among the empty neighbours of each parent
+        if isinstance(rng, streams.Streams):
+            claimants = parents[alive]
+            pick = rng.random(time, claimants, 'place', draw=2 * attempt)
+            # Highest priority first
+            order = np.argsort(-rng.random(time, claimants, 'place',
+                                           draw=2 * attempt + 1), kind='stable')
+        else:
+            pick = rng.random(n_empty.size)
+        pick = (pick * n_empty).astype(int)
+        column = np.argmax(empty & (np.cumsum(empty, axis=1) == pick[:, None] + 1),
+                           axis=1)
+        targets = neighbours[np.arange(n_empty.size), column]
+        # The first claim on a patch in a random order wins
+        if not isinstance(rng, streams.Streams):
+            order = rng.permutation(n_empty.size)
+        _, first = np.unique(targets[order], return_index=True)
+        winners = order[first]
+        np.put(cells, targets[winners], 1)
+        placed.append(targets[winners])
+        losers = np.ones(n_empty.size, dtype=bool)
+        losers[winners] = False
+        parents = parents[alive][losers]
+        attempt += 1
+    return np.concatenate(placed) if placed else np.array([], dtype=int)
+
+
+def _binomial(rng, n, p, time, patches, purpose):
+    # Binomial draws, keyed by time, patch (flat index) and purpose if rng is
+    # a streams.Streams
+    if isinstance(rng, streams.Streams):
+        return rng.binomial(time, patches, purpose, n, p)
+    return rng.binomial(n, p)
+
+
+def _grid_sum(values, index, shape):
+    # Sum values drawn at the patches in index (as returned by np.nonzero)
+    # separately for each grid of a stack of shape (replicates, rows, cols)
+    if len(shape) == 2:
+        return np.sum(values)
+    return np.bincount(index[0], weights=values,
+                       minlength=shape[0]).astype(int)
+
+
+def _flat_count(patches, shape):
+    # Number of flat indices in patches that fall in each grid of a stack of
+    # shape (replicates, rows, cols)
+    if len(shape) == 2:
+        return patches.size
+    return np.bincount(patches // (shape[-2] * shape[-1]), minlength=shape[0])
+
+
+def _conditional(p, p_left):
+    # Probability of an outcome given that none of the earlier outcomes of a
+    # multinomial occurred
+    return np.clip(np.divide(p, p_left, out=np.zeros(np.shape(p_left)),
+                             where=p_left > 0), 0, 1)
+
+
+class TimerWheel:
+    """
+    Timers bucketed by the time step at which they are due.
+
+    Patches, stored as flat indices into the grid, sit in a ring of `span`
+    slots, one per upcoming time step, so a timer can be scheduled at most
+    `span - 1` steps ahead. Scheduling and expiring timers costs time in
+    proportion to the number of timers, not to the size of the grid.
+    """
+    def __init__(self, span):
+        self.span = span
+        self.slots = [[] for _ in range(span)]
+
+    def schedule(self, patches, due):
+        """
+        Schedule a timer for one patch, or an array of patches, at step `due`.
+        """
+        if np.ndim(patches) == 0:
+            self.slots[due % self.span].append(int(patches))
+        else:
+            self.slots[due % self.span].extend(np.ravel(patches).tolist())
+
+    def pop(self, time):
+        """
+        Remove and return the list of patches whose timers are due at `time`.
+        """
+        slot = self.slots[time % self.span]
+        self.slots[time % self.span] = []
+        return slot
+
+    def mark(self, due):
+        """
+        Return the value a timer grid holds for a timer due at step `due`: its
+        slot plus one, so that 0 can mark patches without a timer.
+
+        Marks never exceed `span`, so the grids fit in small integers, and
+        no two timers pending at once share a mark.
+        """
+        return due % self.span + 1
+
+    def restore(self, marks):
+        """
+        Schedule the timers held in a grid of marks, as written by mark().
+        """
+        pending = np.flatnonzero(marks)
+        for mark in np.unique(marks.flat[pending]):
+            self.schedule(pending[marks.flat[pending] == mark], int(mark) - 1)
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+
+class UniformBlocks:
+    """
+    Uniform variates drawn from rng in blocks of `size` and handed out one at
+    a time, for the scalar draws of iterate() and iterate_active().
+
+    A call into rng costs far more than the number it returns, so patches
+    take their binomial and uniform choices from the current block instead,
+    by inverting the distribution function. A new block is only drawn when
+    the current one runs out, so a step that visits few patches draws few
+    blocks. Binomials whose mean exceeds `inversion_limit`, where inversion
+    would walk too far, are drawn from rng directly.
+    """
+    def __init__(self, rng, size=1024, inversion_limit=30):
+        self.rng = rng
+        self.size = size
+        self.inversion_limit = inversion_limit
+        self.block = []
+        self.position = 0
+
+    def random(self):
+        """
+        Get the next uniform number in [0, 1).
+        """
+        if self.position == len(self.block):
+            self.block = self.rng.random(self.size).tolist()
+            self.position = 0
+        u = self.block[self.position]
+        self.position += 1
+        return u
+
+    def choice(self, n):
+        """
+        Pick one of 0, 1, ..., n - 1 uniformly.
+        """
+        return min(int(self.random() * n), n - 1)
+
+    def binomial(self, n, p):
+        """
+        Draw from the binomial(n, p) distribution.
+        """
+        # Counts read from the grids are NumPy scalars, which are slow to
+        # compute with one at a time
+        n = int(n)
+        p = float(p)
+        if n <= 0 or p <= 0:
+            return 0
+        if p >= 1:
+            return n
+        if n * p > self.inversion_limit:
+            return int(self.rng.binomial(n, p))
+        if self.position == len(self.block):
+            self.block = self.rng.random(self.size).tolist()
+            self.position = 0
+        u = self.block[self.position]
+        self.position += 1
+        if n == 1:
+            return int(u < p)
+        # Walk the shorter tail
+        flip = p > 0.5
+        if flip:
+            p = 1 - p
+        odds = p / (1 - p)
+        pmf = (1 - p) ** n
+        cdf = pmf
+        k = 0
+        while u >= cdf and k < n:
+            pmf *= (n - k) / (k + 1) * odds
+            k += 1
+            cdf += pmf
+        return n - k if flip else k
+
+
+ENGINES = {
+    'loop': iterate,
+    'active': iterate_active,
+    'vectorized': iterate_vectorized,
+}
+
+
+# Data types of the grids. Cells and EPS only ever hold 0 or 1, and the
+# timers hold their slot in a TimerWheel plus one, or 0 for no timer (see
+# TimerWheel.mark()), which is never more than the lysis or decay time plus
+# one. A patch takes 9 bytes instead of 40 with NumPy's default int64.
+GRID_DTYPES = {'phage': np.int32, 'cells': np.uint8, 'eps': np.uint8,
+               'lysis': np.uint8, 'debris': np.int16}
+
+# Grids of 0s and 1s, stored in checkpoints as bits
+BIT_GRIDS = ('cells', 'eps')
+
+
+def make_params(eps,
+                burst,
+                decay=0,
+                random_eps=True,
+                burn_in=7000,
+                rows=20,
+                cols=20,
+                rng=None,
+                replicates=None):
 
     params = dict(
         delta_t = 1,  # time step in minutes
@@ -223,59 +1100,57 @@ def run_simulation(eps,
 
         random_eps = random_eps,
 
-        rows = 20,
-        cols = 20,
+        rows = rows,
+        cols = cols,
 
         fill_phage = 0.3,  # proportion of phage at initialization
         fill_cells = 0.3,  # proportion of cells at initialization
         fill_eps = eps,  # proportion of eps at initialization
 
         burn_in = burn_in,  # how many iterations should we wait before recording data?
-        # Randomly place phage in grid
-    )
 
-    patches = params['rows'] * params['cols']
-    phage_count_init = int(params['fill_phage'] * patches)
-    phage_empties_init = patches - phage_count_init
-    cell_count_init = int(params['fill_cells'] * patches)
-    cell_empties_init = patches - cell_count_init
-    eps_count_init = int(params['fill_eps'] * patches)
-    eps_empties_init = patches - eps_count_init
+        # Source of randomness, a new np.random.Generator unless given.
+        # NumPy's global random state is only drawn from if np.random itself
+        # is passed.
+        rng = np.random.default_rng() if rng is None else rng,
+    )
+    for key, span in [('lysis', params['lysis_time'] + 1),
+                      ('debris', params['decay_time'] + 1)]:
+        # Timer grids hold marks of up to `span` (see TimerWheel.mark())
+        if span > np.iinfo(GRID_DTYPES[key]).max:
+            raise ValueError(f"{key} timers of {span - 1} steps do not fit "
+                             f"in {np.dtype(GRID_DTYPES[key]).name} grids")
 
-    params['phage'] = np.random.choice(
-                        [params['burst_size']]*phage_count_init + \
-                        [0]*phage_empties_init,
-                        replace=False, size=(params['rows'], params['cols'])
-                        )
-    # Randomly place live cells
-    params['cells'] = np.random.choice(
-                        [1]*cell_count_init + [0]*cell_empties_init,
-                        replace=False, size=(params['rows'], params['cols']))
+    # Replicates are stacked along a leading axis, one grid per replicate
+    grids = [initial_grids(params, replicate)
+             for replicate in range(replicates or 1)]
+    if replicates is None:
+        params['phage'], params['cells'], params['eps'] = grids[0]
+    else:
+        params['phage'], params['cells'], params['eps'] = \
+            (np.stack(grid) for grid in zip(*grids))
+    shape = params['phage'].shape
     # Grid of lysis timers (can also tell us where infected cells are)
-    params['lysis'] = np.ones((params['rows'], params['cols']), dtype='int')*-1
+    params['lysis'] = np.zeros(shape, dtype=GRID_DTYPES['lysis'])
     # Grid of debris/dead cell timers
-    params['debris'] = np.ones((params['rows'], params['cols']), dtype='int')*-1
+    params['debris'] = np.zeros(shape, dtype=GRID_DTYPES['debris'])
+    # Timers indexed by the step they are due, so that only the patches
+    # whose cell lyses or whose debris decays are touched on each step
+    params['lysis_timers'] = TimerWheel(params['lysis_time'] + 1)
+    params['debris_timers'] = TimerWheel(params['decay_time'] + 1)
     params['random_rows'] = list(range(0, params['rows']))
     params['random_cols'] = list(range(0, params['cols']))
-    # Grid of EPS
-    if not params['random_eps']:
-        # if eps is deterministic, patches from left to right, top to bottom
-        params['eps'] = np.zeros((params['rows'], params['cols']))
-        for i in range(0, params['rows']):
-            for j in range(0, params['cols']):
-                if np.sum(params['eps']) < eps_count_init:
-                    params['eps'][i][j] = 1
-    else:
-        params['eps'] = np.random.choice([1]*eps_count_init + \
-                                         [0]*eps_empties_init,
-                                         replace=False,
-                                         size=(params['rows'], params['cols']))
-    print(params['eps'])
+
+    # Running totals of healthy and infected cells, debris, phage and healthy
+    # cells in EPS
+    params['counts'] = count_state(params['phage'], params['cells'],
+                                   params['lysis'], params['debris'],
+                                   params['eps'])
 
     params['output'] = {
         'burst_total': 0,
         'replication_total': 0,
-        'eps_total': np.sum(params['eps']),
+        'eps_total': np.sum(params['eps'], axis=(-2, -1), dtype=int),
         'lost_to_eps': 0,
         'lost_to_debris': 0,
         'lost_to_primary_infection': 0,
@@ -286,59 +1161,567 @@ def run_simulation(eps,
         'infection_with_eps': 0,
         'infection_total': 0,
         'healthy_cell_total': 0,
-        'healthy_cell_eps': 0
+        'healthy_cell_eps': 0,
+        'recorded_steps': 0,
+        'alphab_skipped': 0,
+        'phage_with_eps_skipped': 0
     }
+    return params
 
-    time = 0
 
+def initial_grids(params, replicate=0):
+    rng = params['rng']
+    if isinstance(rng, streams.Streams):
+        # Keyed streams draw the grids of each replicate from a stream of
+        # their own
+        rng = rng.generator(0, replicate, 'initial grids')
+    shape = (params['rows'], params['cols'])
+    patches = params['rows'] * params['cols']
+    phage_count_init = int(params['fill_phage'] * patches)
+    cell_count_init = int(params['fill_cells'] * patches)
+    eps_count_init = int(params['fill_eps'] * patches)
+
+    # Each grid is filled by drawing a random order of the patches and
+    # filling the patches that come first. This is how choosing without
+    # replacement from a list of the patch values places them, so the grids
+    # are the same as those drawn from such lists, without building them.
+    # Randomly place phage in grid
+    order = rng.choice(patches, replace=False, size=shape)
+    phage = np.where(order < phage_count_init, params['burst_size'], 0)
+    phage = phage.astype(GRID_DTYPES['phage'])
+    # Randomly place live cells
+    order = rng.choice(patches, replace=False, size=shape)
+    cells = (order < cell_count_init).astype(GRID_DTYPES['cells'])
+    # Grid of EPS
+    if not params['random_eps']:
+        # if eps is deterministic, patches from left to right, top to bottom
+        eps = np.zeros(shape, dtype=GRID_DTYPES['eps'])
+        eps.flat[:eps_count_init] = 1
+    else:
+        order = rng.choice(patches, replace=False, size=shape)
+        eps = (order < eps_count_init).astype(GRID_DTYPES['eps'])
+    return phage, cells, eps
+
+
+def summarize(output, phage, cells):
+    # Turn the accumulated totals of one run into averages and ratios. Any
+    # ratio whose denominator is zero is reported as 0.
+    output['phage_final'] = np.sum(phage)
+    output['total_cells_final'] = np.sum(cells)
+    output['alphab_avg'] = _quotient(
+        output['alphab'], output['recorded_steps'] - output['alphab_skipped'])
+    output['cells_with_eps'] = _quotient(output['healthy_cell_eps'],
+                                         output['healthy_cell_total'])
+    output['phage_with_eps'] = _quotient(
+        output['phage_with_eps'],
+        output['recorded_steps'] - output['phage_with_eps_skipped'])
+    output['infection_with_eps'] = _quotient(output['infection_with_eps'],
+                                             output['infection_total'])
+    output['p2c'] = _quotient(output['lost_to_primary_infection'],
+                              output['burst_total'])
+    output['p2ic'] = _quotient(output['lost_to_secondary_infection'],
+                               output['burst_total'])
+    output['p2eps'] = _quotient(output['lost_to_eps'], output['burst_total'])
+    output['p2debris'] = _quotient(output['lost_to_debris'],
+                                   output['burst_total'])
+    return output
+
+
+def _quotient(numerator, denominator):
+    if denominator == 0:
+        return 0
+    return numerator / denominator
+
+
+class EarlyStopping:
+    """
+    Criteria for ending a run before sim_time, checked after every step by
+    advance().
+
+    With `extinction`, the run stops as soon as the phage (free phage and
+    infected cells) or the cells (healthy and infected) are gone, since
+    nothing but phage decay and cell growth can happen afterwards.
+
+    With `rtol`, both phases of the run end adaptively, in windows of
+    `window` steps:
+
+    - The burn-in ends early, by moving params['burn_in'] to the current
+      step, once the phage, healthy cell, infected cell and debris counts
+      have stopped drifting: over the last `min_windows` windows, the mean
+      counts of the earlier and the later half must differ by less than two
+      standard errors of the window means, or by less than rtol.
+    - The measurement phase ends once the outputs in MEASURED have settled.
+      Each window gives one estimate of every output (batch means), and the
+      run stops when, for every output, the standard error of the mean of
+      at least `min_windows` estimates is within rtol of the mean.
+
+    The state is plain numbers, lists and dicts, so it can be saved with a
+    checkpoint.
+    """
+    # Running counts followed during the burn-in
+    STATE = ('phage', 'healthy', 'infected', 'debris')
+    # Outputs that must settle, as (numerator, denominator) totals
+    MEASURED = {
+        'alphab': ('alphab', 'alphab_steps'),
+        'p2c': ('lost_to_primary_infection', 'burst_total'),
+        'p2ic': ('lost_to_secondary_infection', 'burst_total'),
+        'p2eps': ('lost_to_eps', 'burst_total'),
+        'cells_with_eps': ('healthy_cell_eps', 'healthy_cell_total'),
+        'phage_with_eps': ('phage_with_eps', 'phage_with_eps_steps'),
+    }
+
+    def __init__(self, extinction=True, rtol=None, window=250, min_windows=8):
+        self.extinction = extinction
+        self.rtol = rtol
+        self.window = window
+        self.min_windows = min_windows
+        # Burn-in: sums of the counts in the current window, and the means
+        # of the last min_windows complete windows
+        self.sums = dict.fromkeys(self.STATE, 0)
+        self.steps = 0
+        self.means = {key: [] for key in self.STATE}
+        # Measurement: totals at the end of the last window, and the
+        # estimates of every output from each window
+        self.totals = None
+        self.batches = {name: [] for name in self.MEASURED}
+
+    def update(self, time, params):
+        """
+        Take in the state after the step at `time`.
+
+        Return:
+            Reason to stop the run ('phage extinct', 'cells extinct' or
+            'converged'), or None to go on.
+        """
+        counts = params['counts']
+        if self.extinction:
+            if counts['phage'] + counts['infected'] == 0:
+                return 'phage extinct'
+            if counts['healthy'] + counts['infected'] == 0:
+                return 'cells extinct'
+        if self.rtol is None:
+            return None
+
+        if time <= params['burn_in']:
+            for key in self.STATE:
+                self.sums[key] += counts[key]
+            self.steps += 1
+            if self.steps < self.window:
+                return None
+            for key in self.STATE:
+                self.means[key].append(self.sums[key] / self.steps)
+                del self.means[key][:-self.min_windows]
+            self.sums = dict.fromkeys(self.STATE, 0)
+            self.steps = 0
+            if all(self._settled(means) for means in self.means.values()):
+                # Recording starts with the next step
+                params['burn_in'] = time
+            return None
+
+        output = params['output']
+        if output['recorded_steps'] % self.window != 0:
+            return None
+        totals = {key: float(output[key]) for pair in self.MEASURED.values()
+                  for key in pair if key in output}
+        totals['alphab_steps'] = float(output['recorded_steps'] -
+                                       output['alphab_skipped'])
+        totals['phage_with_eps_steps'] = float(
+            output['recorded_steps'] - output['phage_with_eps_skipped'])
+        # Totals start from zero when recording starts
+        previous = self.totals or dict.fromkeys(totals, 0)
+        for name, (numerator, denominator) in self.MEASURED.items():
+            change = totals[denominator] - previous[denominator]
+            if change > 0:
+                self.batches[name].append(
+                    (totals[numerator] - previous[numerator]) / change)
+        self.totals = totals
+        if self._converged():
+            return 'converged'
+        return None
+
+    def _settled(self, means):
+        # Whether a count shows no drift between the halves of its window
+        # means
+        if len(means) < max(self.min_windows, 4):
+            return False
+        half = len(means) // 2
+        earlier, later = means[:half], means[-half:]
+        difference = abs(np.mean(later) - np.mean(earlier))
+        error = np.sqrt((np.var(earlier, ddof=1) + np.var(later, ddof=1)) /
+                        half)
+        return difference <= max(2 * error, self.rtol *
+                                  max(abs(np.mean(earlier)),
+                                      abs(np.mean(later))))
+
+    def _converged(self):
+        for batch in self.batches.values():
+            if len(batch) < self.min_windows:
+                return False
+            error = np.std(batch, ddof=1) / np.sqrt(len(batch))
+            if error > self.rtol * abs(np.mean(batch)):
+                return False
+        return True
+
+
+# Grids in the frames of a recorded trajectory (see frame_grids())
+FRAME_FIELDS = ('phage', 'cells', 'infected', 'eps')
+
+
+def frame_grids(params):
+    # Grids of params to record in a trajectory frame, by FRAME_FIELDS name.
+    # Infected cells are the patches with a running lysis timer.
+    return {'phage': params['phage'], 'cells': params['cells'],
+            'infected': params['lysis'] > 0, 'eps': params['eps']}
+
+
+# Version of the model's results, part of the key of cached runs. Bump it
+# whenever a change alters the output of a run for a given seed.
+MODEL_VERSION = 2
+
+
+def run_simulation(eps,
+                   burst,
+                   decay=0,
+                   random_eps=True,
+                   sim_time=10000,
+                   burn_in=7000,
+                   rows=20,
+                   cols=20,
+                   engine='loop',
+                   rng=None,
+                   verbose=True,
+                   checkpoint=None,
+                   checkpoint_every=1000,
+                   stop_on_extinction=False,
+                   rtol=None,
+                   window=250,
+                   cache=None,
+                   recorder=None,
+                   profiler=None):
+    # With stop_on_extinction or rtol, the run may end before sim_time and
+    # the burn-in before burn_in (see EarlyStopping). output['stop_reason'],
+    # output['stop_time'] and output['burn_in'] record how the run went.
+    #
+    # Without an rng, the run draws from a new np.random.Generator. Pass
+    # np.random to draw from NumPy's global random state instead.
+    #
+    # With a cache.ResultCache as `cache`, the output is looked up by the
+    # parameters, the model version and the starting state of rng, and only
+    # computed if it is not there yet. The entry also holds the state rng
+    # was left in, which a cached run sets rng to, so runs drawing one after
+    # another from the same generator get the same outputs from the cache as
+    # they would computed.
+    #
+    # With a recorder.TrajectoryRecorder for FRAME_FIELDS as `recorder`, the
+    # grids are recorded as the run goes. Such runs are never cached.
+    #
+    # With a profiling.Profiler as `profiler`, the time and events of every
+    # phase of the steps are recorded, and its report is returned as
+    # output['profile']. Profiled runs are never cached either.
+    if rng is None:
+        rng = np.random.default_rng()
+    if cache is not None and recorder is None and profiler is None:
+        args = dict(locals(), cache=None)
+        parts = {key: value for key, value in args.items()
+                 if key not in ('rng', 'verbose', 'checkpoint',
+                                'checkpoint_every', 'cache')}
+        # The active engine gives the same results as the loop engine
+        if engine == 'active':
+            parts['engine'] = 'loop'
+        key = cache.key(model='heilmann', version=MODEL_VERSION,
+                        rng=_rng_state(rng), **parts)
+        output = cache.get(key)
+        # Entries from before the rng state was stored are run again
+        if output is None or 'rng_after' not in output:
+            output = run_simulation(**args)
+            cache.put(key, dict(output, rng_after=_rng_state(rng)))
+        else:
+            _set_rng_state(rng, output.pop('rng_after'))
+        return output
+
+    params = make_params(eps, burst, decay=decay, random_eps=random_eps,
+                         burn_in=burn_in, rows=rows, cols=cols, rng=rng)
+    if verbose:
+        print(params['eps'])
+    if engine == 'active':
+        params['active'] = active_patches(params['phage'], params['cells'],
+                                          params['lysis'])
+    stopping = None
+    if stop_on_extinction or rtol is not None:
+        stopping = EarlyStopping(extinction=stop_on_extinction, rtol=rtol,
+                                 window=window)
+
+    return advance(params, 0, sim_time, engine, verbose=verbose,
+                   checkpoint=checkpoint, checkpoint_every=checkpoint_every,
+                   stopping=stopping, recorder=recorder, profiler=profiler)
+
+
+def advance(params, time, sim_time, engine, verbose=True, checkpoint=None,
+            checkpoint_every=1000, stopping=None, recorder=None,
+            profiler=None):
+    # Run the simulation in params from `time` up to `sim_time`, or until
+    # the EarlyStopping `stopping` ends it, saving the full state to the file
+    # `checkpoint` every `checkpoint_every` steps, passing the grids at the
+    # start of every step, and at the end, to `recorder`, and the phases of
+    # every step to `profiler`
+    step = ENGINES[engine]
+    if isinstance(params['rng'], streams.Streams) and engine != 'vectorized':
+        raise ValueError("Keyed random streams need the vectorized engine")
+
+    reason = 'sim_time'
     while time < sim_time:
-        iterate(time, **params)
+        if recorder is not None and recorder.due(time):
+            recorder.record(time, frame_grids(params))
+        if profiler is None:
+            step(time, **params)
+        else:
+            profiler.start()
+            step(time, profiler=profiler, **params)
+            profiler.step(time)
+        if stopping is not None:
+            stop = stopping.update(time, params)
+            if stop is not None:
+                reason = stop
+                time += params['delta_t']
+                break
         time += params['delta_t']
+        if checkpoint is not None and time % checkpoint_every == 0 and \
+                time < sim_time:
+            save_checkpoint(checkpoint, params, time, sim_time, engine,
+                            stopping)
 
-    try:
-        params['output']['phage_final'] = np.sum(params['phage'])
-        params['output']['total_cells_final'] = np.sum(params['cells'])
-        params['output']['alphab_avg'] = params['output']['alphab'] / \
-                                         (sim_time - burn_in)
-        # params['output']['cells_with_eps'] = params['output']['cells_with_eps'] / (sim_time - burn_in)
-        params['output']['cells_with_eps'] = params['output']['healthy_cell_eps'] / params['output']['healthy_cell_total']
-        params['output']['phage_with_eps'] = params['output']['phage_with_eps'] / (sim_time - burn_in)
-        # params['output']['infection_with_eps'] = params['output']['infection_with_eps'] / (sim_time - burn_in)
-        params['output']['infection_with_eps'] = params['output']['infection_with_eps'] / params['output']['infection_total']
-        params['output']['p2c'] = params['output']['lost_to_primary_infection'] / \
-            params['output']['burst_total']
-        params['output']['p2ic'] = params['output']['lost_to_secondary_infection']/\
-            params['output']['burst_total']
-        params['output']['p2eps'] = params['output']['lost_to_eps']/\
-            params['output']['burst_total']
-        params['output']['p2debris'] = params['output']['lost_to_debris']/\
-            params['output']['burst_total']
-    except:
-        params['output']['phage_final'] = np.sum(params['phage'])
-        params['output']['total_cells_final'] = np.sum(params['cells'])
-        params['output']['alphab_avg'] = params['output']['alphab'] / \
-                                         (sim_time - burn_in)
-        params['output']['p2c'] = 0
-        params['output']['p2ic'] = 0
-        params['output']['p2eps'] = 0
-        params['output']['p2debris'] = 0
-    print(params['phage'])
-    print(params['cells'])
+    if recorder is not None and recorder.due(time):
+        recorder.record(time, frame_grids(params))
+    params['output'].update(stop_reason=reason, stop_time=time,
+                            burn_in=params['burn_in'])
+    summarize(params['output'], params['phage'], params['cells'])
+    if profiler is not None:
+        params['output']['profile'] = profiler.report()
+    if verbose:
+        print(params['phage'])
+        print(params['cells'])
     return params['output']
 
 
+def resume(checkpoint, verbose=True, checkpoint_every=1000, recorder=None,
+           profiler=None):
+    """
+    Continue a run_simulation() run from a file written with its
+    `checkpoint` argument, and return its output.
+
+    The run picks up exactly where the checkpoint was taken, including the
+    state of its random number generator, so the output is identical to that
+    of the uninterrupted run. Checkpoints keep being written to the same
+    file, the rest of the trajectory to `recorder` and the phases of the
+    remaining steps to `profiler`, if given.
+    """
+    params, time, sim_time, engine, stopping = load_checkpoint(checkpoint)
+    return advance(params, time, sim_time, engine, verbose=verbose,
+                   checkpoint=checkpoint, checkpoint_every=checkpoint_every,
+                   stopping=stopping, recorder=recorder, profiler=profiler)
+
+
+def save_checkpoint(path, params, time, sim_time, engine, stopping=None):
+    """
+    Save the full state of a run to a compressed .npz file at `path`.
+
+    Grids and the row/column visiting orders are stored as arrays, the
+    grids in BIT_GRIDS packed 8 patches to a byte, and everything else
+    (parameters, output, running counts, the loop time and the random number
+    generator state, and that of the EarlyStopping `stopping`, if any) as
+    JSON. Timer wheels and the active set are rebuilt from the grids on
+    loading. The file is written to a temporary name first, so an
+    interrupted save never corrupts the previous checkpoint.
+    """
+    arrays = {}
+    meta = {'time': time, 'sim_time': sim_time, 'engine': engine,
+            'rng': _rng_state(params['rng']), 'params': {},
+            'stopping': None if stopping is None else vars(stopping)}
+    for key, value in params.items():
+        if key in ('rng', 'lysis_timers', 'debris_timers', 'active'):
+            continue
+        elif key in BIT_GRIDS:
+            arrays[key] = np.packbits(value.astype(bool), axis=-1)
+            meta[key + '_shape'] = value.shape
+        elif isinstance(value, np.ndarray):
+            arrays[key] = value
+        elif key in ('random_rows', 'random_cols'):
+            arrays[key] = np.array(value)
+        elif key in ('output', 'counts'):
+            meta[key] = value
+        else:
+            meta['params'][key] = value
+
+    temp = path + '.tmp'
+    with open(temp, 'wb') as f:
+        np.savez_compressed(f, meta=np.array(json.dumps(meta, default=_json)),
+                            **arrays)
+    os.replace(temp, path)
+
+
+def load_checkpoint(path):
+    """
+    Load a file written by save_checkpoint().
+
+    Return:
+        params dict ready for the engines, loop time, simulation length,
+        engine name and EarlyStopping (or None).
+    """
+    with np.load(path) as data:
+        meta = json.loads(str(data['meta']))
+        params = meta['params']
+        for key in data.files:
+            if key != 'meta':
+                params[key] = data[key]
+    for key in BIT_GRIDS:
+        shape = meta.get(key + '_shape')
+        if shape is not None:
+            params[key] = np.unpackbits(
+                params[key], axis=-1, count=shape[-1]).astype(
+                    GRID_DTYPES[key]).reshape(shape)
+    params['random_rows'] = params['random_rows'].tolist()
+    params['random_cols'] = params['random_cols'].tolist()
+    params['output'] = meta['output']
+    params['counts'] = meta['counts']
+    params['rng'] = _restore_rng(meta['rng'])
+
+    # Every pending timer is stored in the grids as its mark
+    params['lysis_timers'] = TimerWheel(params['lysis_time'] + 1)
+    params['debris_timers'] = TimerWheel(params['decay_time'] + 1)
+    for key in ('lysis', 'debris'):
+        timers = params[key + '_timers']
+        grid = params[key]
+        if grid.dtype != GRID_DTYPES[key]:
+            # Older checkpoints hold the step a timer is due, or -1
+            grid = np.where(grid > 0, timers.mark(grid), 0).astype(
+                GRID_DTYPES[key])
+            params[key] = grid
+        timers.restore(grid)
+    if meta['engine'] == 'active':
+        params['active'] = active_patches(params['phage'], params['cells'],
+                                          params['lysis'])
+    stopping = None
+    if meta.get('stopping') is not None:
+        stopping = EarlyStopping()
+        vars(stopping).update(meta['stopping'])
+    return params, meta['time'], meta['sim_time'], meta['engine'], stopping
+
+
+def _rng_state(rng):
+    if isinstance(rng, streams.Streams):
+        return {'kind': 'streams', 'entropy': rng.sequence.entropy,
+                'spawn_key': rng.sequence.spawn_key}
+    elif rng is np.random:
+        return {'kind': 'global', 'state': np.random.get_state(legacy=False)}
+    elif isinstance(rng, np.random.RandomState):
+        return {'kind': 'random_state', 'state': rng.get_state(legacy=False)}
+    return {'kind': 'generator', 'state': rng.bit_generator.state}
+
+
+def _set_rng_state(rng, saved):
+    # Put rng in a state saved by _rng_state(). Streams have no state.
+    if saved['kind'] == 'global':
+        np.random.set_state(saved['state'])
+    elif saved['kind'] == 'random_state':
+        rng.set_state(saved['state'])
+    elif saved['kind'] == 'generator':
+        rng.bit_generator.state = saved['state']
+
+
+def _restore_rng(saved):
+    if saved['kind'] == 'streams':
+        return streams.Streams(np.random.SeedSequence(
+            saved['entropy'], spawn_key=saved['spawn_key']))
+    elif saved['kind'] == 'global':
+        np.random.set_state(saved['state'])
+        return np.random
+    elif saved['kind'] == 'random_state':
+        rng = np.random.RandomState()
+        rng.set_state(saved['state'])
+        return rng
+    bit_generator = getattr(np.random, saved['state']['bit_generator'])()
+    bit_generator.state = saved['state']
+    return np.random.Generator(bit_generator)
+
+
+def _json(value):
+    # Convert NumPy values for json.dumps()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    elif isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Cannot save {!r} in a checkpoint".format(value))
+
+
+def run_ensemble(eps,
+                 burst,
+                 replicates,
+                 decay=0,
+                 random_eps=True,
+                 sim_time=10000,
+                 burn_in=7000,
+                 rows=20,
+                 cols=20,
+                 rng=None):
+    """
+    Run `replicates` independent replicates of one parameter set together.
+
+    The replicate grids are stacked into arrays of shape (replicates, rows,
+    cols) and advanced with a single call to iterate_vectorized() per time
+    step, so the per-step Python overhead is shared by all replicates. With
+    a streams.Streams as rng, the first replicate is the same run as
+    run_simulation() with the vectorized engine and the same streams.
+
+    Returns a dict with the list of per-replicate output dicts, as returned
+    by run_simulation(), under 'replicates', and the mean and variance of
+    every output value across replicates under 'mean' and 'variance'.
+    """
+    params = make_params(eps, burst, decay=decay, random_eps=random_eps,
+                         burn_in=burn_in, rows=rows, cols=cols, rng=rng,
+                         replicates=replicates)
+
+    time = 0
+
+    while time < sim_time:
+        iterate_vectorized(time, **params)
+        time += params['delta_t']
+
+    outputs = []
+    for r in range(replicates):
+        # Split the stacked counters into plain numbers for each replicate
+        output = {key: np.broadcast_to(value, (replicates,))[r].item()
+                  for key, value in params['output'].items()}
+        outputs.append(summarize(output, params['phage'][r],
+                                 params['cells'][r]))
+    ddof = 1 if replicates > 1 else 0
+    return {
+        'replicates': outputs,
+        'mean': {key: np.mean([o[key] for o in outputs])
+                 for key in outputs[0]},
+        'variance': {key: np.var([o[key] for o in outputs], ddof=ddof)
+                     for key in outputs[0]},
+    }
+
+
+HEADER = "EPS\tburst\talpha-b\tp->c\tp->ic\tp->eps\tC:E/C\tP:E/P\tI:E/I"
+
+
+def format_row(eps, burst, output):
+    # One line of a results table, in the same columns as HEADER
+    return "{:}\t{:}\t{:0.2f}\t{:0.2f}\t{:0.2f}\t{:0.2f}\t{:0.2f}\t{:0.2f}\t{:0.2f}".format(eps, burst, output['alphab_avg'], output['p2c'], output['p2ic'], output['p2eps'], output['cells_with_eps'], output['phage_with_eps'], output['infection_with_eps'])
+
+
 def main():
     burst_sizes = [2, 6, 10, 20, 40, 60]
     eps_list = [0.1, 0.3, 0.6, 0.9]
-    print("EPS\tburst\talpha-b\tp->c\tp->ic\tp->eps\tC:E/C\tP:E/P\tI:E/I")
-    # output = run_simulation(0.1, 2)
-    # for burst in burst_sizes:
-    #     for eps in eps_list:
-    #         for i in range(3):
+    print(HEADER)
+    # For the full burst_sizes x eps_list table, with replicates spread over
+    # several processes, use sweep.py, and for other runs of either model
+    # a job file for jobs.py
     eps = 0.9
     burst = 20
     output = run_simulation(eps=0.9, burst=40, random_eps=True)
-    print("{:}\t{:}\t{:0.2f}\t{:0.2f}\t{:0.2f}\t{:0.2f}\t{:0.2f}\t{:0.2f}\t{:0.2f}".format(eps, burst, output['alphab_avg'], output['p2c'], output['p2ic'], output['p2eps'], output['cells_with_eps'], output['phage_with_eps'], output['infection_with_eps']))
+    print(format_row(eps, burst, output))
     sys.stdout.flush()
 
 
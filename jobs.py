@@ -0,0 +1,403 @@
+#! /usr/bin/env python3
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import inspect
+import itertools
+import json
+import os
+import sys
+import time
+import traceback
+
+import numpy as np
+
+import cache
+import gillespie_multi_particle
+import heilmann
+import sweep
+
+'''
+Runs batches of simulations of either model described by a job file, on a
+local work queue of worker processes.
+
+A job file is TOML, JSON or YAML (YAML needs PyYAML). It names the model
+and gives the arguments of its run function, heilmann.run_simulation or
+gillespie_multi_particle.run_plate: fixed ones under `params`, and lists of
+values under `sweep`, which are expanded into one task per combination and
+replicate:
+
+    model = "heilmann"
+    seed = 1234
+    replicates = 3
+    workers = 8
+    retries = 2
+    output = "results.jsonl"
+
+    [params]
+    engine = "vectorized"
+    sim_time = 10000
+    burn_in = 7000
+
+    [sweep]
+    eps = [0.1, 0.3, 0.6, 0.9]
+    burst = [2, 6, 10, 20, 40, 60]
+
+Both models take an `engine` parameter: one of heilmann.ENGINES, or one of
+gillespie_multi_particle.ENGINES for the GMP model ('lockstep', 'patch',
+'tau', 'tiled' or 'nsm').
+
+Several experiments can share a file as a `jobs` list, each entry with its
+own model, params, sweep and replicates on top of those at the top level.
+The top level may also set `cache` and `cache_size`, as for sweep.py.
+
+Every task is seeded from the file's seed, its parameters and its replicate
+number, as in sweep.py, so a batch gives the same results whatever the
+number of workers or retries. Results are written as JSON lines, one per
+task as it finishes, holding the task number, model, parameters, seed and
+output. A failed task is put back on the queue up to `retries` times, and a
+pool whose worker died is replaced. Progress, tasks per second and the time
+left are reported on stderr as the batch runs:
+
+    python3 jobs.py experiment.toml --workers 16
+'''
+
+# Run function of each model
+MODELS = {'heilmann': heilmann.run_simulation,
+          'gmp': gillespie_multi_particle.run_plate}
+
+# Run function arguments set by the driver rather than by job files
+RESERVED = ('rng', 'seed', 'verbose', 'checkpoint', 'checkpoint_every',
+            'cache', 'recorder', 'profiler')
+
+# Keys of a job file, at the top level and in the entries of `jobs`
+SETTINGS = ('seed', 'workers', 'retries', 'output', 'cache', 'cache_size')
+JOB_KEYS = ('model', 'params', 'sweep', 'replicates')
+
+
+def load_config(path):
+    """
+    Read a job file, as TOML, JSON or YAML by its extension.
+
+    Return:
+        Dict of the file's contents.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            # Before Python 3.11
+            import tomli as tomllib
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    elif extension == '.json':
+        with open(path) as f:
+            return json.load(f)
+    elif extension in ('.yaml', '.yml'):
+        import yaml
+
+        with open(path) as f:
+            return yaml.safe_load(f)
+    raise ValueError("Unknown job file type {!r}, expected .toml, .json, "
+                     ".yaml or .yml".format(extension))
+
+
+def make_tasks(config):
+    """
+    Expand a job file into one task per parameter combination and
+    replicate.
+
+    Tasks are ordered by job, then by combination of the sweep values, with
+    the first key of `sweep` as the outermost loop, and finally by
+    replicate.
+
+    Args:
+        config: Dict read by load_config().
+
+    Return:
+        List of task dicts, each holding the model name under 'model' and
+        the keyword arguments of its run function.
+    """
+    unknown = set(config) - set(SETTINGS) - set(JOB_KEYS) - {'jobs'}
+    if unknown:
+        raise ValueError("Unknown job file keys: {}".format(
+            ', '.join(sorted(unknown))))
+    defaults = {key: config[key] for key in JOB_KEYS if key in config}
+    tasks = []
+    for job in config.get('jobs', [{}]):
+        unknown = set(job) - set(JOB_KEYS)
+        if unknown:
+            raise ValueError("Unknown job keys: {}".format(
+                ', '.join(sorted(unknown))))
+        model = job.get('model', defaults.get('model'))
+        if model not in MODELS:
+            raise ValueError("Unknown model {!r}, expected one of {}".format(
+                model, sorted(MODELS)))
+        params = dict(defaults.get('params', {}), **job.get('params', {}))
+        values = dict(defaults.get('sweep', {}), **job.get('sweep', {}))
+        replicates = job.get('replicates', defaults.get('replicates', 1))
+        for combination in itertools.product(*values.values()):
+            task = dict(params, **dict(zip(values, combination)))
+            check_params(model, task)
+            for _ in range(replicates):
+                tasks.append(dict(task, model=model))
+    return tasks
+
+
+def check_params(model, params):
+    """
+    Check that params are a full set of arguments of the run function of
+    `model`, so that a mistake in a job file fails before any task runs.
+    """
+    signature = inspect.signature(MODELS[model])
+    unknown = [name for name in params
+               if name not in signature.parameters or name in RESERVED]
+    if unknown:
+        raise ValueError("Unknown {} parameters: {}".format(
+            model, ', '.join(unknown)))
+    missing = [name for name, parameter in signature.parameters.items()
+               if parameter.default is inspect.Parameter.empty and
+               name not in params]
+    if missing:
+        raise ValueError("Missing {} parameters: {}".format(
+            model, ', '.join(missing)))
+
+
+def run_task(task, seed, cache_dir=None, cache_size=None):
+    """
+    Run a single task with random numbers drawn from `seed`.
+
+    Args:
+        task: Task dict from make_tasks().
+        seed: np.random.SeedSequence of the task.
+        cache_dir, cache_size: Directory and size limit in MB of a
+            cache.ResultCache to look the run up in, or None.
+
+    Return:
+        Dict of the task's output and the seconds it took.
+    """
+    start = time.perf_counter()
+    params = {key: value for key, value in task.items() if key != 'model'}
+    result_cache = None
+    if cache_dir is not None:
+        max_bytes = None
+        if cache_size is not None:
+            max_bytes = int(cache_size * 2**20)
+        result_cache = cache.ResultCache(cache_dir, max_bytes=max_bytes)
+    if task['model'] == 'heilmann':
+        output = heilmann.run_simulation(rng=np.random.default_rng(seed),
+                                         verbose=False, cache=result_cache,
+                                         **params)
+    else:
+        result = gillespie_multi_particle.run_plate(seed=seed,
+                                                    cache=result_cache,
+                                                    **params)
+        # Keep the totals of each species rather than the whole plate
+        output = {name: int(np.sum(counts)) for name, counts in zip(
+            gillespie_multi_particle.Plate.species, result['state'])}
+        output.update(time=result['time'], phage_iter=result['phage_iter'],
+                      cell_iter=result['cell_iter'])
+    return {'output': output, 'seconds': time.perf_counter() - start}
+
+
+class Progress:
+    """
+    Reports the progress of a batch, its throughput and the time left.
+
+    Attributes:
+        total: Number of tasks in the batch.
+        every: Seconds between reports.
+        file: File object reports are written to.
+    """
+    def __init__(self, total, every=10, file=sys.stderr):
+        self.total = total
+        self.every = every
+        self.file = file
+        self._start = self._reported = time.monotonic()
+        self._last = None
+
+    def update(self, done, failed, retried, force=False):
+        """
+        Write a report if one is due, or if force is set and the counts
+        changed since the last one.
+
+        Args:
+            done: Tasks finished so far.
+            failed: Tasks that failed for good.
+            retried: Failed attempts that were put back on the queue.
+        """
+        now = time.monotonic()
+        counts = (done, failed, retried)
+        if force:
+            # No need to repeat the last report
+            if counts == self._last:
+                return
+        elif now - self._reported < self.every:
+            return
+        self._reported = now
+        self._last = counts
+        elapsed = now - self._start
+        rate = done / elapsed if elapsed > 0 else 0
+        left = self.total - done - failed
+        eta = _duration(left / rate) if rate > 0 else '?'
+        print("[jobs] {}/{} tasks done, {} retried, {} failed | {:.3g} "
+              "tasks/s | {} elapsed, {} left".format(
+                  done, self.total, retried, failed, rate,
+                  _duration(elapsed), eta), file=self.file)
+        self.file.flush()
+
+
+def _duration(seconds):
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+def run_tasks(tasks, out=sys.stdout, seed=None, workers=None, retries=2,
+              cache_dir=None, cache_size=None, progress=None):
+    """
+    Run tasks on a work queue of worker processes and write a JSON line per
+    task to `out` as it finishes.
+
+    At most two tasks per worker are handed to the pool at a time, and the
+    rest wait on the queue, so failed tasks go back to the end of it. If a
+    worker dies, the tasks running in the pool count as failed attempts and
+    a new pool takes over the queue.
+
+    Args:
+        tasks: Tasks from make_tasks().
+        out: File object the results are written to.
+        seed: Entropy for the root np.random.SeedSequence. If None, fresh
+            entropy is drawn and reported on stderr.
+        workers: Number of worker processes (defaults to the number of CPUs).
+        retries: Times a failed task is run again before it is given up.
+        cache_dir, cache_size: As for run_task().
+        progress: Progress to report to, or None.
+
+    Return:
+        List of the numbers of the tasks that failed for good.
+    """
+    root = np.random.SeedSequence(seed)
+    if seed is None:
+        print("Jobs seed: {}".format(root.entropy), file=sys.stderr)
+    seeds = sweep.job_seeds(root, tasks)
+    if workers is None:
+        workers = os.cpu_count()
+
+    queue = collections.deque(range(len(tasks)))
+    attempts = [0] * len(tasks)
+    failed = []
+    done = retried = 0
+    while queue:
+        broken = False
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers) as pool:
+            running = {}
+            while running or (queue and not broken):
+                while queue and not broken and len(running) < 2 * workers:
+                    index = queue.popleft()
+                    try:
+                        future = pool.submit(run_task, tasks[index],
+                                             seeds[index], cache_dir,
+                                             cache_size)
+                    except concurrent.futures.process.BrokenProcessPool:
+                        # A worker died since the last results came in
+                        queue.appendleft(index)
+                        broken = True
+                        break
+                    running[future] = index
+                finished, _ = concurrent.futures.wait(
+                    running, timeout=None if progress is None else
+                    progress.every,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    index = running.pop(future)
+                    attempts[index] += 1
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        if isinstance(
+                                error,
+                                concurrent.futures.process.BrokenProcessPool):
+                            broken = True
+                        print("[jobs] task {} failed (attempt {}):\n{}".format(
+                            index, attempts[index],
+                            ''.join(traceback.format_exception(
+                                type(error), error, error.__traceback__))),
+                            file=sys.stderr)
+                        if attempts[index] <= retries:
+                            queue.append(index)
+                            retried += 1
+                        else:
+                            failed.append(index)
+                        continue
+                    record = {'task': index, 'model': tasks[index]['model'],
+                              'params': {key: value for key, value in
+                                         tasks[index].items()
+                                         if key != 'model'},
+                              'seed': seeds[index],
+                              'attempts': attempts[index]}
+                    record.update(result)
+                    print(json.dumps(record, default=cache._json), file=out)
+                    out.flush()
+                    done += 1
+                if progress is not None:
+                    progress.update(done, len(failed), retried)
+    if progress is not None:
+        progress.update(done, len(failed), retried, force=True)
+    return sorted(failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the tasks of a job file on a pool of workers.")
+    parser.add_argument('job_file', help="TOML, JSON or YAML job file")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="worker processes (default: the job file's, "
+                             "or the number of CPUs)")
+    parser.add_argument('--retries', type=int, default=None,
+                        help="times a failed task is run again "
+                             "(default: the job file's, or 2)")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="root seed (default: the job file's)")
+    parser.add_argument('-o', '--output', default=None,
+                        help="JSON lines file to write (default: the job "
+                             "file's, or stdout)")
+    parser.add_argument('--report-every', type=float, default=10,
+                        help="seconds between progress reports")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="print the tasks instead of running them")
+    args = parser.parse_args()
+
+    config = load_config(args.job_file)
+    tasks = make_tasks(config)
+    if args.dry_run:
+        for index, task in enumerate(tasks):
+            print(index, json.dumps(task))
+        return
+
+    def setting(name, default):
+        value = getattr(args, name)
+        return config.get(name, default) if value is None else value
+
+    output = setting('output', None)
+    out = open(output, 'w') if output else sys.stdout
+    try:
+        failed = run_tasks(tasks, out=out, seed=setting('seed', None),
+                           workers=setting('workers', None),
+                           retries=setting('retries', 2),
+                           cache_dir=config.get('cache'),
+                           cache_size=config.get('cache_size'),
+                           progress=Progress(len(tasks), args.report_every))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if failed:
+        print("{} task(s) failed: {}".format(
+            len(failed), ' '.join(map(str, failed))), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
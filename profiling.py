@@ -0,0 +1,119 @@
+import sys
+import time
+
+'''
+Optional instrumentation of the simulation loops.
+
+A Profiler passed to heilmann.run_simulation (or advance, resume and the
+engines) or to gillespie_multi_particle.Plate and run_plate records the wall
+time spent in every phase of a step and counts the events of every phase.
+Without one, the loops only test `profiler is not None` at phase boundaries.
+
+Time is measured with a running stopwatch: lap(name) charges the time since
+the previous lap to phase `name`, so the phases of a step add up to its
+whole duration. The patch-by-patch Heilmann engines lap several times per
+patch, so their timings include the cost of reading the clock, which makes
+them slower overall while profiled but keeps the split between phases
+meaningful.
+
+The report is a plain dict, stored as output['profile'] by the models:
+
+    {'steps': 1000, 'seconds': 12.5,
+     'phases': {'replication': {'seconds': 4.1, 'fraction': 0.33}, ...},
+     'events': {'replications': 2031, 'phage moved': 151203, ...}}
+
+With log_every set, a line summarising the last log_every steps is written
+to `file` as the run goes.
+'''
+
+
+class Profiler:
+    """
+    Per-phase wall time and event counts of a run.
+
+    Attributes:
+        seconds: Dict from phase name to the seconds spent in it.
+        events: Dict from event name to its count.
+        steps: Number of steps taken.
+        log_every: Steps between log lines, or None for no logging.
+        file: File object log lines are written to.
+    """
+    def __init__(self, log_every=None, file=sys.stderr):
+        self.seconds = {}
+        self.events = {}
+        self.steps = 0
+        self.log_every = log_every
+        self.file = file
+        self._last = time.perf_counter()
+        # Totals at the last log line
+        self._logged = (self._last, 0, {}, {})
+
+    def start(self):
+        """
+        Restart the stopwatch, so that the time since the last lap is not
+        charged to any phase.
+        """
+        self._last = time.perf_counter()
+
+    def lap(self, phase):
+        """
+        Charge the time since the last lap (or start()) to `phase`.
+        """
+        now = time.perf_counter()
+        self.seconds[phase] = self.seconds.get(phase, 0) + now - self._last
+        self._last = now
+
+    def count(self, event, number=1):
+        """
+        Add `number` events of kind `event`.
+        """
+        self.events[event] = self.events.get(event, 0) + number
+
+    def step(self, label=None):
+        """
+        Mark the end of a step, and write a log line if one is due.
+
+        Args:
+            label: Time of the step, to show in the log line.
+        """
+        self.steps += 1
+        if self.log_every and self.steps % self.log_every == 0:
+            self.log(label)
+
+    def log(self, label=None):
+        """
+        Write a line with the steps per second, the share of each phase and
+        the events since the last line.
+        """
+        now = time.perf_counter()
+        last, steps, seconds, events = self._logged
+        elapsed = sum(self.seconds.values()) - sum(seconds.values())
+        phases = ' '.join(
+            '{} {:.0%}'.format(phase, (total - seconds.get(phase, 0)) /
+                               elapsed)
+            for phase, total in self.seconds.items()) if elapsed > 0 else ''
+        counts = ' '.join(
+            '{}={}'.format(event, int(total - events.get(event, 0)))
+            for event, total in self.events.items())
+        print("[profile] step {}: {:.4g} steps/s | {} | {}".format(
+            self.steps if label is None else round(label, 6),
+            (self.steps - steps) / (now - last),
+            phases, counts), file=self.file)
+        self._logged = (now, self.steps, dict(self.seconds),
+                        dict(self.events))
+
+    def report(self):
+        """
+        Get the structured report of the run so far (see the module
+        docstring).
+        """
+        total = sum(self.seconds.values())
+        return {
+            'steps': self.steps,
+            'seconds': total,
+            'phases': {phase: {'seconds': seconds,
+                               'fraction': seconds / total if total else 0}
+                       for phase, seconds in self.seconds.items()},
+            'events': {event: int(count)
+                       for event, count in self.events.items()},
+        }
@@ -0,0 +1,192 @@
+import json
+import os
+
+import numpy as np
+
+'''
+Trajectory recording for both models.
+
+A TrajectoryRecorder writes snapshots of named grids (phage, cells, ...) to
+a directory as the simulation runs. Frames go into chunk files of `chunk`
+frames each, preallocated as memory-mapped .npy files, so a run of any
+length is recorded in constant memory. A frame is taken whenever the
+simulation time has advanced by `interval` since the last one: every k-th
+step of the Heilmann model, or every interval of plate time of the GMP
+model.
+
+A Trajectory reads a recorded directory back without loading it, for
+analysis or animation:
+
+    trajectory = Trajectory('run')
+    for time, frame in zip(trajectory.times, trajectory):
+        phage = frame[trajectory.fields.index('phage')]
+
+The directory holds meta.json, describing the fields, grid shape and number
+of frames, and for every chunk a frames-NNNNN.npy of shape (chunk, fields,
+rows, cols) and a times-NNNNN.npy of the simulation time of every frame.
+'''
+
+
+class TrajectoryRecorder:
+    """
+    Records grids at regular intervals of simulation time into
+    memory-mapped chunk files.
+
+    Attributes:
+        directory: Directory the trajectory is written to.
+        fields: Names of the grids in every frame, in order.
+        shape: Shape of every grid.
+        interval: Simulation time between frames.
+        chunk: Frames per chunk file.
+        dtype: Data type the grids are stored as.
+        frames: Number of frames recorded.
+    """
+    def __init__(self, directory, fields, shape, interval=1, chunk=256,
+                 dtype=np.int32):
+        self.directory = directory
+        self.fields = list(fields)
+        self.shape = tuple(shape)
+        self.interval = interval
+        self.chunk = chunk
+        self.dtype = np.dtype(dtype)
+        self.frames = 0
+        # Time at which the next frame is due
+        self._due = None
+        self._grids = None
+        self._times = None
+        os.makedirs(directory, exist_ok=True)
+        self._write_meta()
+
+    def due(self, time):
+        """
+        Whether a frame is due at `time`, so that callers only build the
+        grids of the frames that are recorded.
+        """
+        return self._due is None or time >= self._due
+
+    def record(self, time, grids):
+        """
+        Record the grids as a frame at `time` if a frame is due.
+
+        Args:
+            time: Current simulation time.
+            grids: Mapping from every name in fields to its grid.
+
+        Return:
+            Whether a frame was recorded.
+        """
+        if not self.due(time):
+            return False
+        index = self.frames % self.chunk
+        if index == 0:
+            self._open_chunk(self.frames // self.chunk)
+        for position, name in enumerate(self.fields):
+            self._grids[index, position] = grids[name]
+        self._times[index] = time
+        self.frames += 1
+        self._due = time + self.interval
+        if self.frames % self.chunk == 0:
+            self._write_meta()
+        return True
+
+    def _open_chunk(self, number):
+        """
+        Preallocate the files of a chunk, after flushing the current one.
+        """
+        self._flush()
+        self._grids = np.lib.format.open_memmap(
+            _chunk_path(self.directory, 'frames', number), mode='w+',
+            dtype=self.dtype,
+            shape=(self.chunk, len(self.fields)) + self.shape)
+        self._times = np.lib.format.open_memmap(
+            _chunk_path(self.directory, 'times', number), mode='w+',
+            dtype=np.float64, shape=(self.chunk,))
+
+    def _flush(self):
+        if self._grids is not None:
+            self._grids.flush()
+            self._times.flush()
+
+    def _write_meta(self):
+        """
+        Write meta.json, through a temporary file so that it is never
+        partial.
+        """
+        meta = {'fields': self.fields, 'shape': self.shape,
+                'dtype': self.dtype.str, 'interval': self.interval,
+                'chunk': self.chunk, 'frames': self.frames}
+        path = os.path.join(self.directory, 'meta.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        """
+        Flush the frames to disk and record their number.
+        """
+        self._flush()
+        self._grids = self._times = None
+        self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Trajectory:
+    """
+    Read-only view of a trajectory written by TrajectoryRecorder. Frames
+    are read from the memory-mapped chunk files on access.
+
+    Attributes:
+        directory: Directory of the trajectory.
+        fields: Names of the grids in every frame, in order.
+        shape: Shape of every grid.
+        times: Simulation time of every frame.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        self.fields = meta['fields']
+        self.shape = tuple(meta['shape'])
+        self.chunk = meta['chunk']
+        self._frames = meta['frames']
+        self._chunks = {}
+        chunks = -(-self._frames // self.chunk)
+        self.times = np.concatenate(
+            [np.load(_chunk_path(directory, 'times', number))
+             for number in range(chunks)] or [np.zeros(0)])[:self._frames]
+
+    def __len__(self):
+        return self._frames
+
+    def __getitem__(self, index):
+        """
+        Get frame `index`, of shape (fields, rows, cols).
+        """
+        if index < 0:
+            index += self._frames
+        if not 0 <= index < self._frames:
+            raise IndexError("Frame {} out of range".format(index))
+        number, offset = divmod(index, self.chunk)
+        if number not in self._chunks:
+            self._chunks[number] = np.load(
+                _chunk_path(self.directory, 'frames', number), mmap_mode='r')
+        return self._chunks[number][offset]
+
+    def __iter__(self):
+        for index in range(self._frames):
+            yield self[index]
+
+    def grid(self, name, index):
+        """
+        Get the grid `name` of frame `index`.
+        """
+        return self[index][self.fields.index(name)]
+
+
+def _chunk_path(directory, kind, number):
+    return os.path.join(directory, '{}-{:05d}.npy'.format(kind, number))
@@ -0,0 +1,309 @@
+#! /usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import os
+import shutil
+import subprocess
+
+import numpy as np
+
+import recorder
+
+'''
+Renders recorded trajectories (see recorder.py) to animations.
+
+Frames are drawn by a pool of worker processes. Every worker builds one
+figure with one image per field when it starts and only swaps the data of
+those images from frame to frame, so no figure is rebuilt. Finished frames
+come back in order and are written straight to the output:
+
+    output.gif  an animated GIF, written with Pillow
+    output.mp4  a video (or any other extension ffmpeg knows), piped to ffmpeg
+    output/     a directory of numbered PNGs, written by the workers
+
+Rendering happens outside the simulation, from the files on disk, so it
+never slows a run down. start_render() runs a whole render in a background
+process and returns a Future, so a script can start on its next run while
+the last one is being drawn:
+
+    render('run', 'phage.gif', fields=['phage'], workers=4)
+
+or from the command line:
+
+    python3 render.py run -o phage.gif --fields phage --workers 4
+'''
+
+# Frames sent to a worker at a time
+BATCH = 16
+
+# The worker's FrameRenderer, made by _start_worker()
+_renderer = None
+
+
+class FrameRenderer:
+    """
+    Draws frames of a trajectory, reusing one figure for all of them.
+
+    Attributes:
+        trajectory: The recorder.Trajectory being drawn.
+        fields: Names of the grids drawn, side by side.
+        size: (width, height) of every frame in pixels.
+    """
+    def __init__(self, directory, fields, limits, cmap='viridis', scale=None,
+                 label=True):
+        # Imported here so that importing render does not need matplotlib
+        import matplotlib
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        self.trajectory = recorder.Trajectory(directory)
+        self.fields = list(fields)
+        self._positions = [self.trajectory.fields.index(name)
+                           for name in self.fields]
+        rows, cols = self.trajectory.shape
+        if scale is None:
+            scale = default_scale(self.trajectory.shape)
+        self.size = (cols * scale * len(self.fields), rows * scale)
+        self._cmap = matplotlib.colormaps[cmap]
+
+        dpi = 100
+        self._figure = Figure(figsize=(self.size[0] / dpi, self.size[1] / dpi),
+                              dpi=dpi)
+        self._canvas = FigureCanvasAgg(self._figure)
+        self._images = []
+        self._labels = []
+        for panel, name in enumerate(self.fields):
+            axes = self._figure.add_axes(
+                [panel / len(self.fields), 0, 1 / len(self.fields), 1])
+            axes.set_axis_off()
+            vmin, vmax = limits[name]
+            self._images.append(axes.imshow(
+                np.zeros((rows, cols)), cmap=self._cmap, vmin=vmin,
+                vmax=vmax, origin='lower', interpolation='nearest',
+                aspect='auto'))
+            self._labels.append(axes.text(
+                0.02, 0.98, '', transform=axes.transAxes, color='white',
+                fontsize=8, va='top') if label else None)
+        self._palette = None
+
+    def render(self, index):
+        """
+        Draw frame `index` and return it as an RGB array of shape
+        (height, width, 3).
+        """
+        frame = self.trajectory[index]
+        time = self.trajectory.times[index]
+        for name, position, image, label in zip(
+                self.fields, self._positions, self._images, self._labels):
+            image.set_data(frame[position])
+            if label is not None:
+                label.set_text("{}  t = {:g}".format(name, time))
+        self._canvas.draw()
+        return np.asarray(self._canvas.buffer_rgba())[..., :3].copy()
+
+    def render_paletted(self, index):
+        """
+        Draw frame `index` as a paletted Pillow image for a GIF. Every frame
+        shares one palette, made of the colour map plus black and white.
+        """
+        from PIL import Image
+
+        if self._palette is None:
+            colours = self._cmap(np.linspace(0, 1, 254))[:, :3]
+            colours = np.vstack([colours, [[0, 0, 0], [1, 1, 1]]])
+            self._palette = Image.new('P', (1, 1))
+            self._palette.putpalette(
+                np.round(colours * 255).astype(np.uint8).ravel().tolist())
+        return Image.fromarray(self.render(index)).quantize(
+            palette=self._palette, dither=Image.Dither.NONE)
+
+
+def default_scale(shape):
+    """
+    Get an even number of pixels per patch that makes a grid of `shape` at
+    least 256 pixels on its longer side.
+    """
+    scale = max(1, -(-256 // max(shape)))
+    return scale + scale % 2
+
+
+def field_limits(trajectory, fields):
+    """
+    Get the (min, max) colour limits of each field over the whole
+    trajectory, so that colours mean the same in every frame.
+    """
+    positions = [trajectory.fields.index(name) for name in fields]
+    high = np.ones(len(fields))
+    for frame in trajectory:
+        high = np.maximum(high, frame[positions].reshape(
+            len(fields), -1).max(axis=1))
+    return {name: (0, float(top)) for name, top in zip(fields, high)}
+
+
+def _start_worker(*args):
+    global _renderer
+    _renderer = FrameRenderer(*args)
+
+
+def _render_batch(indices, kind, directory=None):
+    # Draw a batch of frames in a worker, returning what the writer needs
+    if kind == 'png':
+        from PIL import Image
+
+        for index in indices:
+            Image.fromarray(_renderer.render(index)).save(
+                os.path.join(directory, '{}.png'.format(index)))
+        return []
+    elif kind == 'gif':
+        return [_renderer.render_paletted(index) for index in indices]
+    return [_renderer.render(index) for index in indices]
+
+
+def render(directory, output, fields=None, start=0, stop=None, every=1,
+           fps=10, cmap='viridis', scale=None, label=True, limits=None,
+           workers=None):
+    """
+    Render a recorded trajectory to an animation.
+
+    Args:
+        directory: Directory written by recorder.TrajectoryRecorder.
+        output: Path of the animation. A .gif is written with Pillow, a path
+            without an extension is made a directory of numbered PNGs, and
+            anything else is encoded by ffmpeg (e.g. .mp4).
+        fields: Grids to draw side by side (defaults to the first one).
+        start, stop, every: Frames to draw, as in range().
+        fps: Frames per second of the animation.
+        cmap: Name of a matplotlib colour map.
+        scale: Pixels per patch (defaults to default_scale()).
+        label: Whether to print the field name and time on every frame.
+        limits: Dict from field to (min, max) colour limits. By default each
+            field is scaled from 0 to its maximum over the trajectory.
+        workers: Number of worker processes (defaults to the number of
+            CPUs). With 1, frames are drawn in this process.
+
+    Return:
+        Number of frames rendered.
+    """
+    trajectory = recorder.Trajectory(directory)
+    if fields is None:
+        fields = trajectory.fields[:1]
+    for name in fields:
+        if name not in trajectory.fields:
+            raise ValueError("Unknown field {!r}, expected one of {}".format(
+                name, trajectory.fields))
+    if limits is None:
+        limits = field_limits(trajectory, fields)
+    indices = range(*slice(start, stop, every).indices(len(trajectory)))
+    batches = [indices[i:i + BATCH] for i in range(0, len(indices), BATCH)]
+    if not batches:
+        raise ValueError("No frames to render in {}".format(directory))
+
+    extension = os.path.splitext(output)[1].lower()
+    if not extension:
+        kind = 'png'
+        os.makedirs(output, exist_ok=True)
+    elif extension == '.gif':
+        kind = 'gif'
+    else:
+        kind = 'video'
+    if scale is None:
+        scale = default_scale(trajectory.shape)
+    rows, cols = trajectory.shape
+    size = (cols * scale * len(fields), rows * scale)
+    setup = (directory, fields, limits, cmap, scale, label)
+
+    if workers == 1:
+        _start_worker(*setup)
+        frames = (frame for batch in batches
+                  for frame in _render_batch(batch, kind, output))
+        _write(frames, output, kind, fps, size)
+        return len(indices)
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_start_worker,
+            initargs=setup) as pool:
+        # map() returns batches in order while later ones are still drawn
+        results = pool.map(_render_batch, batches,
+                           [kind] * len(batches), [output] * len(batches))
+        frames = (frame for batch in results for frame in batch)
+        _write(frames, output, kind, fps, size)
+    return len(indices)
+
+
+def _write(frames, output, kind, fps, size):
+    # Write frames, in order, as they arrive
+    if kind == 'png':
+        for _ in frames:
+            pass
+    elif kind == 'gif':
+        first = next(frames)
+        first.save(output, save_all=True, append_images=frames,
+                   duration=1000 / fps, loop=0, optimize=False)
+    else:
+        ffmpeg = shutil.which('ffmpeg')
+        if ffmpeg is None:
+            raise RuntimeError("ffmpeg is needed to write {}".format(output))
+        encoder = subprocess.Popen(
+            [ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo',
+             '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(*size),
+             '-r', str(fps), '-i', '-',
+             # Most encoders need even dimensions
+             '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p',
+             output], stdin=subprocess.PIPE)
+        try:
+            for frame in frames:
+                encoder.stdin.write(frame.tobytes())
+        finally:
+            encoder.stdin.close()
+            if encoder.wait() != 0:
+                raise RuntimeError("ffmpeg failed to write {}".format(output))
+
+
+def start_render(directory, output, **kwargs):
+    """
+    Run render() in a background process.
+
+    Return:
+        A concurrent.futures.Future of the number of frames rendered.
+    """
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+    future = executor.submit(render, directory, output, **kwargs)
+    # The process exits once the render is done
+    executor.shutdown(wait=False)
+    return future
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Render a recorded trajectory to a GIF, video or PNGs.")
+    parser.add_argument('directory', help="directory of the trajectory")
+    parser.add_argument('-o', '--output', required=True,
+                        help=".gif, video file (e.g. .mp4, needs ffmpeg) or "
+                             "directory of PNGs")
+    parser.add_argument('--fields', nargs='+', default=None,
+                        help="grids to draw side by side "
+                             "(default: the first one)")
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('--stop', type=int, default=None)
+    parser.add_argument('--every', type=int, default=1,
+                        help="draw every n-th frame")
+    parser.add_argument('--fps', type=float, default=10)
+    parser.add_argument('--cmap', default='viridis')
+    parser.add_argument('--scale', type=int, default=None,
+                        help="pixels per patch")
+    parser.add_argument('--no-label', action='store_true',
+                        help="leave out the field name and time")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="worker processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    frames = render(args.directory, args.output, fields=args.fields,
+                    start=args.start, stop=args.stop, every=args.every,
+                    fps=args.fps, cmap=args.cmap, scale=args.scale,
+                    label=not args.no_label, workers=args.workers)
+    print("Rendered {} frames to {}".format(frames, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import math
+import zlib
+
+import numpy as np
+
+'''
+Counter-based random streams for the simulations.
+
+Every draw is keyed by (step, patch, purpose) and computed with the Philox4x64
+counter-based generator, so it does not depend on the order in which patches
+are visited, on how the grid is split between processes, or on how many other
+draws were made before it. Engines that draw through a Streams object give
+identical trajectories whether they run serially, vectorized or tiled.
+
+A stream is the sequence of numbers of an np.random.Philox generator whose
+counter starts at (0, step, patch, purpose). Streams.generator() returns that
+generator, and Streams.random() computes its first numbers directly, for many
+patches at once.
+'''
+
+
+# Philox4x64-10 constants (Salmon et al., doi: 10.1145/2063384.2063405), as
+# in np.random.Philox
+PHILOX_M = (np.uint64(0xD2E7470EE14C6C93), np.uint64(0xCA5A826395121157))
+PHILOX_W = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xBB67AE8584CAA73B))
+PHILOX_ROUNDS = 10
+
+
+class Streams:
+    """
+    Random streams keyed by (step, patch, purpose), all derived from one
+    seed.
+
+    Steps and patches are non-negative integers. A purpose is a
+    non-negative integer or a name, such as 'infect', that tells apart
+    the draws made for different reasons in the same patch and step.
+
+    Attributes:
+        sequence: np.random.SeedSequence the key was drawn from.
+            Streams(sequence) recreates the same streams.
+        key: Philox key, as two uint64.
+    """
+    def __init__(self, seed=None):
+        """
+        Inits Streams from a seed, or from an np.random.SeedSequence. If seed
+        is None, fresh entropy is drawn.
+        """
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.sequence = seed
+        self.key = seed.generate_state(2, np.uint64)
+
+    def generator(self, step, patch, purpose):
+        """
+        Get the generator of one stream, to draw any number and kind of
+        random values from it.
+
+        Return:
+            np.random.Generator over np.random.Philox.
+        """
+        counter = [0, step, patch, _purpose(purpose)]
+        return np.random.Generator(np.random.Philox(key=self.key,
+                                                    counter=counter))
+
+    def random(self, step, patches, purpose, draw=0):
+        """
+        Get the `draw`th uniform number in [0, 1) of the streams of many
+        patches at once. Arguments are broadcast against each other.
+
+        Return:
+            Array of the numbers that generator(step, patch,
+            purpose).random() would give as its draw + 1th value.
+        """
+        step, patches, draw = np.broadcast_arrays(
+            np.asarray(step, dtype=np.uint64),
+            np.asarray(patches, dtype=np.uint64),
+            np.asarray(draw, dtype=np.uint64))
+        # A Philox generator advances its counter before the first block,
+        # and each block holds four numbers
+        counter = (draw // np.uint64(4) + np.uint64(1), step, patches,
+                   np.full(step.shape, _purpose(purpose), dtype=np.uint64))
+        block = philox(counter, self.key)
+        bits = np.choose((draw % np.uint64(4)).astype(int), block)
+        return (bits >> np.uint64(11)) * (1.0 / 9007199254740992.0)
+
+    def binomial(self, step, patches, purpose, n, p):
+        """
+        Draw binomial(n, p) values for many patches at once by inverting the
+        binomial distribution function at the first number of each stream.
+        """
+        return inverse_binomial(self.random(step, patches, purpose), n, p)
+
+
+def _purpose(purpose):
+    # Purposes given by name are keyed by their CRC-32
+    if isinstance(purpose, str):
+        return zlib.crc32(purpose.encode())
+    return int(purpose)
+
+
+def philox(counter, key):
+    """
+    Philox4x64-10 block function, for arrays of counters.
+
+    Args:
+        counter: Four arrays of uint64 (broadcast together), the words of
+            the counters from lowest to highest.
+        key: Two uint64.
+
+    Return:
+        Four arrays of uint64, the words of the output blocks.
+    """
+    x = [np.array(word, dtype=np.uint64) for word in
+         np.broadcast_arrays(*counter)]
+    key = [np.full(x[0].shape, word, dtype=np.uint64) for word in key]
+    multipliers = [np.full(x[0].shape, m, dtype=np.uint64) for m in PHILOX_M]
+    # Arithmetic is modulo 2**64, and single counters give numpy scalars,
+    # which warn when they wrap around
+    with np.errstate(over='ignore'):
+        for i in range(PHILOX_ROUNDS):
+            if i > 0:
+                key = [key[0] + PHILOX_W[0], key[1] + PHILOX_W[1]]
+            hi0, lo0 = _mulhilo(multipliers[0], x[0])
+            hi1, lo1 = _mulhilo(multipliers[1], x[2])
+            x = [hi1 ^ x[1] ^ key[0], lo1, hi0 ^ x[3] ^ key[1], lo0]
+    return x
+
+
+def _mulhilo(a, b):
+    # High and low words of the 128-bit product of uint64 arrays, from
+    # 32-bit halves
+    mask = np.uint64(0xFFFFFFFF)
+    shift = np.uint64(32)
+    a_lo, a_hi = a & mask, a >> shift
+    b_lo, b_hi = b & mask, b >> shift
+    lo_lo = a_lo * b_lo
+    lo_hi = a_lo * b_hi
+    hi_lo = a_hi * b_lo
+    middle = (lo_lo >> shift) + (lo_hi & mask) + (hi_lo & mask)
+    hi = a_hi * b_hi + (lo_hi >> shift) + (hi_lo >> shift) + \
+        (middle >> shift)
+    return hi, a * b
+
+
+def inverse_binomial(u, n, p):
+    """
+    Invert the binomial(n, p) distribution function at u, elementwise: the
+    smallest k with P(X <= k) > u.
+
+    The search starts at 0, or, for wide distributions, at 8 standard
+    deviations below the mean, where the probability left out is below
+    1e-15.
+    """
+    u, n, p = (np.array(value) for value in np.broadcast_arrays(u, n, p))
+    k = np.where(p >= 1, n, 0).astype(np.int64)
+    flat_k = k.reshape(-1)
+    index = np.flatnonzero((n > 0) & (p > 0) & (p < 1))
+    if index.size == 0:
+        return k[()]
+    u = u.flat[index]
+    n = n.flat[index].astype(float)
+    p = p.flat[index].astype(float)
+    mean = n * p
+    deviation = np.sqrt(mean * (1 - p))
+    start = np.where(deviation > 5, np.floor(mean - 8 * deviation), 0)
+    start = np.maximum(start, 0)
+    lgamma = np.frompyfunc(math.lgamma, 1, 1)
+    log_pmf = (lgamma(n + 1) - lgamma(start + 1) - lgamma(n - start + 1))
+    log_pmf = log_pmf.astype(float) + start * np.log(p) + \
+        (n - start) * np.log1p(-p)
+    log_odds = np.log(p) - np.log1p(-p)
+    cdf = np.exp(log_pmf)
+    current = start
+    while index.size > 0:
+        done = (u < cdf) | (current >= n)
+        flat_k[index[done]] = current[done]
+        keep = ~done
+        index, u, n, log_odds, log_pmf, cdf, current = (
+            value[keep] for value in
+            (index, u, n, log_odds, log_pmf, cdf, current))
+        log_pmf = log_pmf + np.log((n - current) / (current + 1)) + log_odds
+        current = current + 1
+        cdf = cdf + np.exp(log_pmf)
+    return k[()]
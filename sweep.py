@@ -0,0 +1,191 @@
+#! /usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import json
+import sys
+import zlib
+
+import numpy as np
+
+import cache
+import heilmann
+
+'''
+Runs the Heilmann model over a grid of parameters, spreading the runs across a
+pool of worker processes.
+
+Every run gets its own random number generator, spawned from one
+np.random.SeedSequence by the run's parameters and replicate number. Results
+are therefore the same whatever the number of workers, a table can be
+regenerated exactly from its seed, and adding parameter values to a sweep
+leaves the runs of the existing ones unchanged. With a result cache, only
+the runs that are new are computed.
+'''
+
+
+def make_jobs(eps_list, burst_sizes, decays=(0,), random_eps=(True,),
+              replicates=3):
+    """
+    Expand parameter lists into one job per table row.
+
+    Jobs are ordered as in the published tables: burst size is the outermost
+    loop, then EPS fill, decay time, EPS placement and finally replicate.
+
+    Args:
+        eps_list: EPS fill fractions.
+        burst_sizes: Burst sizes.
+        decays: Dead cell decay times (0 for no decay).
+        random_eps: EPS placements to run (True for random placement).
+        replicates: Number of replicates of each parameter set.
+
+    Return:
+        List of dicts of run_simulation keyword arguments.
+    """
+    jobs = []
+    for burst in burst_sizes:
+        for eps in eps_list:
+            for decay in decays:
+                for placement in random_eps:
+                    for _ in range(replicates):
+                        jobs.append(dict(eps=eps, burst=burst, decay=decay,
+                                         random_eps=placement))
+    return jobs
+
+
+def run_job(job, seed, **kwargs):
+    """
+    Run a single simulation with a generator built from `seed`.
+
+    Args:
+        job: run_simulation keyword arguments from make_jobs.
+        seed: np.random.SeedSequence for this job.
+        **kwargs: Further run_simulation keyword arguments shared by all jobs.
+
+    Return:
+        Table row for the job, formatted by heilmann.format_row.
+    """
+    rng = np.random.default_rng(seed)
+    output = heilmann.run_simulation(rng=rng, verbose=False, **job, **kwargs)
+    return heilmann.format_row(job['eps'], job['burst'], output)
+
+
+def job_seeds(root, jobs):
+    """
+    Seed every job from its parameters and replicate number.
+
+    Args:
+        root: Root np.random.SeedSequence of the sweep.
+        jobs: Jobs from make_jobs.
+
+    Return:
+        List of np.random.SeedSequence, one per job.
+    """
+    seeds = []
+    replicates = {}
+    for job in jobs:
+        name = json.dumps(job, sort_keys=True)
+        replicate = replicates[name] = replicates.get(name, -1) + 1
+        seeds.append(np.random.SeedSequence(
+            root.entropy, spawn_key=(zlib.crc32(name.encode()), replicate)))
+    return seeds
+
+
+def run_sweep(jobs, out=sys.stdout, seed=None, workers=None, **kwargs):
+    """
+    Run jobs on a process pool and stream table rows to `out`.
+
+    Rows are written in job order as soon as every earlier job has finished,
+    so a partial table is always a prefix of the full one.
+
+    Args:
+        jobs: Jobs from make_jobs.
+        out: File object the table is written to.
+        seed: Entropy for the root np.random.SeedSequence. If None, fresh
+            entropy is drawn and reported on stderr.
+        workers: Number of worker processes (defaults to the number of CPUs).
+        **kwargs: Further run_simulation keyword arguments shared by all jobs.
+
+    Return:
+        Entropy of the root SeedSequence.
+    """
+    root = np.random.SeedSequence(seed)
+    if seed is None:
+        print("Sweep seed: {}".format(root.entropy), file=sys.stderr)
+    seeds = job_seeds(root, jobs)
+
+    print(heilmann.HEADER, file=out)
+    out.flush()
+    finished = {}
+    next_row = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job, job, job_seed, **kwargs): index
+                   for index, (job, job_seed) in enumerate(zip(jobs, seeds))}
+        for future in concurrent.futures.as_completed(futures):
+            finished[futures[future]] = future.result()
+            # Write out every row that is now complete from the front
+            while next_row in finished:
+                print(finished.pop(next_row), file=out)
+                next_row += 1
+            out.flush()
+    return root.entropy
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a Heilmann model parameter sweep in parallel.")
+    parser.add_argument('--eps', type=float, nargs='+',
+                        default=[0.1, 0.3, 0.6, 0.9], help="EPS fill fractions")
+    parser.add_argument('--burst', type=int, nargs='+',
+                        default=[2, 6, 10, 20, 40, 60], help="burst sizes")
+    parser.add_argument('--decay', type=int, nargs='+', default=[0],
+                        help="dead cell decay times (0 for no decay)")
+    parser.add_argument('--ordered-eps', action='store_true',
+                        help="place EPS left to right instead of randomly")
+    parser.add_argument('--replicates', type=int, default=3)
+    parser.add_argument('--sim-time', type=int, default=10000)
+    parser.add_argument('--burn-in', type=int, default=7000)
+    parser.add_argument('--engine', choices=sorted(heilmann.ENGINES),
+                        default='loop')
+    parser.add_argument('--seed', type=int, default=None,
+                        help="root seed, for reproducing a table")
+    parser.add_argument('--stop-on-extinction', action='store_true',
+                        help="stop runs once phage or cells are extinct")
+    parser.add_argument('--rtol', type=float, default=None,
+                        help="end the burn-in and runs once the outputs "
+                             "settle to this relative tolerance")
+    parser.add_argument('--window', type=int, default=250,
+                        help="steps per window of the convergence test")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="worker processes (default: number of CPUs)")
+    parser.add_argument('-o', '--output', default=None,
+                        help="TSV file to write (default: stdout)")
+    parser.add_argument('--cache', default=None,
+                        help="directory of cached runs, reused across sweeps")
+    parser.add_argument('--cache-size', type=float, default=None,
+                        help="size limit of the cache in MB")
+    args = parser.parse_args()
+
+    jobs = make_jobs(args.eps, args.burst, decays=args.decay,
+                     random_eps=(not args.ordered_eps,),
+                     replicates=args.replicates)
+    result_cache = None
+    if args.cache:
+        max_bytes = None
+        if args.cache_size is not None:
+            max_bytes = int(args.cache_size * 2**20)
+        result_cache = cache.ResultCache(args.cache, max_bytes=max_bytes)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        run_sweep(jobs, out=out, seed=args.seed, workers=args.workers,
+                  sim_time=args.sim_time, burn_in=args.burn_in,
+                  engine=args.engine,
+                  stop_on_extinction=args.stop_on_extinction,
+                  rtol=args.rtol, window=args.window, cache=result_cache)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import numpy as np
+
+import cache
+import heilmann
+
+
+def run_three(rng, result_cache):
+    return [heilmann.run_simulation(0.3, 20, sim_time=60, burn_in=20,
+                                    engine='vectorized', rng=rng,
+                                    verbose=False, cache=result_cache)
+            for _ in range(3)]
+
+
+def test_cached_runs_advance_shared_generator(tmp_path):
+    result_cache = cache.ResultCache(str(tmp_path))
+    cold = run_three(np.random.default_rng(7), result_cache)
+    rng = np.random.default_rng(7)
+    warm = run_three(rng, result_cache)
+    assert warm == cold
+    assert [output['alphab_avg'] for output in cold] != \
+        [cold[0]['alphab_avg']] * 3
+    # The generator ends where the computed runs left it
+    uncached = np.random.default_rng(7)
+    run_three(uncached, None)
+    assert rng.random() == uncached.random()
+
+
+def test_cached_runs_advance_global_state(tmp_path):
+    result_cache = cache.ResultCache(str(tmp_path))
+    np.random.seed(7)
+    cold = run_three(np.random, result_cache)
+    after = np.random.random()
+    np.random.seed(7)
+    warm = run_three(np.random, result_cache)
+    assert warm == cold
+    assert np.random.random() == after
@@ -0,0 +1,127 @@
+import numpy as np
+
+import cache
+import gillespie_multi_particle as gmp
+import streams
+
+
+def test_long_patch_counts_stay_non_negative():
+    # Phage lost to goo at a huge rate leave rounding errors in the running
+    # propensity sum that are larger than every propensity left afterwards
+    for seed in range(4):
+        patch = gmp.Patch(0, 0, 1, cells=50, phages=1500, goo=1000,
+                          burst_size=40, k_replicate=0.03, k_infect=1e-3,
+                          k_lysis=0.1, k_goo=3.7e9)
+        patch.rng = np.random.default_rng(seed)
+        names = [reaction.name for reaction in patch.network.reactions]
+        fired = [0] * len(names)
+        for time in range(1, 201):
+            patch.execute_until(time, fired=fired)
+            assert min(patch.counts) >= 0
+        assert fired[names.index('goo')] == 1500
+        # Cells keep replicating once the phage are gone
+        assert fired[names.index('replicate')] > 100
+
+
+def test_lockstep_matches_patches_when_sums_drift():
+    rates = [np.full((2, 3), rate) for rate in (40, 0.03, 1e-3, 0.1, 3.7e9)]
+    results = []
+    for lockstep in (True, False):
+        state = np.zeros((len(gmp.Patch.network.species), 2, 3),
+                         dtype=np.int32)
+        state[gmp.Patch.network.species.index('cells')] = 50
+        state[gmp.Patch.network.species.index('phages')] = 1500
+        state[gmp.Patch.network.species.index('goo')] = 1000
+        patch_time = np.zeros((2, 3))
+        rng = streams.Streams(11)
+        for step in range(1, 101):
+            if lockstep:
+                gmp.execute_lockstep(state, patch_time, rates, step, rng=rng,
+                                     step=step)
+            else:
+                gmp.execute_patches(state, patch_time, rates, 1, step,
+                                    rng=rng, step=step)
+            assert state.min() >= 0
+        results.append(state)
+    assert np.array_equal(*results)
+
+
+class CountingPatch(gmp.Patch):
+    leaps = 0
+
+    def leap(self, tau):
+        CountingPatch.leaps += 1
+        return super().leap(tau)
+
+
+def final_counts(tau_epsilon, seeds, until=10):
+    counts = []
+    for seed in seeds:
+        patch = CountingPatch(0, 0, 1, cells=5000, phages=20000, goo=5,
+                              burst_size=20, k_replicate=0.03, k_infect=1e-5,
+                              k_lysis=0.1, k_goo=0.001)
+        patch.rng = np.random.default_rng(seed)
+        patch.execute_until(until, tau_epsilon)
+        counts.append(patch.counts)
+    return np.mean(counts, axis=0)
+
+
+def test_tau_leaping_leaps_and_matches_exact_means():
+    CountingPatch.leaps = 0
+    exact = final_counts(None, range(40))
+    assert CountingPatch.leaps == 0
+    leaped = final_counts(gmp.TAU_EPSILON, range(1000, 1040))
+    assert CountingPatch.leaps > 40 * 100
+    np.testing.assert_allclose(leaped, exact, rtol=0.05)
+
+
+def test_tau_leaping_starts_without_infected_cells():
+    # The patches start with no infected cells, which must not hold back
+    # the first leap of an interval of about 50 reactions
+    CountingPatch.leaps = 0
+    final_counts(gmp.TAU_EPSILON, range(10), until=0.05)
+    assert CountingPatch.leaps >= 10
+
+
+def test_nsm_matches_patch_engine_at_until():
+    params = dict(length=1, phage_diffusion=1, cell_diffusion=6, goo=5,
+                  max_cell_density=3, burst_size=20, k_infect=0.01,
+                  k_lysis=0.1, k_goo=0.001, k_replicate=0.03, until=3)
+    totals = {}
+    for engine, seeds in (('nsm', range(25)), ('patch', range(100, 125))):
+        results = [gmp.run_plate(4, 4, seed=seed, engine=engine, **params)
+                   for seed in seeds]
+        if engine == 'nsm':
+            # No event past until is executed
+            assert all(result['time'] == 3 for result in results)
+        totals[engine] = np.mean([result['state'].sum(axis=(1, 2))
+                                  for result in results], axis=0)
+    np.testing.assert_allclose(totals['nsm'], totals['patch'], rtol=0.1)
+
+
+def test_run_plate_seed_has_one_form(tmp_path):
+    result_cache = cache.ResultCache(str(tmp_path))
+    spawned = np.random.SeedSequence(7).spawn(2)[1]
+    for seed, spawn_key in ((7, []), (spawned, [1])):
+        runs = [gmp.run_plate(3, 3, 1, 1, 6, 5, 3, 20, 0.01, 0.1, 0.001,
+                              0.03, until=1, seed=seed, cache=result_cache)
+                for _ in range(2)]
+        # Computed, then read from the cache
+        for run in runs:
+            assert run['seed'] == {'entropy': 7, 'spawn_key': spawn_key}
+        np.testing.assert_array_equal(runs[1]['state'], runs[0]['state'])
+
+
+def test_unseeded_plates_leave_global_state_alone():
+    np.random.seed(4)
+    expected = np.random.random()
+    np.random.seed(4)
+    plate = gmp.Plate(3, 3, 1, 1, 6, 5, 3, 20, 0.01, 0.1, 0.001, 0.03)
+    plate.iterate()
+    run = gmp.run_plate(3, 3, 1, 1, 6, 5, 3, 20, 0.01, 0.1, 0.001, 0.03,
+                        until=1)
+    assert np.random.random() == expected
+    # The drawn seed repeats the run
+    again = gmp.run_plate(3, 3, 1, 1, 6, 5, 3, 20, 0.01, 0.1, 0.001, 0.03,
+                          until=1, seed=run['seed']['entropy'])
+    np.testing.assert_array_equal(again['state'], run['state'])
@@ -0,0 +1,127 @@
+import json
+
+import numpy as np
+import pytest
+
+import heilmann
+import profiling
+import streams
+import tiled
+
+
+def ensemble_means(engine, seeds):
+    outputs = [heilmann.run_simulation(0.9, 40, sim_time=1000, burn_in=300,
+                                       rows=32, cols=32, engine=engine,
+                                       rng=np.random.default_rng(seed),
+                                       verbose=False)
+               for seed in seeds]
+    return {key: np.mean([output[key] for output in outputs])
+            for key in ('p2c', 'p2ic', 'phage_with_eps')}
+
+
+def test_vectorized_engine_matches_loop_means():
+    loop = ensemble_means('loop', range(4))
+    vectorized = ensemble_means('vectorized', range(100, 116))
+    for key, mean in loop.items():
+        assert vectorized[key] == pytest.approx(mean, rel=0.05), key
+
+
+@pytest.mark.parametrize('engine', ['loop', 'active'])
+def test_profiled_visits_match_plain_visits(engine):
+    kwargs = dict(decay=5, sim_time=300, burn_in=50, rows=16, cols=16,
+                  engine=engine, verbose=False)
+    plain = heilmann.run_simulation(0.5, 20, rng=np.random.default_rng(3),
+                                    **kwargs)
+    profiler = profiling.Profiler()
+    profiled = heilmann.run_simulation(0.5, 20, rng=np.random.default_rng(3),
+                                       profiler=profiler, **kwargs)
+    assert profiled.pop('profile')['events']['lyses'] > 0
+    assert profiled == plain
+
+def test_runs_without_rng_leave_global_state_alone():
+    np.random.seed(4)
+    expected = np.random.random()
+    np.random.seed(4)
+    heilmann.run_simulation(0.5, 20, sim_time=50, burn_in=10, rows=8,
+                            cols=8, verbose=False)
+    assert np.random.random() == expected
+
+def test_tiled_runs_match_vectorized_streams():
+    kwargs = dict(decay=5, sim_time=300, burn_in=100, rows=24, cols=20,
+                  verbose=False)
+    vectorized = heilmann.run_simulation(0.5, 20, engine='vectorized',
+                                         rng=streams.Streams(7), **kwargs)
+    assert tiled.run_simulation(0.5, 20, bands=3, seed=7, **kwargs) == \
+        vectorized
+
+
+def test_ensemble_member_matches_single_vectorized_run():
+    kwargs = dict(decay=5, sim_time=200, burn_in=50)
+    ensemble = heilmann.run_ensemble(0.5, 20, 3, rng=streams.Streams(5),
+                                     **kwargs)
+    single = heilmann.run_simulation(0.5, 20, engine='vectorized',
+                                     rng=streams.Streams(5), verbose=False,
+                                     **kwargs)
+    first = ensemble['replicates'][0]
+    assert first == {key: single[key] for key in first}
+    assert ensemble['replicates'][1] != first
+
+
+def test_resume_converts_checkpoints_with_due_step_timers(tmp_path):
+    kwargs = dict(decay=7, sim_time=300, burn_in=50, rows=16, cols=16,
+                  engine='vectorized', verbose=False)
+    whole = heilmann.run_simulation(0.5, 20, rng=np.random.default_rng(2),
+                                    **kwargs)
+    path = str(tmp_path / 'run.npz')
+    heilmann.run_simulation(0.5, 20, rng=np.random.default_rng(2),
+                            checkpoint=path, checkpoint_every=100, **kwargs)
+    # Rewrite the timers the way older checkpoints stored them: the step at
+    # which they are due, or -1
+    with np.load(path) as data:
+        arrays = dict(data)
+    meta = json.loads(str(arrays['meta']))
+    time = meta['time']
+    for key, span in [('lysis', 21), ('debris', 8)]:
+        marks = arrays[key].astype(np.int32)
+        arrays[key] = np.where(marks > 0, time + (marks - 1 - time) % span,
+                               -1).astype(np.int32)
+    assert np.any(arrays['debris'] > 0)
+    np.savez_compressed(path, **arrays)
+    assert heilmann.resume(path, verbose=False) == whole
+
+
+def test_make_params_rejects_timers_too_long_for_grids():
+    with pytest.raises(ValueError):
+        heilmann.make_params(0.5, 20, decay=40000, rows=4, cols=4)
+
+
+def test_runs_stop_once_phage_are_extinct():
+    kwargs = dict(sim_time=3000, burn_in=100, rows=8, cols=8,
+                  engine='vectorized', verbose=False)
+    stopped = heilmann.run_simulation(0.9, 2, rng=np.random.default_rng(1),
+                                      stop_on_extinction=True, **kwargs)
+    assert stopped['stop_reason'] == 'phage extinct'
+    assert stopped['stop_time'] < 3000
+    full = heilmann.run_simulation(0.9, 2, rng=np.random.default_rng(1),
+                                   **kwargs)
+    assert (full['stop_reason'], full['stop_time']) == ('sim_time', 3000)
+
+
+def test_converged_runs_end_early_and_resume(tmp_path):
+    path = str(tmp_path / 'run.npz')
+    whole = heilmann.run_simulation(0.5, 20, sim_time=5000, burn_in=3000,
+                                    rows=16, cols=16, engine='vectorized',
+                                    rng=streams.Streams(3), rtol=0.2,
+                                    window=50, verbose=False,
+                                    checkpoint=path, checkpoint_every=500)
+    assert whole['stop_reason'] == 'converged'
+    assert whole['burn_in'] < 3000
+    assert whole['stop_time'] < 5000
+    # The stopping criteria carry over from the last checkpoint
+    assert heilmann.resume(path, verbose=False) == whole
+
+
+def test_tiled_runs_of_zero_steps_finish():
+    output = tiled.run_simulation(0.5, 20, sim_time=0, burn_in=0, rows=8,
+                                  cols=8, bands=2, seed=1, verbose=False)
+    assert (output['stop_reason'], output['stop_time']) == ('sim_time', 0)
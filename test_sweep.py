@@ -0,0 +1,26 @@
+import io
+import json
+
+import sweep
+
+
+def sweep_rows(jobs):
+    out = io.StringIO()
+    sweep.run_sweep(jobs, out=out, seed=5, workers=2, sim_time=40,
+                    burn_in=10, engine='vectorized')
+    rows = out.getvalue().splitlines()[1:]
+    # Rows keyed by the parameters and replicate number of their job
+    keyed = {}
+    for job, row in zip(jobs, rows):
+        name = json.dumps(job, sort_keys=True)
+        replicate = sum(key[0] == name for key in keyed)
+        keyed[name, replicate] = row
+    return keyed
+
+
+def test_reordered_table_keeps_per_row_results():
+    table = sweep_rows(sweep.make_jobs([0.3, 0.6], [10, 20], replicates=2))
+    reordered = sweep_rows(sweep.make_jobs([0.6, 0.3], [20, 10],
+                                           replicates=2))
+    assert reordered == table
+    assert len(set(table.values())) == len(table)
@@ -0,0 +1,596 @@
+#! /usr/bin/env python3
+
+import argparse
+import multiprocessing
+from multiprocessing import shared_memory
+import sys
+
+import numpy as np
+
+import heilmann
+import streams
+
+'''
+Runs the Heilmann model on large torus grids split across worker processes.
+
+The grid is cut into bands of whole rows, one per worker, held in shared
+memory. Each worker advances its own band with the same phases as
+heilmann.iterate_vectorized(). Bands only interact across their top and bottom
+rows, when a daughter cell is placed in, or a phage diffuses to, the row of a
+neighbouring band. These moves go through small shared halo buffers, one row
+per band edge, between the phases of a step. The main process only steps the
+workers through the phases and reduces their statistics at the end of every
+step.
+
+Every draw is keyed by the time step, the patch and its purpose with
+streams.Streams, so a run does not depend on the number of bands, and is the
+same as a run of heilmann.iterate_vectorized() with the same streams.
+'''
+
+
+# Grids shared between the bands, stored as heilmann.GRID_DTYPES
+GRIDS = ('phage', 'cells', 'eps', 'lysis', 'debris')
+
+
+class TiledTorus:
+    """
+    A Heilmann model grid advanced by one worker process per band of rows.
+
+    TiledTorus holds worker processes and shared memory until close() is
+    called, and can be used as a context manager.
+
+    Attributes:
+        params: Parameters of the run, as made by heilmann.make_params. The
+            grids in params are views into shared memory until close().
+        output: Output counters, as filled by heilmann.record_statistics.
+        bands: List of the (first row, end row) bounds of every band.
+    """
+    def __init__(self, params, bands=None):
+        """
+        Inits TiledTorus by moving the grids of params into shared memory
+        and starting the workers.
+
+        Args:
+            params: Parameters from heilmann.make_params for a single grid,
+                with a streams.Streams as rng.
+            bands: Number of bands (defaults to the number of CPUs, and is at
+                most the number of rows).
+        """
+        if not isinstance(params['rng'], streams.Streams):
+            raise ValueError("TiledTorus needs keyed random streams as rng")
+        rows, cols = params['rows'], params['cols']
+        bands = min(bands or multiprocessing.cpu_count(), rows)
+        bounds = np.linspace(0, rows, bands + 1).astype(int).tolist()
+        self.bands = list(zip(bounds, bounds[1:]))
+        self.params = params
+        self.output = params['output']
+
+        self._memory = {}
+        self._arrays = {}
+        for name in GRIDS:
+            self.params[name] = self._share(
+                name, np.asarray(params[name],
+                                 dtype=heilmann.GRID_DTYPES[name]))
+        # Halo buffers: daughter claims and phage leaving each band through
+        # its top (0) and bottom (1) row
+        self._share('claims', np.full((bands, 2, cols), -1.0))
+        self._share('flows', np.zeros((bands, 2, cols), dtype=np.int64))
+
+        shared = {name: (memory.name, self._arrays[name].shape,
+                         self._arrays[name].dtype.str)
+                  for name, memory in self._memory.items()}
+        rates = {key: params[key] for key in
+                 ('burst_size', 'p_replicate', 'lysis_time', 'decay_time',
+                  'p_eps', 'p_infect', 'p_debris', 'p_diffuse')}
+        self._connections = []
+        self._workers = []
+        for index, band in enumerate(self.bands):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=_band_worker,
+                args=(worker_connection, index, band, shared, rates,
+                      params['rng']),
+                daemon=True)
+            worker.start()
+            self._connections.append(connection)
+            self._workers.append(worker)
+
+    def _share(self, name, array):
+        """
+        Copy an array into a new block of shared memory.
+        """
+        memory = shared_memory.SharedMemory(create=True,
+                                            size=max(array.nbytes, 1))
+        self._memory[name] = memory
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+        shared[:] = array
+        self._arrays[name] = shared
+        return shared
+
+    def _all(self, command, *args):
+        """
+        Run a phase on every band in parallel and return their results.
+        """
+        for connection in self._connections:
+            connection.send((command, args))
+        results = [connection.recv() for connection in self._connections]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def step(self, time):
+        """
+        Advance every band by one time step and record the statistics of the
+        whole grid.
+        """
+        # Daughter cells are placed after the infections in rounds, as in
+        # heilmann.place_daughters(), until no band has a claim left
+        self._all('start', time)
+        self._all('infect', time)
+        while sum(self._all('claim')) > 0:
+            self._all('resolve')
+        self._all('diffuse', time)
+        reports = self._all('finish')
+
+        counts = {key: sum(report['counts'][key] for report in reports)
+                  for key in reports[0]['counts']}
+        totals = {key: sum(report[key] for report in reports)
+                  for key in reports[0] if key != 'counts'}
+        if time > self.params['burn_in']:
+            for key in ('burst_total', 'replication_total', 'lost_to_eps',
+                        'lost_to_debris', 'lost_to_primary_infection',
+                        'lost_to_secondary_infection'):
+                self.output[key] += totals[key]
+        self.params['counts'] = counts
+        heilmann.record_statistics(
+            time, self.params['burn_in'], self.params['burst_size'],
+            self.params['p_infect'], self.params['p_eps'], counts,
+            self.output, totals['phage_with_eps'],
+            totals['infection_with_eps'], totals['infection_total'])
+
+    def close(self):
+        """
+        Stop the workers and move the grids out of shared memory.
+        """
+        if not self._workers:
+            return
+        for connection in self._connections:
+            connection.send(('close', ()))
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._connections = []
+        for name in GRIDS:
+            self.params[name] = self.params[name].copy()
+        self._arrays = {}
+        for memory in self._memory.values():
+            memory.close()
+            memory.unlink()
+        self._memory = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _band_worker(connection, *args):
+    """
+    Serve the phases of a band, sent by TiledTorus as (command, args) pairs,
+    until told to close. Errors are sent back instead of a result.
+    """
+    band = _Band(*args)
+    try:
+        while True:
+            command, args = connection.recv()
+            if command == 'close':
+                break
+            try:
+                result = getattr(band, command)(*args)
+            except Exception as error:
+                result = error
+            connection.send(result)
+    finally:
+        band.close()
+
+
+class _Band:
+    """
+    The rows of the grid owned by one worker, with the phases of a time step
+    of heilmann.iterate_vectorized(), split where bands exchange halos:
+
+    start: expire the timers that are due.
+    infect: infections and losses of phage, then pick the replicating cells.
+    claim: let the replicating cells whose daughters are not placed yet
+        claim an empty neighbour each, with a random priority.
+    resolve: place the daughters with the highest priority claim on each
+        patch of the band, from the claims of the band and of its neighbours.
+    diffuse: phage diffusion within the band, with the phage leaving the
+        band set aside in the halo.
+    finish: take in the phage arriving from the neighbouring bands and report
+        the statistics of the band.
+
+    Patches are stored as flat indices into the band in the timer wheels and
+    as flat indices into the whole grid in claims.
+    """
+    def __init__(self, index, band, shared, rates, rng):
+        self.index = index
+        self.first, self.end = band
+        self.rates = rates
+        self.rng = rng
+        self._memory = []
+        arrays = {}
+        for name, (memory_name, shape, dtype) in shared.items():
+            memory = shared_memory.SharedMemory(name=memory_name)
+            self._memory.append(memory)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+        self.shape = arrays['cells'].shape
+        self.claims = arrays['claims']
+        self.flows = arrays['flows']
+        bands = self.claims.shape[0]
+        self.above = (index - 1) % bands
+        self.below = (index + 1) % bands
+        # Whole grid of cells, to look for empty neighbours across the halo
+        self.all_cells = arrays['cells']
+        for name in GRIDS:
+            setattr(self, name, arrays[name][self.first:self.end])
+        self.counts = heilmann.count_state(self.phage, self.cells, self.lysis,
+                                           self.debris, self.eps)
+        self.lysis_timers = heilmann.TimerWheel(rates['lysis_time'] + 1)
+        self.debris_timers = heilmann.TimerWheel(rates['decay_time'] + 1)
+        self.lysis_timers.restore(self.lysis)
+        self.debris_timers.restore(self.debris)
+        self.report = {}
+        self.parents = np.array([], dtype=int)
+        self._no_claims()
+
+    def _no_claims(self):
+        # Placeholder claims for the cells in parents, none of which has won
+        n = self.parents.size
+        self.targets = np.zeros(n, dtype=int)
+        self.priority = np.zeros(n)
+        self.sides = np.full(n, -1)
+        self.won = np.zeros(n, dtype=bool)
+
+    def claim(self):
+        """
+        Start a round of daughter placement, and return the number of claims
+        made.
+        """
+        rows, cols = self.shape
+        # Drop the cells whose claims won in the last round. Claims on the
+        # halo were resolved by the neighbouring band.
+        remote = self.sides >= 0
+        self.won[remote] = self.claims[self.index, self.sides[remote],
+                                       self.targets[remote] % cols] == \
+            self.priority[remote]
+        self.parents = self.parents[~self.won]
+        self.claims[self.index] = -1
+
+        parents = self.parents
+        r, c = np.divmod(parents, cols)
+        neighbours = np.stack([((r + 1) % rows) * cols + c,
+                               ((r - 1) % rows) * cols + c,
+                               r * cols + (c + 1) % cols,
+                               r * cols + (c - 1) % cols], axis=1)
+        empty = self.all_cells.flat[neighbours] == 0
+        n_empty = empty.sum(axis=1)
+        # Daughters with nowhere to move die
+        alive = n_empty > 0
+        self.parents = parents[alive]
+        neighbours = neighbours[alive]
+        empty = empty[alive]
+        n_empty = n_empty[alive]
+        # Pick uniformly among the empty neighbours of each parent, with the
+        # same draws as heilmann.place_daughters()
+        pick = self.rng.random(self.time, self.parents, 'place',
+                               draw=2 * self.attempt)
+        pick = (pick * n_empty).astype(int)
+        column = np.argmax(empty &
+                           (np.cumsum(empty, axis=1) == pick[:, None] + 1),
+                           axis=1)
+        self.targets = neighbours[np.arange(n_empty.size), column]
+        self.priority = self.rng.random(self.time, self.parents, 'place',
+                                        draw=2 * self.attempt + 1)
+        self.attempt += 1
+        # Side of the halo each claim is on: the row above the band (0), the
+        # row below it (1), or none (-1)
+        row = self.targets // cols
+        inside = (self.first <= row) & (row < self.end)
+        self.sides = np.where(inside, -1,
+                              np.where(row == (self.first - 1) % rows, 0, 1))
+        remote = self.sides >= 0
+        self.claims[self.index, self.sides[remote],
+                    self.targets[remote] % cols] = self.priority[remote]
+        self.won = np.zeros(n_empty.size, dtype=bool)
+        return int(n_empty.size)
+
+    def start(self, time):
+        """
+        Expire the timers due at `time`.
+        """
+        rates = self.rates
+        burst_size = rates['burst_size']
+        self.time = time
+        self.attempt = 0
+        report = self.report = dict.fromkeys(
+            ('burst_total', 'replication_total', 'lost_to_eps',
+             'lost_to_debris', 'lost_to_primary_infection',
+             'lost_to_secondary_infection', 'phage_with_eps',
+             'infection_with_eps', 'infection_total'), 0)
+        counts = self.counts
+
+        decayed = np.array(self.debris_timers.pop(time), dtype=int)
+        decayed = decayed[self.debris.flat[decayed] ==
+                          self.debris_timers.mark(time)]
+        self.debris.flat[decayed] = 0
+        counts['debris'] -= decayed.size
+
+        lysed = np.array(self.lysis_timers.pop(time), dtype=int)
+        if np.any(self.cells.flat[lysed] == 0):
+            # Sanity check
+            raise RuntimeError("Cell counts and lysis timers are out of sync.")
+        self.lysis.flat[lysed] = 0
+        self.phage.flat[lysed] += burst_size
+        self.cells.flat[lysed] = 0
+        counts['infected'] -= lysed.size
+        counts['phage'] += burst_size * lysed.size
+        if rates['decay_time'] > 0:
+            counts['debris'] += np.sum(self.debris.flat[lysed] == 0)
+            self.debris.flat[lysed] = self.debris_timers.mark(
+                time + rates['decay_time'])
+            self.debris_timers.schedule(lysed, time + rates['decay_time'])
+        report['burst_total'] = lysed.size
+
+    def resolve(self):
+        """
+        Place the daughters that won their claims on the patches of the band.
+        """
+        cols = self.shape[1]
+        best = np.full(self.cells.shape, -1.0)
+        local = self.sides < 0
+        targets = self.targets[local] - self.first * cols
+        np.maximum.at(best.reshape(-1), targets, self.priority[local])
+        # Claims from the neighbouring bands on the edge rows of this band
+        np.maximum(best[0], self.claims[self.above, 1], out=best[0])
+        np.maximum(best[-1], self.claims[self.below, 0], out=best[-1])
+        self.won[local] = best.flat[targets] == self.priority[local]
+        self.claims[self.above, 1] = best[0]
+        self.claims[self.below, 0] = best[-1]
+
+        placed = best >= 0
+        self.cells[placed] = 1
+        self.counts['healthy'] += int(np.sum(placed))
+        self.counts['healthy_eps'] += int(np.sum(placed & (self.eps > 0)))
+
+    def infect(self, time):
+        """
+        Process infections within the band and pick the replicating cells.
+        """
+        rates = self.rates
+        report = self.report
+        counts = self.counts
+        phage, cells, eps, lysis = self.phage, self.cells, self.eps, self.lysis
+        rng = self.rng
+
+        offset = self.first * self.shape[1]
+
+        occupied = np.nonzero(phage)
+        patches = np.ravel_multi_index(occupied, phage.shape) + offset
+        n_phage = phage[occupied]
+        p_infect_adj = cells[occupied] * rates['p_infect']
+        p_eps_adj = eps[occupied] * rates['p_eps']
+        p_debris_adj = (self.debris[occupied] > 0) * rates['p_debris']
+        infect = rng.binomial(time, patches, 'infect', n_phage, p_infect_adj)
+        p_left = 1 - p_infect_adj
+        to_eps = rng.binomial(time, patches, 'eps', n_phage - infect,
+                              heilmann._conditional(p_eps_adj, p_left))
+        p_left = p_left - p_eps_adj
+        to_debris = rng.binomial(time, patches, 'debris',
+                                 n_phage - infect - to_eps,
+                                 heilmann._conditional(p_debris_adj, p_left))
+
+        infected = infect > 0
+        primary = infected & (lysis[occupied] == 0)
+        secondary = infected & ~primary
+        lost_eps = ~infected & (to_eps > 0)
+        lost_debris = ~infected & ~lost_eps & (to_debris > 0)
+        lost = (infect + np.where(lost_eps, to_eps, 0) +
+                np.where(lost_debris, to_debris, 0))
+        phage[occupied] -= lost
+        counts['phage'] -= int(np.sum(lost))
+        infections = tuple(index[primary] for index in occupied)
+        lysis[infections] = self.lysis_timers.mark(rates['lysis_time'] + time)
+        self.lysis_timers.schedule(
+            np.ravel_multi_index(infections, lysis.shape),
+            rates['lysis_time'] + time)
+        n_primary = int(np.sum(primary))
+        counts['healthy'] -= n_primary
+        counts['infected'] += n_primary
+        counts['healthy_eps'] -= int(np.sum(primary & (eps[occupied] > 0)))
+
+        report['lost_to_primary_infection'] = int(np.sum(infect * primary))
+        report['lost_to_secondary_infection'] = int(np.sum(infect * secondary))
+        report['lost_to_eps'] = int(np.sum(to_eps * lost_eps))
+        report['lost_to_debris'] = int(np.sum(to_debris * lost_debris))
+        report['infection_with_eps'] = int(
+            np.sum(infect * (primary & (eps[occupied] > 0))))
+        report['infection_total'] = report['lost_to_primary_infection']
+        report['phage_with_eps'] = int(np.sum(np.where(eps > 0, phage, 0)))
+
+        healthy = np.flatnonzero((cells > 0) & (lysis == 0))
+        replicate = rng.binomial(time, healthy + offset, 'replicate',
+                                 cells.flat[healthy],
+                                 rates['p_replicate']) == 1
+        self.parents = healthy[replicate] + offset
+        self._no_claims()
+        report['replication_total'] = int(self.parents.size)
+
+    def diffuse(self, time):
+        """
+        Diffuse phage within the band, setting aside the phage that leave it.
+        """
+        phage = self.phage
+        rates = self.rates
+        rng = self.rng
+        offset = self.first * self.shape[1]
+
+        # Diffuse phage on the torus. Moves down off the last row and up off
+        # the first row go to the halo.
+        occupied = np.nonzero(phage)
+        patches = np.ravel_multi_index(occupied, phage.shape) + offset
+        to_diffuse = rng.binomial(time, patches, 'diffuse', phage[occupied],
+                                  rates['p_diffuse'])
+        moves = np.zeros((4,) + phage.shape, dtype=phage.dtype)
+        moves[0][occupied] = rng.binomial(time, patches, 'down', to_diffuse,
+                                          1/4)
+        moves[1][occupied] = rng.binomial(
+            time, patches, 'up', to_diffuse - moves[0][occupied], 1/3)
+        moves[2][occupied] = rng.binomial(
+            time, patches, 'right',
+            to_diffuse - moves[0][occupied] - moves[1][occupied], 1/2)
+        moves[3][occupied] = to_diffuse - moves[0][occupied] - \
+            moves[1][occupied] - moves[2][occupied]
+        phage[occupied] -= to_diffuse
+        phage[1:] += moves[0][:-1]                 # down
+        phage[:-1] += moves[1][1:]                 # up
+        phage += np.roll(moves[2], 1, axis=-1)     # right
+        phage += np.roll(moves[3], -1, axis=-1)    # left
+        self.flows[self.index, 0] = moves[1][0]
+        self.flows[self.index, 1] = moves[0][-1]
+        self.counts['phage'] -= int(moves[1][0].sum() + moves[0][-1].sum())
+
+    def finish(self):
+        """
+        Take in the phage arriving from the neighbouring bands, and return
+        the statistics of the band for this step.
+        """
+        arriving = [self.flows[self.above, 1], self.flows[self.below, 0]]
+        self.phage[0] += arriving[0]
+        self.phage[-1] += arriving[1]
+        self.counts['phage'] += int(arriving[0].sum() + arriving[1].sum())
+        self.report['counts'] = {key: int(value)
+                                 for key, value in self.counts.items()}
+        return self.report
+
+    def close(self):
+        for name in GRIDS:
+            setattr(self, name, None)
+        self.all_cells = self.claims = self.flows = None
+        for memory in self._memory:
+            memory.close()
+
+
+def run_simulation(eps,
+                   burst,
+                   decay=0,
+                   random_eps=True,
+                   sim_time=10000,
+                   burn_in=7000,
+                   rows=4096,
+                   cols=4096,
+                   bands=None,
+                   seed=None,
+                   verbose=True,
+                   stop_on_extinction=False,
+                   rtol=None,
+                   window=250,
+                   recorder=None):
+    """
+    Run the Heilmann model on a large torus grid split into bands of rows,
+    each advanced by its own worker process.
+
+    Args:
+        eps, burst, decay, random_eps, sim_time, burn_in, rows, cols: As for
+            heilmann.run_simulation.
+        bands: Number of bands and worker processes (defaults to the number
+            of CPUs). Results do not depend on it.
+        seed: Seed of the streams.Streams of the run. The output is the same
+            as that of heilmann.run_simulation with the vectorized engine and
+            streams.Streams(seed) as rng.
+        verbose: Report progress on stderr every 1000 steps.
+        stop_on_extinction, rtol, window: Criteria for ending the run, and
+            its burn-in, early, as for heilmann.run_simulation (see
+            heilmann.EarlyStopping).
+        recorder: recorder.TrajectoryRecorder for heilmann.FRAME_FIELDS, to
+            record the grids at the start of every step, and at the end, or
+            None.
+
+    Return:
+        Output counters and averages, as from heilmann.run_simulation.
+    """
+    params = heilmann.make_params(eps, burst, decay=decay,
+                                  random_eps=random_eps, burn_in=burn_in,
+                                  rows=rows, cols=cols,
+                                  rng=streams.Streams(seed))
+    stopping = None
+    if stop_on_extinction or rtol is not None:
+        stopping = heilmann.EarlyStopping(extinction=stop_on_extinction,
+                                          rtol=rtol, window=window)
+    reason = 'sim_time'
+    time = 0
+    with TiledTorus(params, bands=bands) as torus:
+        while time < sim_time:
+            if recorder is not None and recorder.due(time):
+                recorder.record(time, heilmann.frame_grids(params))
+            torus.step(time)
+            if verbose and (time + 1) % 1000 == 0:
+                print("Step {}".format(time + 1), file=sys.stderr)
+            if stopping is not None:
+                reason = stopping.update(time, params) or reason
+            time += params['delta_t']
+            if reason != 'sim_time':
+                break
+        if recorder is not None and recorder.due(time):
+            recorder.record(time, heilmann.frame_grids(params))
+    params['output'].update(stop_reason=reason, stop_time=time,
+                            burn_in=params['burn_in'])
+    return heilmann.summarize(params['output'], params['phage'],
+                              params['cells'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the Heilmann model on a large grid split across "
+                    "worker processes.")
+    parser.add_argument('--eps', type=float, default=0.3,
+                        help="EPS fill fraction")
+    parser.add_argument('--burst', type=int, default=20, help="burst size")
+    parser.add_argument('--decay', type=int, default=0,
+                        help="dead cell decay time (0 for no decay)")
+    parser.add_argument('--ordered-eps', action='store_true',
+                        help="place EPS left to right instead of randomly")
+    parser.add_argument('--rows', type=int, default=4096)
+    parser.add_argument('--cols', type=int, default=4096)
+    parser.add_argument('--sim-time', type=int, default=10000)
+    parser.add_argument('--burn-in', type=int, default=7000)
+    parser.add_argument('--bands', type=int, default=None,
+                        help="worker processes (default: number of CPUs)")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--stop-on-extinction', action='store_true',
+                        help="stop once phage or cells are extinct")
+    parser.add_argument('--rtol', type=float, default=None,
+                        help="end the burn-in and the run once the outputs "
+                             "settle to this relative tolerance")
+    parser.add_argument('--window', type=int, default=250,
+                        help="steps per window of the convergence test")
+    args = parser.parse_args()
+
+    output = run_simulation(args.eps, args.burst, decay=args.decay,
+                            random_eps=not args.ordered_eps,
+                            sim_time=args.sim_time, burn_in=args.burn_in,
+                            rows=args.rows, cols=args.cols, bands=args.bands,
+                            seed=args.seed,
+                            stop_on_extinction=args.stop_on_extinction,
+                            rtol=args.rtol, window=args.window)
+    print("Stopped at step {} ({}), burn-in {}".format(
+        output['stop_time'], output['stop_reason'], output['burn_in']),
+        file=sys.stderr)
+    print(heilmann.HEADER)
+    print(heilmann.format_row(args.eps, args.burst, output))
+
+
+if __name__ == "__main__":
+    main()